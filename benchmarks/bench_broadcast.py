@@ -0,0 +1,75 @@
+"""
+Serialization CPU per tick as subscriber count grows.
+
+Legacy: the tick dict is copied to every subscriber (as InMemoryChannelLayer
+does) and each consumer json.dumps it. Frame: the producer encodes once and
+every subscriber receives the same string.
+
+    python benchmarks/bench_broadcast.py --clients 10 100 1000 5000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markets.frames import Frame, orjson
+
+SYMBOLS = 75
+
+
+def make_response() -> dict:
+    now = int(time.time())
+    return {
+        "channel": "rates",
+        "event": "data",
+        "data": {
+            f"SYM{i}_CAD": {
+                "symbol": f"SYM{i}_CAD", "timestamp": now,
+                "bid": 100.0 + i, "ask": 100.5 + i, "spot": 100.25 + i, "change": 0.5,
+            }
+            for i in range(SYMBOLS)
+        },
+    }
+
+
+def legacy_tick(response: dict, clients: int):
+    for _ in range(clients):
+        message = deepcopy({"type": "rates.update", "payload": response})
+        json.dumps(message["payload"])
+
+
+def frame_tick(response: dict, clients: int):
+    frame = Frame(response)
+    for _ in range(clients):
+        message = deepcopy({"type": "rates.update", "text": frame.text})
+        message["text"]
+
+
+def cpu_per_tick(fn, response: dict, clients: int, ticks: int) -> float:
+    start = time.process_time()
+    for _ in range(ticks):
+        fn(response, clients)
+    return (time.process_time() - start) / ticks
+
+
+def main(args):
+    response = make_response()
+    print(f"{SYMBOLS} symbols per tick, encoder={'orjson' if orjson else 'json'}")
+    print(f"{'clients':>8} {'legacy ms/tick':>15} {'frame ms/tick':>14} {'speedup':>8}")
+    for clients in args.clients:
+        ticks = max(1, args.budget // clients)
+        legacy = cpu_per_tick(legacy_tick, response, clients, ticks)
+        frame = cpu_per_tick(frame_tick, response, clients, ticks)
+        print(f"{clients:>8} {legacy * 1000:>15.2f} {frame * 1000:>14.2f} {legacy / frame:>7.0f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--budget', type=int, default=5000, help='client sends simulated per row')
+    main(parser.parse_args())
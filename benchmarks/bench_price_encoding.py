@@ -0,0 +1,84 @@
+"""
+Compare the legacy str(dict) price history members with the binary records.
+
+Reports bytes per member and bulk decode throughput; with --redis-url it also
+loads one symbol's worth of ticks and reports MEMORY USAGE for each format:
+
+    python benchmarks/bench_price_encoding.py
+    python benchmarks/bench_price_encoding.py --redis-url redis://127.0.0.1:6379/15 --entries 86400
+"""
+
+import argparse
+import ast
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markets.encoding import encode_price, decode_prices
+
+
+def make_items(entries: int) -> list:
+    start = int(time.time()) - entries
+    return [
+        {
+            "symbol": "BTC_CAD",
+            "bid": f"{84123.456789 + i * 0.01:.6f}",
+            "ask": f"{84210.123456 + i * 0.01:.6f}",
+            "change": f"{-1.2345 + i * 0.0001:.4f}",
+            "timestamp": start + i,
+        }
+        for i in range(entries)
+    ]
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+async def redis_memory(redis_url: str, items: list, legacy: list, binary: list):
+    import redis.asyncio as aioredis
+    client = aioredis.Redis.from_url(redis_url)
+    usage = {}
+    for label, members in (("legacy", legacy), ("binary", binary)):
+        key = f"bench:price_encoding:{label}"
+        await client.delete(key)
+        for i in range(0, len(members), 10000):
+            await client.zadd(key, {m: item['timestamp'] for m, item in zip(members[i:i + 10000], items[i:i + 10000])})
+        usage[label] = await client.memory_usage(key, samples=0)
+        await client.delete(key)
+    await client.aclose()
+    return usage
+
+
+def main(args):
+    items = make_items(args.entries)
+    legacy = [str(item).encode() for item in items]
+    binary = [encode_price(item) for item in items]
+
+    legacy_size = sum(map(len, legacy)) / len(legacy)
+    binary_size = sum(map(len, binary)) / len(binary)
+    print(f"{args.entries} entries")
+    print(f"member size: legacy={legacy_size:.1f}B binary={binary_size:.1f}B ({legacy_size / binary_size:.1f}x smaller)")
+
+    eval_time = timed(lambda: [eval(m) for m in legacy])
+    literal_time = timed(lambda: [ast.literal_eval(m.decode()) for m in legacy])
+    bulk_time = timed(decode_prices, binary, "BTC_CAD")
+    print(f"decode: eval={eval_time * 1000:.1f}ms literal_eval={literal_time * 1000:.1f}ms "
+          f"binary bulk={bulk_time * 1000:.1f}ms ({eval_time / bulk_time:.0f}x faster than eval)")
+
+    if args.redis_url:
+        usage = asyncio.run(redis_memory(args.redis_url, items, legacy, binary))
+        print(f"redis MEMORY USAGE: legacy={usage['legacy']}B binary={usage['binary']}B "
+              f"({usage['legacy'] / usage['binary']:.1f}x smaller)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--redis-url', default='', help='also measure MEMORY USAGE on a real Redis')
+    main(parser.parse_args())
@@ -0,0 +1,139 @@
+"""
+Compare per-symbol price history writes with the pipelined store_tick path.
+
+Runs against fakeredis by default, or a real server with --redis-url:
+
+    python benchmarks/bench_price_history.py --ticks 200
+    python benchmarks/bench_price_history.py --redis-url redis://127.0.0.1:6379/15
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'websocket_project.settings')
+
+import django
+
+django.setup()
+
+import logging
+
+logging.getLogger('markets').setLevel(logging.WARNING)
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from markets import models
+from markets.models import PriceHistory
+
+
+class RoundTripCounter:
+    """Counts client round trips: one per command, one per pipeline execute"""
+
+    def __init__(self, client):
+        self.count = 0
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        async def counted_execute_command(*args, **kwargs):
+            self.count += 1
+            return await execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def counted_execute(*a, **kw):
+                self.count += 1
+                return await execute(*a, **kw)
+
+            pipe.execute = counted_execute
+            return pipe
+
+        client.execute_command = counted_execute_command
+        client.pipeline = counted_pipeline
+
+
+def make_snapshot(tick: int, moving: int) -> list:
+    """75 supported pairs where the first `moving` symbols changed this tick"""
+    now = int(time.time())
+    return [
+        {
+            "symbol": f"{asset}_CAD",
+            "bid": str(100.0 + (tick if i < moving else 0)),
+            "ask": str(101.0 + (tick if i < moving else 0)),
+            "change": "0.5",
+            "timestamp": now + tick,
+        }
+        for i, asset in enumerate(settings.SUPPORTED_ASSETS)
+    ]
+
+
+async def legacy_store(client, items: list):
+    """The original per-symbol ZADD / ZREMRANGEBYSCORE / ZCARD sequence"""
+    month_ago = int(time.time()) - (30 * 24 * 60 * 60)
+    for item in items:
+        key = f"price_history:{item['symbol']}"
+        await client.zadd(key, {str(item): item['timestamp']})
+        await client.zremrangebyscore(key, '-inf', month_ago)
+        await client.zcard(key)
+
+
+async def run(label: str, client, write, ticks: int, moving: int) -> dict:
+    await client.flushdb()
+    counter = RoundTripCounter(client)
+    latencies = []
+    for tick in range(ticks):
+        items = make_snapshot(tick, moving)
+        start = time.perf_counter()
+        await write(items)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "label": label,
+        "round_trips_per_tick": counter.count / ticks,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def make_client(redis_url: str):
+    if redis_url:
+        return aioredis.Redis.from_url(redis_url, decode_responses=True)
+    import fakeredis.aioredis
+    return fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+
+async def main(args):
+    results = []
+
+    client = make_client(args.redis_url)
+    results.append(await run(
+        "per-symbol store_price (legacy)", client,
+        lambda items: legacy_store(client, items), args.ticks, args.moving
+    ))
+
+    client = make_client(args.redis_url)
+    models.get_redis_client = lambda: client
+    history = PriceHistory()
+    results.append(await run(
+        "pipelined store_tick", client, history.store_tick, args.ticks, args.moving
+    ))
+
+    backend = args.redis_url or "fakeredis"
+    print(f"{args.ticks} ticks x {len(settings.SUPPORTED_ASSETS)} symbols, {args.moving} moving per tick, backend={backend}")
+    for r in results:
+        print(f"{r['label']:<34} round trips/tick={r['round_trips_per_tick']:>7.2f} "
+              f"p50={r['p50_ms']:.3f}ms p99={r['p99_ms']:.3f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--moving', type=int, default=20, help='symbols whose quote changes each tick')
+    parser.add_argument('--redis-url', default='', help='benchmark a real Redis instead of fakeredis')
+    asyncio.run(main(parser.parse_args()))
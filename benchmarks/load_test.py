@@ -0,0 +1,291 @@
+"""
+End-to-end load test: a local Newton stand-in, the ASGI app and N WebSocket subscribers.
+
+The stand-in serves a fresh snapshot on every request and stamps it with a tick
+number, so subscribers can time each tick from the moment Newton served it to
+the moment their frame arrived. Runs against fakeredis by default, or a real
+server with --redis-url. Clients run in the same process as the app, so CPU
+per tick includes their share of the work. Every run is appended to a JSON-lines file together
+with the commit it ran on; --compare prints the change against the previous
+run with the same parameters:
+
+    python benchmarks/load_test.py --clients 10 100 1000 --duration 10
+    python benchmarks/load_test.py --clients 500 --mode delta --format msgpack --compare
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'websocket_project.settings')
+os.environ.setdefault('MARKETS_LOG_LEVEL', 'WARNING')
+os.environ.setdefault('MARKETS_LOG_BACKGROUND', '0')
+
+import django
+
+django.setup()
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from markets import consumers, leader, models, resources
+from markets import producer as producer_module
+from markets.frames import msgpack
+from markets.producer import MarketDataProducer
+from markets.upstream import close_http_session
+from websocket_project.asgi import application
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'load_test.jsonl')
+
+# Parameters that must match for two runs to be compared
+RUN_KEYS = ('clients', 'mode', 'format', 'interval')
+
+
+class MockNewton:
+    """Local aiohttp server returning a moved quote for every supported pair on each request"""
+
+    def __init__(self):
+        self.tick = 0
+        self.served = {}
+        self.prices = {f"{asset}_CAD": 100.0 + i for i, asset in enumerate(settings.SUPPORTED_ASSETS)}
+        app = web.Application()
+        app.router.add_get("/rates", self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        self.tick += 1
+        now = int(time.time())
+        body = []
+        for symbol, price in self.prices.items():
+            price *= 1 + random.uniform(-0.001, 0.001)
+            self.prices[symbol] = price
+            # "change" carries the tick number so subscribers can tell which snapshot reached them
+            body.append({"symbol": symbol, "bid": f"{price:.6f}", "ask": f"{price * 1.001:.6f}",
+                         "change": str(self.tick), "timestamp": now})
+        self.served[self.tick] = time.perf_counter()
+        return web.Response(text=json.dumps(body), content_type="application/json")
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.server.close()
+
+    @property
+    def url(self):
+        return str(self.server.make_url("/rates"))
+
+
+def decode(output: dict, wire_format: str) -> dict:
+    if wire_format == "json":
+        return json.loads(output["text"])
+    data = output["bytes"]
+    if wire_format == "deflate":
+        return json.loads(zlib.decompress(data))
+    return msgpack.unpackb(data)
+
+
+class Subscriber:
+    """One simulated client; sampled ones decode every frame to time it, the rest only count"""
+
+    def __init__(self, mode: str, wire_format: str, sampled: bool):
+        self.mode = mode
+        self.format = wire_format
+        self.sampled = sampled
+        self.frames = 0
+        self.latencies = []
+        self.first_frame = asyncio.get_running_loop().create_future()
+        subprotocols = None if wire_format == "json" else [f"rates.{wire_format}"]
+        self.communicator = WebsocketCommunicator(application, "/markets/ws/", subprotocols=subprotocols)
+        self._task = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        assert connected, "connection refused"
+
+    async def subscribe(self):
+        await self.communicator.send_json_to({"event": "subscribe", "channel": "rates", "mode": self.mode})
+
+    def start(self, served: dict):
+        self._task = asyncio.create_task(self.receive(served))
+
+    async def receive(self, served: dict):
+        while True:
+            output = await self.communicator.output_queue.get()
+            if output["type"] != "websocket.send":
+                return
+            received = time.perf_counter()
+            self.frames += 1
+            if not self.first_frame.done():
+                self.first_frame.set_result(received)
+            if self.sampled:
+                quotes = decode(output, self.format)["data"]
+                if quotes:
+                    tick = int(float(next(iter(quotes.values()))["change"]))
+                    self.latencies.append(received - served[tick])
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.communicator.disconnect()
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(args, clients: int) -> dict:
+    producer = MarketDataProducer()
+    consumers.market_data_producer = producer_module.market_data_producer = producer
+
+    async with MockNewton() as newton:
+        settings.NEWTON_API_URL = newton.url
+        subscribers = [Subscriber(args.mode, args.format, i < args.sample) for i in range(clients)]
+
+        # Nobody is subscribed yet, so no ticks allocate while connections are measured
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        for subscriber in subscribers:
+            await subscriber.connect()
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # The startup window rebuild reads the whole history, keep it out of the measurement
+        producer.ensure_service()
+        await producer.market_service.start_window_rebuild()
+        for subscriber in subscribers:
+            await subscriber.subscribe()
+        for subscriber in subscribers:
+            subscriber.start(newton.served)
+        await asyncio.wait_for(asyncio.gather(*(s.first_frame for s in subscribers)), timeout=args.duration + 30)
+
+        # Measure from here on, once every client is receiving
+        for subscriber in subscribers:
+            subscriber.frames = 0
+            subscriber.latencies.clear()
+        ticks = producer.tick_count
+        cpu, wall = time.process_time(), time.perf_counter()
+        await asyncio.sleep(args.duration)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        ticks = producer.tick_count - ticks
+
+        await asyncio.gather(*(subscriber.close() for subscriber in subscribers))
+        await producer.close()
+        await close_http_session()
+
+    latencies = [latency for subscriber in subscribers for latency in subscriber.latencies]
+    frames = sum(subscriber.frames for subscriber in subscribers)
+    return {
+        "clients": clients,
+        "ticks_per_sec": ticks / wall,
+        "frames_per_sec": frames / wall,
+        "delivered_ratio": frames / (ticks * clients) if ticks else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "kb_per_connection": (after - before) / clients / 1024,
+        "cpu_ms_per_tick": cpu / ticks * 1000 if ticks else float('nan'),
+    }
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{revision}-dirty" if dirty else revision
+
+
+def load_runs(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(current: dict, runs: list):
+    previous = next((run for run in reversed(runs) if all(run.get(key) == current[key] for key in RUN_KEYS)), None)
+    if previous is None:
+        print("  no earlier run with the same parameters to compare with")
+        return
+    print(f"  vs {previous['commit']} ({previous['date']}):")
+    for metric in ("ticks_per_sec", "frames_per_sec", "p50_ms", "p99_ms", "kb_per_connection", "cpu_ms_per_tick"):
+        old, new = previous[metric], current[metric]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"    {metric:<18} {old:>10.3f} -> {new:>10.3f} {change:>8}")
+
+
+def use_redis(redis_url: str):
+    if redis_url:
+        import redis.asyncio as aioredis
+        client = aioredis.Redis.from_url(redis_url)
+    else:
+        import fakeredis.aioredis
+        client = fakeredis.aioredis.FakeRedis()
+    models.get_redis_client = lambda: client
+    leader.get_redis_client = lambda: client
+    resources.get_redis_client = lambda: client
+    return client
+
+
+async def main(args):
+    settings.MARKET_DATA_POLL_INTERVAL = args.interval
+    settings.MARKET_DATA_MAX_POLL_INTERVAL = args.interval
+    client = use_redis(args.redis_url)
+    runs = load_runs(args.output)
+    commit = git_revision()
+    backend = args.redis_url or "fakeredis"
+
+    print(f"{len(settings.SUPPORTED_ASSETS)} symbols, {args.mode} mode, {args.format}, "
+          f"{args.interval}s poll interval, {args.duration}s per row, backend={backend}, commit={commit}")
+    print(f"{'clients':>8} {'ticks/s':>8} {'frames/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'KB/conn':>8} {'CPU ms/tick':>12}")
+    for clients in args.clients:
+        await client.flushdb()
+        result = await run(args, clients)
+        print(f"{clients:>8} {result['ticks_per_sec']:>8.1f} {result['frames_per_sec']:>10.0f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['kb_per_connection']:>8.1f} "
+              f"{result['cpu_ms_per_tick']:>12.2f}")
+        record = {
+            "commit": commit,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "mode": args.mode,
+            "format": args.format,
+            "interval": args.interval,
+            "duration": args.duration,
+            "backend": "redis" if args.redis_url else "fakeredis",
+            **result,
+        }
+        if args.compare:
+            compare(record, runs)
+        if args.output:
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            with open(args.output, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        runs.append(record)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds per row')
+    parser.add_argument('--interval', type=float, default=0.1, help='upstream poll interval in seconds')
+    parser.add_argument('--mode', choices=consumers.SUBSCRIPTION_MODES, default='full')
+    parser.add_argument('--format', choices=sorted(consumers.SUBPROTOCOLS.values()), default='json')
+    parser.add_argument('--sample', type=int, default=100, help='clients that decode every frame to time it')
+    parser.add_argument('--redis-url', default='', help='load test against a real Redis instead of fakeredis')
+    parser.add_argument('--output', default=RESULTS, help='JSON-lines file runs are appended to, empty to skip')
+    parser.add_argument('--compare', action='store_true', help='compare with the previous run of the same parameters')
+    asyncio.run(main(parser.parse_args()))
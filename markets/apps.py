@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class MarketsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'markets'
+    log_listener = None
+
+    def ready(self):
+        if settings.LOG_BACKGROUND and MarketsConfig.log_listener is None:
+            from .log import start_background_logging
+            MarketsConfig.log_listener = start_background_logging(["markets", "redis"])
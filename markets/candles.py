@@ -0,0 +1,117 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+CANDLE_INTERVALS = {"1m": 60, "5m": 5 * 60, "1h": 60 * 60, "1d": 24 * 60 * 60}
+
+# How long closed bars are kept in Redis per interval, None keeps them forever
+CANDLE_RETENTION = {
+    "1m": 7 * 24 * 60 * 60,
+    "5m": 30 * 24 * 60 * 60,
+    "1h": 365 * 24 * 60 * 60,
+    "1d": None,
+}
+
+
+class Candle:
+    """One OHLCV bar; volume counts quote updates since Newton rates carry no traded volume"""
+
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, start: int, price: float):
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = 1
+
+    def update(self, price: float):
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "start": self.start, "open": self.open, "high": self.high,
+            "low": self.low, "close": self.close, "volume": self.volume
+        }
+
+
+class CandleAggregator:
+    """Rolling OHLCV bars for every symbol and interval, updated in O(1) per tick
+
+    Bars close when a tick lands in a later period or, for symbols that went
+    quiet, when the tick clock passes the end of the period; the sweep for
+    that runs once per period, not once per tick. Ticks for a period that
+    already closed are ignored. The tick clock is upstream's: the newest quote
+    timestamp, run forward by the wall time since it arrived, so quiet
+    stretches close bars without mixing in the server's clock.
+    """
+
+    def __init__(self, intervals: dict = None):
+        self.intervals = intervals or CANDLE_INTERVALS
+        self.bars = {name: {} for name in self.intervals}
+        self._swept = {name: 0 for name in self.intervals}
+        # Newest quote timestamp and the wall time it arrived at
+        self._clock = None
+
+    def update(self, symbol: str, timestamp: float, price: float) -> list:
+        """Fold one price in, returns (interval, symbol, Candle) for every bar it closed"""
+        closed = []
+        timestamp = int(timestamp)
+        for name, seconds in self.intervals.items():
+            start = timestamp - timestamp % seconds
+            if start < self._swept[name]:
+                continue
+            bars = self.bars[name]
+            candle = bars.get(symbol)
+            if candle is None:
+                bars[symbol] = Candle(start, price)
+            elif start == candle.start:
+                candle.update(price)
+            elif start > candle.start:
+                closed.append((name, symbol, candle))
+                bars[symbol] = Candle(start, price)
+        return closed
+
+    def close_due(self, now: float) -> list:
+        """Close every bar whose period ended before `now`"""
+        closed = []
+        now = int(now)
+        for name, seconds in self.intervals.items():
+            current = now - now % seconds
+            if current <= self._swept[name]:
+                continue
+            self._swept[name] = current
+            bars = self.bars[name]
+            for symbol in [symbol for symbol, candle in bars.items() if candle.start < current]:
+                closed.append((name, symbol, bars.pop(symbol)))
+        return closed
+
+    def clock(self) -> float:
+        """Upstream time as of now, None before the first quote"""
+        if self._clock is None:
+            return None
+        timestamp, arrived = self._clock
+        return timestamp + time.time() - arrived
+
+    def update_tick(self, quotes: dict, now: float = None) -> list:
+        """Close the bars due by `now`, by default the tick clock, then fold in each quote's spot price"""
+        newest = max((quote['timestamp'] for quote in quotes.values()), default=None)
+        if newest is not None and (self._clock is None or newest >= self._clock[0]):
+            self._clock = (newest, time.time())
+        if now is None:
+            now = self.clock()
+        closed = self.close_due(now) if now is not None else []
+        for symbol, quote in quotes.items():
+            closed.extend(self.update(symbol, quote['timestamp'], quote['spot']))
+        return closed
+
+    def live(self, interval: str, symbols=None) -> dict:
+        """Open bars of one interval, optionally limited to some symbols"""
+        bars = self.bars[interval]
+        if symbols is None:
+            return {symbol: candle.as_dict() for symbol, candle in bars.items()}
+        return {symbol: bars[symbol].as_dict() for symbol in symbols if symbol in bars}
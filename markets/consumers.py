@@ -1,79 +1,449 @@
-import json
 import asyncio
+import json
+import time
+import redis
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .services import MarketDataService
+from django.conf import settings
+from .producer import market_data_producer, INDICATORS_GROUP
+from .outbox import Outbox
+from .frames import WIRE_FORMATS
+from .candles import CANDLE_INTERVALS
+from .subscriptions import SUPPORTED_PAIRS
+from .history import parse_history_params, query_history
+from .metrics import connected_clients
+from .heartbeat import Heartbeat
 import logging
 from uuid import uuid4
-import time
 
 logger = logging.getLogger(__name__)
 
+# "full" resends every pair each tick, "delta" sends one snapshot then only moved pairs
+SUBSCRIPTION_MODES = ("full", "delta")
+
+# Sent when a client falls more than CLIENT_MAX_LAG_SECONDS behind ("try again later")
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+# Sent to clients that stayed silent for longer than CLIENT_IDLE_TIMEOUT ("going away")
+IDLE_CLOSE_CODE = 1001
+
+# Offering one of these Sec-WebSocket-Protocol values picks the wire format at connect time
+SUBPROTOCOLS = {f"rates.{wire_format}": wire_format for wire_format in WIRE_FORMATS}
+
+heartbeat = Heartbeat(settings.CLIENT_HEARTBEAT_INTERVAL)
+
 class MarketConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.client_id = str(uuid4())
-        logger.info(f"New client connecting: {self.client_id}")
-        
+        logger.info("New client connecting: %s", self.client_id)
+
+        self.group = None
+        self.registered = None
+        self.symbols = set()
+        self.intervals = set()
+        self.indicators = False
+        self.mode = "full"
+        self.throttle = None
+        subprotocol = next((p for p in self.scope.get("subprotocols", []) if p in SUBPROTOCOLS), None)
+        self.format = SUBPROTOCOLS.get(subprotocol, "json")
+        self.awaiting_snapshot = False
+        self.last_received = time.monotonic()
+        self.requests = set()
+        self._closing = None
+        self.outbox = Outbox(
+            self.send_frame,
+            name=self.client_id,
+            resync=self.resync_frames,
+            on_slow=self.close_slow_client,
+            max_size=settings.CLIENT_SEND_QUEUE_SIZE,
+            max_lag=settings.CLIENT_MAX_LAG_SECONDS
+        )
         try:
-            self.market_service = MarketDataService()
-            await self.accept()
-            logger.info(f"Client {self.client_id} connected successfully")
+            await self.accept(subprotocol=subprotocol)
+            connected_clients.inc()
+            heartbeat.add(self)
+            logger.info("Client %s connected successfully using %s", self.client_id, self.format)
         except Exception as e:
-            logger.error(f"Error during client {self.client_id} connection: {str(e)}")
+            logger.error("Error during client %s connection: %s", self.client_id, e)
             raise
 
     async def disconnect(self, close_code):
-        logger.info(f"Client {self.client_id} disconnecting with code: {close_code}")
+        logger.info("Client %s disconnecting with code: %s", self.client_id, close_code)
+        connected_clients.dec()
+        heartbeat.discard(self)
         try:
-            await self.market_service.close()
-            logger.info(f"Client {self.client_id} disconnected cleanly")
+            await self.cancel_requests()
+            await self.leave_rates()
+            await self.leave_candles()
+            await self.leave_indicators()
+            await self.outbox.close()
+            logger.info("Client %s disconnected cleanly: %s", self.client_id, self.outbox.stats())
         except Exception as e:
-            logger.error(f"Error during client {self.client_id} disconnect: {str(e)}")
+            logger.error("Error during client %s disconnect: %s", self.client_id, e)
 
     async def receive(self, text_data):
         try:
-            logger.debug(f"Received message from client {self.client_id}: {text_data}")
+            logger.debug("Received message from client %s: %s", self.client_id, text_data, extra={"rate_key": self.client_id})
+            self.last_received = time.monotonic()
             message = json.loads(text_data)
-            
-            if message.get("event") == "subscribe" and message.get("channel") == "rates":
-                logger.info(f"Client {self.client_id} subscribing to rates channel")
-                await self.handle_market_data_subscription()
+            event = message.get("event")
+
+            if event == "ping":
+                await self.send(text_data=json.dumps({"event": "pong", "id": message.get("id"), "ts": time.time()}))
+            elif event == "subscribe" and message.get("channel") == "rates":
+                await self.handle_subscribe(message)
+            elif event == "unsubscribe" and message.get("channel") == "rates":
+                await self.handle_unsubscribe(message)
+            elif event == "history":
+                # Queries wait on Redis, so they run beside this handler instead of holding up later messages
+                await self.start_request(self.handle_history(message), message.get("id"))
+            elif event == "subscribe" and message.get("channel") == "candles":
+                await self.handle_candle_subscribe(message)
+            elif event == "unsubscribe" and message.get("channel") == "candles":
+                await self.handle_candle_unsubscribe(message)
+            elif event == "subscribe" and message.get("channel") == "indicators":
+                await self.handle_indicator_subscribe()
+            elif event == "unsubscribe" and message.get("channel") == "indicators":
+                await self.leave_indicators()
+                await self.send(text_data=json.dumps({"event": "unsubscribed", "channel": "indicators"}))
             else:
-                logger.warning(f"Client {self.client_id} sent invalid message: {message}")
-                await self.send(text_data=json.dumps({
-                    "event": "error",
-                    "message": "Invalid message format"
-                }))
-                
+                logger.warning("Client %s sent invalid message: %s", self.client_id, message, extra={"rate_key": self.client_id})
+                await self.send_error("Invalid message format")
+
         except json.JSONDecodeError:
-            logger.error(f"Client {self.client_id} sent invalid JSON: {text_data}")
-            await self.send(text_data=json.dumps({
-                "event": "error",
-                "message": "Invalid JSON format"
-            }))
+            logger.warning("Client %s sent invalid JSON: %s", self.client_id, text_data, extra={"rate_key": self.client_id})
+            await self.send_error("Invalid JSON format")
+        except Exception as e:
+            logger.exception("Error processing message from client %s: %s", self.client_id, e)
+            await self.send_error("Internal server error")
+
+    async def send_error(self, message: str):
+        await self.send(text_data=json.dumps({
+            "event": "error",
+            "message": message
+        }))
+
+    async def start_request(self, coroutine, request_id=None):
+        """Run a slow request in the background, at most CLIENT_MAX_PENDING_REQUESTS at a time"""
+        if len(self.requests) >= settings.CLIENT_MAX_PENDING_REQUESTS:
+            coroutine.close()
+            await self.send(text_data=json.dumps({"event": "error", "message": "Too many pending requests", "id": request_id}))
+            return
+        task = asyncio.create_task(coroutine)
+        self.requests.add(task)
+        task.add_done_callback(self.requests.discard)
+
+    async def cancel_requests(self):
+        tasks = list(self.requests)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def beat(self, now: float, frame: str):
+        """Called by the process-wide heartbeat: keep a quiet connection alive, close a silent client"""
+        timeout = settings.CLIENT_IDLE_TIMEOUT
+        if timeout and now - self.last_received > timeout:
+            heartbeat.discard(self)
+            self._closing = asyncio.create_task(self.close_idle_client(now - self.last_received))
+        elif not len(self.outbox) and now - self.outbox.last_sent >= heartbeat.interval:
+            self.outbox.put(None, frame)
+
+    async def close_idle_client(self, idle: float):
+        logger.info("Closing client %s after %.0fs without messages", self.client_id, idle)
+        await self.close(code=IDLE_CLOSE_CODE)
+
+    def parse_symbols(self, message: dict):
+        """Validated symbol list from a message, None when absent, raises ValueError when invalid"""
+        symbols = message.get("symbols")
+        if symbols is None:
+            return None
+        if not isinstance(symbols, list) or not symbols or not all(isinstance(s, str) for s in symbols):
+            raise ValueError("Invalid symbols list")
+        unsupported = sorted(set(symbols) - SUPPORTED_PAIRS)
+        if unsupported:
+            raise ValueError(f"Unsupported symbols: {', '.join(unsupported)}")
+        return set(symbols)
+
+    async def handle_subscribe(self, message: dict):
+        mode = message.get("mode", "full")
+        if mode not in SUBSCRIPTION_MODES:
+            logger.warning("Client %s requested invalid mode: %s", self.client_id, mode, extra={"rate_key": self.client_id})
+            await self.send_error("Invalid subscription mode")
+            return
+        wire_format = message.get("format", self.format)
+        if wire_format not in WIRE_FORMATS:
+            logger.warning("Client %s requested invalid format: %s", self.client_id, wire_format, extra={"rate_key": self.client_id})
+            await self.send_error("Invalid format")
+            return
+        throttle = message.get("throttle")
+        if throttle is not None and throttle not in settings.RATES_THROTTLES:
+            logger.warning("Client %s requested invalid throttle: %s", self.client_id, throttle, extra={"rate_key": self.client_id})
+            await self.send_error("Invalid throttle")
+            return
+        try:
+            symbols = self.parse_symbols(message)
+        except ValueError as e:
+            logger.warning("Client %s sent invalid symbols: %s", self.client_id, message.get('symbols'), extra={"rate_key": self.client_id})
+            await self.send_error(str(e))
+            return
+        if symbols and throttle:
+            await self.send_error("Throttles apply to the whole rates channel, not to symbols")
+            return
+
+        self.format = wire_format
+        if symbols:
+            logger.info("Client %s subscribing to %s rates symbols", self.client_id, len(symbols))
+            await self.handle_symbol_subscription(symbols)
+        else:
+            logger.info("Client %s subscribing to rates channel in %s mode", self.client_id, mode)
+            await self.handle_market_data_subscription(mode, throttle)
+
+    async def handle_unsubscribe(self, message: dict):
+        try:
+            symbols = self.parse_symbols(message)
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        if symbols and self.group:
+            # The whole-stream subscription cannot drop single pairs, and silently keeping them would look like it did
+            logger.warning("Client %s unsubscribed symbols from the full stream", self.client_id, extra={"rate_key": self.client_id})
+            await self.send_error("Subscribed to all symbols, subscribe to the ones to keep instead")
+            return
+        if symbols and self.symbols:
+            self.symbols = market_data_producer.index.unsubscribe(self.channel_name, symbols)
+            logger.info("Client %s unsubscribed from %s symbols, %s left", self.client_id, len(symbols), len(self.symbols))
+            if not self.symbols:
+                await self.unregister()
+        elif symbols is None:
+            logger.info("Client %s unsubscribing from rates channel", self.client_id)
+            await self.leave_rates()
+
+        await self.send(text_data=json.dumps({
+            "event": "unsubscribed",
+            "channel": "rates",
+            "symbols": sorted(self.symbols)
+        }))
+
+    async def handle_history(self, message: dict):
+        """Answer a price history query, echoing the client's request id"""
+        request_id = message.get("id")
+        try:
+            result = await query_history(parse_history_params(message))
+        except ValueError as e:
+            await self.send(text_data=json.dumps({"event": "error", "message": str(e), "id": request_id}))
+            return
+        except redis.RedisError:
+            await self.send(text_data=json.dumps({"event": "error", "message": "History temporarily unavailable", "id": request_id}))
+            return
         except Exception as e:
-            logger.exception(f"Error processing message from client {self.client_id}: {str(e)}")
-            await self.send(text_data=json.dumps({
-                "event": "error",
-                "message": "Internal server error"
-            }))
-
-    async def handle_market_data_subscription(self):
-        logger.info(f"Starting market data updates for client {self.client_id}")
-        update_count = 0
-        
-        while True:
-            cycle_start = time.time()
-            try:
-                response = await self.market_service.get_market_data()
-                if response:
-                    await self.send(text_data=json.dumps(response))
-                    update_count += 1
-                    logger.debug(
-                        f"Sent update #{update_count} to client {self.client_id} "
-                        f"in {time.time() - cycle_start:.3f}s"
-                    )
-                else:
-                    logger.warning(f"No data available for client {self.client_id}")
-            except Exception as e:
-                logger.error(f"Error sending update to client {self.client_id}: {str(e)}")
-            await asyncio.sleep(1)
\ No newline at end of file
+            logger.exception("Error answering history request from client %s: %s", self.client_id, e)
+            await self.send(text_data=json.dumps({"event": "error", "message": "Internal server error", "id": request_id}))
+            return
+        await self.send(text_data=json.dumps({"event": "history", "id": request_id, **result}))
+
+    def parse_intervals(self, message: dict):
+        """Validated candle intervals from a message, None when absent, raises ValueError when invalid"""
+        intervals = message.get("intervals")
+        if intervals is None:
+            return None
+        if not isinstance(intervals, list) or not intervals or not all(i in CANDLE_INTERVALS for i in intervals):
+            raise ValueError("Invalid intervals")
+        return set(intervals)
+
+    async def handle_candle_subscribe(self, message: dict):
+        try:
+            intervals = self.parse_intervals(message) or set(CANDLE_INTERVALS)
+        except ValueError as e:
+            logger.warning("Client %s sent invalid intervals: %s", self.client_id, message.get('intervals'), extra={"rate_key": self.client_id})
+            await self.send_error(str(e))
+            return
+
+        added = intervals - self.intervals
+        logger.info("Client %s subscribing to %s candle intervals", self.client_id, len(added))
+        for interval in added:
+            await self.channel_layer.group_add(market_data_producer.candle_group(interval), self.channel_name)
+        self.intervals |= added
+        if added:
+            self.outbox.put(None, market_data_producer.candles_frame(added).encode(self.format))
+        await self.register()
+
+    async def handle_candle_unsubscribe(self, message: dict):
+        try:
+            intervals = self.parse_intervals(message)
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+
+        removed = self.intervals if intervals is None else self.intervals & intervals
+        await self.leave_candles(removed)
+        await self.send(text_data=json.dumps({
+            "event": "unsubscribed",
+            "channel": "candles",
+            "intervals": sorted(self.intervals)
+        }))
+
+    async def leave_candles(self, intervals=None):
+        """Drop some (or all) candle intervals this client follows"""
+        for interval in list(self.intervals if intervals is None else intervals):
+            await self.channel_layer.group_discard(market_data_producer.candle_group(interval), self.channel_name)
+            self.intervals.discard(interval)
+        await self.unregister()
+
+    async def handle_indicator_subscribe(self):
+        if self.indicators:
+            logger.info("Client %s is already subscribed to indicators channel", self.client_id)
+            return
+        logger.info("Client %s subscribing to indicators", self.client_id)
+        await self.channel_layer.group_add(INDICATORS_GROUP, self.channel_name)
+        self.indicators = True
+        self.outbox.put(None, market_data_producer.indicators_frame().encode(self.format))
+        await self.register()
+
+    async def leave_indicators(self):
+        if self.indicators:
+            await self.channel_layer.group_discard(INDICATORS_GROUP, self.channel_name)
+            self.indicators = False
+        await self.unregister()
+
+    async def handle_market_data_subscription(self, mode: str = "full", throttle: str = None):
+        if self.symbols:
+            market_data_producer.index.unsubscribe(self.channel_name)
+            self.symbols = set()
+
+        self.mode = mode
+        # The last known state goes out right away instead of after the next upstream fetch
+        await self.send_snapshot()
+
+        group = market_data_producer.format_group(self.format, throttle)
+        self.throttle = throttle
+        if self.group == group:
+            logger.info("Client %s is already subscribed to rates channel", self.client_id)
+            return
+
+        logger.info("Starting market data updates for client %s", self.client_id)
+        await self.channel_layer.group_add(group, self.channel_name)
+        if self.group:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+        self.group = group
+        await self.register()
+
+    async def handle_symbol_subscription(self, symbols: set):
+        if self.group:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+            self.group = None
+            self.throttle = None
+
+        market_data_producer.wire_formats[self.channel_name] = self.format
+        added = market_data_producer.index.subscribe(self.channel_name, symbols)
+        watching = bool(self.symbols)
+        self.symbols |= added
+        # Symbol streams are always snapshot + moved symbols
+        frame = market_data_producer.symbols_frame(added)
+        if frame is not None and watching:
+            # Deltas still queued for the symbols already watched must not be lost, and the
+            # added symbols' snapshot carries no seq so it is never filtered against them
+            self.outbox.put(None, frame.encode(self.format))
+        elif frame is not None:
+            self.outbox.put_snapshot(frame.payload["seq"], frame.encode(self.format))
+        await self.register()
+
+    async def leave_rates(self):
+        """Drop every rates subscription this client holds"""
+        if self.group:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+            self.group = None
+            self.throttle = None
+        if self.symbols:
+            market_data_producer.index.unsubscribe(self.channel_name)
+            self.symbols = set()
+        market_data_producer.wire_formats.pop(self.channel_name, None)
+        await self.unregister()
+
+    async def register(self):
+        """Count this client with the producer under its current wire format and throttle"""
+        registration = (self.format, self.throttle if self.group else None)
+        if self.registered == registration:
+            return
+        previous, self.registered = self.registered, registration
+        # Add before removing so a format switch never lets the producer stop
+        await market_data_producer.add_subscriber(*registration)
+        if previous:
+            await market_data_producer.remove_subscriber(*previous)
+
+    async def unregister(self):
+        """Stop counting this client once it holds no subscriptions"""
+        if not self.registered:
+            return
+        if self.group or self.symbols or self.intervals or self.indicators:
+            # Still subscribed to something, but maybe no longer throttled
+            await self.register()
+            return
+        previous, self.registered = self.registered, None
+        await market_data_producer.remove_subscriber(*previous)
+
+    async def send_snapshot(self):
+        """Queue the last known full state, or for a delta stream wait for the first tick"""
+        frame = market_data_producer.snapshot_frame("snapshot" if self.mode == "delta" else "data")
+        self.awaiting_snapshot = frame is None and self.mode == "delta"
+        if frame is not None:
+            self.outbox.put_snapshot(frame.payload["seq"], frame.encode(self.format))
+
+    def resync_frames(self) -> list:
+        """Newest state of every stream this client follows, used when its outbox had to conflate"""
+        frames = []
+        if self.symbols:
+            frame = market_data_producer.symbols_frame(self.symbols)
+        elif self.group:
+            frame = market_data_producer.snapshot_frame()
+        else:
+            frame = None
+        if frame is not None:
+            frames.append((frame.payload["seq"], frame.encode(self.format)))
+        if self.intervals:
+            # Open bars only; closed ones can be backfilled from history
+            frames.append((None, market_data_producer.candles_frame(self.intervals).encode(self.format)))
+        if self.indicators:
+            frames.append((None, market_data_producer.indicators_frame().encode(self.format)))
+        return frames
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def close_slow_client(self):
+        logger.warning("Closing slow client %s: %s", self.client_id, self.outbox.stats())
+        await self.close(code=SLOW_CLIENT_CLOSE_CODE)
+
+    async def rates_update(self, event):
+        # Messages already in flight when the client switched format are dropped
+        if not self.group or event["format"] != self.format or event.get("throttle") != self.throttle:
+            return
+        if self.mode == "delta":
+            if self.awaiting_snapshot:
+                await self.send_snapshot()
+            elif event["delta"] is not None:
+                self.outbox.put(event["seq"], event["delta"])
+        else:
+            # The frame was encoded once per format by the producer, every subscriber gets the same object.
+            # Full frames repeat unchanged ticks, so they carry no seq to filter on
+            self.outbox.put_latest(None, event["frame"], stream=self.group)
+
+    async def candles_update(self, event):
+        frame = event["frames"].get(self.format)
+        if not self.intervals or frame is None:
+            return
+        self.outbox.put(None, frame)
+
+    async def indicators_update(self, event):
+        frame = event["frames"].get(self.format)
+        if not self.indicators or frame is None:
+            return
+        self.outbox.put(None, frame)
+
+    async def rates_symbols(self, event):
+        # Messages already in flight when the client switched subscriptions are dropped
+        if not self.symbols:
+            return
+        self.outbox.put(event["seq"], event["frame"])
@@ -0,0 +1,119 @@
+import ast
+import struct
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sorted-set members are fixed-layout records; the symbol lives in the key, the
+# timestamp doubles as the score and keeps members unique when a quote repeats.
+# v1: version (uint8), timestamp (uint32 seconds), bid, ask (float64), change (float32)
+# v2: as v1 with change as float64, which float32 rounded visibly
+PRICE_FORMAT_VERSION = 2
+PRICE_RECORD_V1 = struct.Struct('<BIddf')
+PRICE_RECORD_V2 = struct.Struct('<BIddd')
+PRICE_RECORDS = {1: PRICE_RECORD_V1, 2: PRICE_RECORD_V2}
+
+
+def encode_price(item: dict) -> bytes:
+    """Pack one upstream quote into a v2 record"""
+    return PRICE_RECORD_V2.pack(
+        PRICE_FORMAT_VERSION,
+        int(item['timestamp']),
+        float(item['bid']),
+        float(item['ask']),
+        float(item['change'])
+    )
+
+
+def is_legacy(member: bytes) -> bool:
+    """Whether a member predates the binary format (a str(dict) repr)"""
+    return member[:1] == b'{'
+
+
+def _decode_legacy(member: bytes, symbol: str) -> dict:
+    data = ast.literal_eval(member.decode())
+    return {
+        "symbol": symbol,
+        "timestamp": int(data['timestamp']),
+        "bid": float(data['bid']),
+        "ask": float(data['ask']),
+        "change": float(data['change'])
+    }
+
+
+def decode_price(member: bytes, symbol: str) -> dict:
+    """Unpack one stored member, accepting v1 and v2 records and legacy reprs"""
+    if is_legacy(member):
+        return _decode_legacy(member, symbol)
+    record = PRICE_RECORDS.get(member[0])
+    if record is None or len(member) != record.size:
+        raise ValueError(f"Unknown price record format (version={member[0]}, size={len(member)})")
+    _, timestamp, bid, ask, change = record.unpack(member)
+    return {"symbol": symbol, "timestamp": timestamp, "bid": bid, "ask": ask, "change": change}
+
+
+def decode_prices(members: list, symbol: str) -> list:
+    """Bulk-decode members, unpacking batches of a single record version in one pass"""
+    for version, record in PRICE_RECORDS.items():
+        if all(len(m) == record.size and m[0] == version for m in members):
+            return [
+                {"symbol": symbol, "timestamp": timestamp, "bid": bid, "ask": ask, "change": change}
+                for _, timestamp, bid, ask, change in record.iter_unpack(b''.join(members))
+            ]
+    return [decode_price(member, symbol) for member in members]
+
+
+# Closed candles use the same scheme: the symbol and interval live in the key, the
+# bar start is the score. v1: version (uint8), start (uint32 seconds),
+# open, high, low, close (float64), volume (uint32)
+CANDLE_FORMAT_VERSION = 1
+CANDLE_RECORD_V1 = struct.Struct('<BIddddI')
+
+
+def encode_candle(bar: dict) -> bytes:
+    """Pack one closed bar into a v1 record"""
+    return CANDLE_RECORD_V1.pack(
+        CANDLE_FORMAT_VERSION, int(bar['start']), bar['open'], bar['high'], bar['low'], bar['close'], bar['volume']
+    )
+
+
+def decode_candles(members: list) -> list:
+    """Bulk-decode candle records"""
+    bars = []
+    for member in members:
+        if member[:1] != bytes([CANDLE_FORMAT_VERSION]) or len(member) != CANDLE_RECORD_V1.size:
+            raise ValueError(f"Unknown candle record format (size={len(member)})")
+        _, start, open_, high, low, close, volume = CANDLE_RECORD_V1.unpack(member)
+        bars.append({"start": start, "open": open_, "high": high, "low": low, "close": close, "volume": volume})
+    return bars
+
+
+# Recorded upstream snapshots are appended to a log of length-prefixed records.
+# v1: version (uint8), received_at (float64 unix seconds), body length (uint32),
+# then the raw response body, zlib-compressed
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_HEADER_V1 = struct.Struct('<BdI')
+
+
+def encode_snapshot(received_at: float, body: bytes) -> bytes:
+    """Pack one raw upstream body into a v1 log record"""
+    compressed = zlib.compress(body)
+    return SNAPSHOT_HEADER_V1.pack(SNAPSHOT_FORMAT_VERSION, received_at, len(compressed)) + compressed
+
+
+def read_snapshot_header(buffer, offset: int):
+    """(received_at, body offset, body end) of the record at `offset`, None at the end or a torn tail"""
+    end = offset + SNAPSHOT_HEADER_V1.size
+    if end > len(buffer):
+        return None
+    version, received_at, length = SNAPSHOT_HEADER_V1.unpack_from(buffer, offset)
+    if version != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unknown snapshot record format (version={version}) at offset {offset}")
+    if end + length > len(buffer):
+        return None
+    return received_at, end, end + length
+
+
+def decode_snapshot_body(buffer, start: int, end: int) -> bytes:
+    return zlib.decompress(buffer[start:end])
@@ -0,0 +1,96 @@
+import json
+import logging
+import zlib
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used when it is not installed
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, the msgpack wire format is not offered without it
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# "json" is sent as text frames, the others as binary frames. "deflate" is the
+# JSON frame zlib-compressed once per tick rather than once per connection
+WIRE_FORMATS = tuple(name for name in ("json", "msgpack", "deflate") if name != "msgpack" or msgpack is not None)
+DEFLATE_LEVEL = 6
+
+
+def json_dumps(payload) -> bytes:
+    """Compact JSON encoding, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def encode_fragment(symbol: str, quote: dict) -> bytes:
+    """Encode one `"symbol":{...}` member of a data object for later splicing"""
+    return json_dumps(symbol) + b':' + json_dumps(quote)
+
+
+def compose_frame(header: dict, fragments, data: dict = None) -> 'Frame':
+    """Splice pre-encoded symbol fragments into a message without re-encoding them
+
+    Passing the `data` the fragments were encoded from lets binary formats skip
+    decoding the JSON again.
+    """
+    head = json_dumps(header)[:-1]
+    separator = b',"data":{' if len(head) > 1 else b'"data":{'
+    payload = header if data is None else {**header, "data": data}
+    return Frame.from_bytes(head + separator + b','.join(fragments) + b'}}', payload)
+
+
+class Frame:
+    """A WebSocket message encoded once and shared by every subscriber of a tick"""
+
+    __slots__ = ('payload', '_bytes', '_text', '_encoded')
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self._bytes = None
+        self._text = None
+        self._encoded = None
+
+    @classmethod
+    def from_bytes(cls, data: bytes, payload: dict = None) -> 'Frame':
+        """Wrap an already encoded message"""
+        frame = cls(payload)
+        frame._bytes = data
+        return frame
+
+    @property
+    def bytes(self) -> bytes:
+        if self._bytes is None:
+            self._bytes = json_dumps(self.payload)
+        return self._bytes
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.bytes.decode()
+        return self._text
+
+    def encode(self, wire_format: str = "json"):
+        """This message in a wire format, str for json and bytes otherwise, encoded once per format"""
+        if wire_format == "json":
+            return self.text
+        if self._encoded is None:
+            self._encoded = {}
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            if wire_format == "msgpack" and msgpack is not None:
+                payload = self.payload if self.payload and "data" in self.payload else json.loads(self.bytes)
+                encoded = msgpack.packb(payload)
+            elif wire_format == "deflate":
+                encoded = zlib.compress(self.bytes, DEFLATE_LEVEL)
+            else:
+                raise ValueError(f"Unsupported wire format: {wire_format}")
+            self._encoded[wire_format] = encoded
+        return encoded
+
+    def __len__(self) -> int:
+        return len(self.bytes)
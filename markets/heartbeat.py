@@ -0,0 +1,50 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class Heartbeat:
+    """One process-wide timer that keeps idle connections alive, instead of a task per connection
+
+    Every `interval` seconds each registered consumer's beat() is called with
+    the current monotonic time and a heartbeat frame encoded once for all of
+    them. The timer stops when the last consumer leaves.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.consumers = weakref.WeakSet()
+        self._task = None
+
+    def is_running(self) -> bool:
+        if self._task is None or self._task.done():
+            return False
+        return self._task.get_loop() is asyncio.get_running_loop()
+
+    def add(self, consumer):
+        self.consumers.add(consumer)
+        if self.interval and not self.is_running():
+            self._task = asyncio.create_task(self.run())
+
+    def discard(self, consumer):
+        self.consumers.discard(consumer)
+
+    def frame(self) -> str:
+        return json.dumps({"event": "heartbeat", "ts": int(time.time())})
+
+    async def run(self):
+        while self._task is asyncio.current_task() and self.consumers:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            frame = self.frame()
+            for consumer in list(self.consumers):
+                try:
+                    consumer.beat(now, frame)
+                except Exception as e:
+                    logger.error("Error sending heartbeat: %s", e)
+        if self._task is asyncio.current_task():
+            self._task = None
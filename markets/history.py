@@ -0,0 +1,169 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from django.conf import settings
+from .models import PriceHistory
+from .subscriptions import SUPPORTED_PAIRS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 60 * 60
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 1000
+
+
+class HistoryCache:
+    """Bounded LRU of query results that expire `ttl` seconds after they were stored"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+history_cache = HistoryCache(settings.HISTORY_CACHE_TTL, settings.HISTORY_CACHE_SIZE)
+
+
+def _number(params: dict, name: str, default=None, minimum=None):
+    value = params.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value) if isinstance(value, str) and value.isdigit() else float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {name}")
+    if not math.isfinite(number):
+        raise ValueError(f"Invalid {name}")
+    if minimum is not None and number < minimum:
+        raise ValueError(f"Invalid {name}")
+    return number
+
+
+def parse_history_params(params: dict) -> dict:
+    """Validated range query from query-string or message fields, raises ValueError when invalid"""
+    symbol = params.get("symbol")
+    if symbol not in SUPPORTED_PAIRS:
+        raise ValueError(f"Unsupported symbol: {symbol}")
+    # An open-ended query ends at the next multiple of the cache TTL rather than this second,
+    # so repeated "latest" queries share a cache key until the cached page would expire anyway
+    step = max(1, int(settings.HISTORY_CACHE_TTL))
+    end = _number(params, "end", default=math.ceil(time.time() / step) * step, minimum=0)
+    start = _number(params, "start", default=end - DEFAULT_WINDOW, minimum=0)
+    if start > end:
+        raise ValueError("start must not be after end")
+    limit = _number(params, "limit", default=DEFAULT_LIMIT, minimum=1)
+    resolution = _number(params, "resolution", minimum=1)
+    cursor = params.get("cursor") or None
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError("Invalid cursor")
+    return {
+        "symbol": symbol,
+        "start": start,
+        "end": end,
+        "limit": min(int(limit), MAX_LIMIT),
+        "resolution": int(resolution) if resolution else None,
+        "cursor": cursor,
+    }
+
+
+def _point(price: dict) -> dict:
+    return {
+        "timestamp": price['timestamp'], "bid": price['bid'], "ask": price['ask'],
+        "spot": (price['bid'] + price['ask']) / 2, "change": price['change']
+    }
+
+
+async def _raw_page(price_history: PriceHistory, query: dict):
+    """One page of ticks; the cursor is "<score>:<entries at that score already returned>" """
+    if query["cursor"]:
+        try:
+            score, skip = query["cursor"].split(":")
+            score, skip = float(score), int(skip)
+        except ValueError:
+            raise ValueError("Invalid cursor")
+    else:
+        score, skip = query["start"], 0
+
+    limit = query["limit"]
+    prices = await price_history.get_price_page(query["symbol"], score, query["end"], skip, limit + 1)
+    page = prices[:limit]
+    next_cursor = None
+    if len(prices) > limit:
+        last = page[-1]['timestamp']
+        # Several entries can share a score, so remember how far into the last one we got
+        tail = sum(1 for price in page if price['timestamp'] == last)
+        next_cursor = f"{last}:{skip + tail if last == score else tail}"
+    return [_point(price) for price in page], next_cursor
+
+
+async def _downsampled_page(price_history: PriceHistory, query: dict):
+    """One page of `resolution`-second buckets holding each bucket's last tick; the cursor is the next bucket start"""
+    resolution, start, end = query["resolution"], query["start"], query["end"]
+    try:
+        bucket = int(query["cursor"]) if query["cursor"] else int(start) - int(start) % resolution
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+    buckets = []
+    starts = []
+    while bucket <= end and len(buckets) < query["limit"]:
+        upper = end if bucket + resolution > end else f"({bucket + resolution}"
+        buckets.append((max(bucket, start), upper))
+        starts.append(bucket)
+        bucket += resolution
+
+    prices = await price_history.get_last_prices(query["symbol"], buckets)
+    data = [
+        dict(_point(price), bucket=bucket_start)
+        for bucket_start, price in zip(starts, prices) if price is not None
+    ]
+    return data, str(bucket) if bucket <= end else None
+
+
+async def query_history(query: dict, price_history: PriceHistory = None) -> dict:
+    """Page of stored prices for a parsed query, served from the TTL cache when hot"""
+    key = tuple(sorted(query.items()))
+    result = history_cache.get(key)
+    if result is not None:
+        return result
+
+    start_time = time.time()
+    price_history = price_history or PriceHistory()
+    if query["resolution"]:
+        data, next_cursor = await _downsampled_page(price_history, query)
+    else:
+        data, next_cursor = await _raw_page(price_history, query)
+    result = {
+        "symbol": query["symbol"],
+        "start": query["start"],
+        "end": query["end"],
+        "resolution": query["resolution"],
+        "data": data,
+        "next_cursor": next_cursor,
+    }
+    history_cache.set(key, result)
+    logger.debug("History query for %s returned %s points in %.3fs", query['symbol'], len(data), time.time() - start_time)
+    return result
@@ -0,0 +1,208 @@
+import math
+from array import array
+from collections import deque
+
+# Exponential moving averages of the mid price; they decay by elapsed time rather than per tick
+INDICATOR_EMA_SPANS = {"1m": 60, "5m": 5 * 60, "15m": 15 * 60}
+
+# Sliding windows for volatility, range, time-weighted mid and spread statistics
+INDICATOR_WINDOWS = {"1m": 60, "5m": 5 * 60}
+
+# Running sums are recomputed from the stored samples this often to shed rounding drift
+RESUM_INTERVAL = 4096
+
+
+class RollingWindow:
+    """Time-based sliding window of (timestamp, value) samples in growable ring arrays
+
+    Running sums give the mean and standard deviation in O(1), monotonic
+    queues of sample positions give the min and max in amortized O(1), and
+    the area under the step series gives a time-weighted mean. Samples leave
+    once they are more than `span` seconds older than the newest one.
+    """
+
+    __slots__ = ('span', 'timestamps', 'values', 'head', 'tail', 'shift', 'total', 'squares', 'area',
+                 'lows', 'highs', '_appends')
+
+    def __init__(self, span: float, capacity: int = 16):
+        self.span = span
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        # Absolute positions of the oldest sample and one past the newest
+        self.head = 0
+        self.tail = 0
+        # Sums are taken around the first value to keep the variance from cancelling out
+        self.shift = 0.0
+        self.total = 0.0
+        self.squares = 0.0
+        self.area = 0.0
+        self.lows = deque()
+        self.highs = deque()
+        self._appends = 0
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def _at(self, position: int) -> int:
+        return position % len(self.values)
+
+    def _grow(self):
+        capacity = len(self.values) * 2
+        timestamps = array('d', bytes(8 * capacity))
+        values = array('d', bytes(8 * capacity))
+        for position in range(self.head, self.tail):
+            i = self._at(position)
+            timestamps[position % capacity] = self.timestamps[i]
+            values[position % capacity] = self.values[i]
+        self.timestamps = timestamps
+        self.values = values
+
+    def append(self, timestamp: float, value: float):
+        """Add a sample and evict the ones that fell out of the window; out-of-order samples are dropped"""
+        if self.tail > self.head:
+            last = self._at(self.tail - 1)
+            if timestamp < self.timestamps[last]:
+                return
+            self.area += self.values[last] * (timestamp - self.timestamps[last])
+        else:
+            self.shift = value
+        if len(self) == len(self.values):
+            self._grow()
+        i = self._at(self.tail)
+        self.timestamps[i] = timestamp
+        self.values[i] = value
+        offset = value - self.shift
+        self.total += offset
+        self.squares += offset * offset
+        while self.lows and self.values[self._at(self.lows[-1])] >= value:
+            self.lows.pop()
+        self.lows.append(self.tail)
+        while self.highs and self.values[self._at(self.highs[-1])] <= value:
+            self.highs.pop()
+        self.highs.append(self.tail)
+        self.tail += 1
+        self.evict(timestamp - self.span)
+        self._appends += 1
+        if self._appends % RESUM_INTERVAL == 0:
+            self.resum()
+
+    def evict(self, cutoff: float):
+        # The newest sample is never older than the cutoff, so head + 1 always exists here
+        while self.timestamps[self._at(self.head)] < cutoff:
+            i, following = self._at(self.head), self._at(self.head + 1)
+            offset = self.values[i] - self.shift
+            self.total -= offset
+            self.squares -= offset * offset
+            self.area -= self.values[i] * (self.timestamps[following] - self.timestamps[i])
+            if self.lows[0] == self.head:
+                self.lows.popleft()
+            if self.highs[0] == self.head:
+                self.highs.popleft()
+            self.head += 1
+
+    def resum(self):
+        self.shift = self.values[self._at(self.head)]
+        self.total = self.squares = self.area = 0.0
+        for position in range(self.head, self.tail):
+            i = self._at(position)
+            offset = self.values[i] - self.shift
+            self.total += offset
+            self.squares += offset * offset
+            if position + 1 < self.tail:
+                self.area += self.values[i] * (self.timestamps[self._at(position + 1)] - self.timestamps[i])
+
+    def stats(self) -> dict:
+        count = len(self)
+        if not count:
+            return None
+        first, last = self.timestamps[self._at(self.head)], self.timestamps[self._at(self.tail - 1)]
+        mean = self.total / count
+        return {
+            "count": count,
+            "mean": self.shift + mean,
+            "twap": self.area / (last - first) if last > first else self.values[self._at(self.tail - 1)],
+            "stddev": math.sqrt(max(0.0, self.squares / count - mean * mean)),
+            "min": self.values[self._at(self.lows[0])],
+            "max": self.values[self._at(self.highs[0])],
+        }
+
+
+class SymbolIndicators:
+    """Indicator state of one symbol: EMAs, plus a mid and a spread window per sliding window"""
+
+    __slots__ = ('timestamp', 'mid', 'spread', 'emas', 'mids', 'spreads')
+
+    def __init__(self, ema_spans: int, windows: dict):
+        self.timestamp = None
+        self.mid = None
+        self.spread = None
+        self.emas = array('d', bytes(8 * ema_spans))
+        self.mids = [RollingWindow(span) for span in windows.values()]
+        self.spreads = [RollingWindow(span) for span in windows.values()]
+
+
+class IndicatorEngine:
+    """Streaming per-symbol indicators, updated in O(1) amortized per moved quote
+
+    Each EMA treats the mid as a step series: the price that stood since the
+    last update is folded in with a weight that grows with how long it stood,
+    so bursts of ticks and quiet stretches are weighted by time, not count.
+    Windows only advance when their symbol updates, so a quiet symbol keeps
+    reporting the state as of its last quote.
+    """
+
+    def __init__(self, ema_spans: dict = None, windows: dict = None):
+        self.ema_spans = ema_spans or INDICATOR_EMA_SPANS
+        self.windows = windows or INDICATOR_WINDOWS
+        self._spans = list(self.ema_spans.values())
+        self.symbols = {}
+
+    def update(self, symbol: str, timestamp: float, bid: float, ask: float):
+        state = self.symbols.get(symbol)
+        if state is None:
+            state = self.symbols[symbol] = SymbolIndicators(len(self._spans), self.windows)
+        elif timestamp < state.timestamp:
+            return
+        mid, spread = (bid + ask) / 2, ask - bid
+        emas = state.emas
+        if state.timestamp is None:
+            for i in range(len(emas)):
+                emas[i] = mid
+        else:
+            elapsed = timestamp - state.timestamp
+            for i, span in enumerate(self._spans):
+                emas[i] += (1 - math.exp(-elapsed / span)) * (state.mid - emas[i])
+        state.timestamp, state.mid, state.spread = timestamp, mid, spread
+        for window in state.mids:
+            window.append(timestamp, mid)
+        for window in state.spreads:
+            window.append(timestamp, spread)
+
+    def update_tick(self, quotes: dict) -> dict:
+        """Fold in each moved quote, returns the indicators of the symbols it touched"""
+        for symbol, quote in quotes.items():
+            self.update(symbol, quote['timestamp'], quote['bid'], quote['ask'])
+        return self.snapshot(quotes)
+
+    def indicators(self, symbol: str) -> dict:
+        state = self.symbols[symbol]
+        windows = {}
+        for name, mids, spreads in zip(self.windows, state.mids, state.spreads):
+            stats = mids.stats()
+            spread_stats = spreads.stats()
+            stats["spread_mean"] = spread_stats["mean"]
+            stats["spread_max"] = spread_stats["max"]
+            windows[name] = stats
+        return {
+            "timestamp": state.timestamp,
+            "mid": state.mid,
+            "spread": state.spread,
+            "ema": dict(zip(self.ema_spans, state.emas)),
+            "windows": windows,
+        }
+
+    def snapshot(self, symbols=None) -> dict:
+        """Indicators of every symbol seen so far, optionally limited to some symbols"""
+        if symbols is None:
+            symbols = self.symbols
+        return {symbol: self.indicators(symbol) for symbol in sorted(symbols) if symbol in self.symbols}
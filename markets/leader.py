@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+import socket
+from uuid import uuid4
+import redis
+from django.conf import settings
+from .models import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Only the holder of the token may extend or delete the lock
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderElection:
+    """Redis lock electing the one process that polls upstream, with expiry-based failover"""
+
+    def __init__(self, key: str = None, ttl: float = None):
+        self.key = key or settings.PRODUCER_LEADER_KEY
+        self.ttl = ttl or settings.PRODUCER_LEADER_TTL
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex}"
+        self.is_leader = False
+        self._task = None
+
+    @property
+    def ttl_ms(self) -> int:
+        return int(self.ttl * 1000)
+
+    async def campaign(self) -> bool:
+        """Renew the lock if held, otherwise try to take it; returns whether we lead"""
+        client = get_redis_client()
+        try:
+            if self.is_leader:
+                if await client.eval(RENEW_SCRIPT, 1, self.key, self.token, self.ttl_ms):
+                    return True
+                logger.warning("Lost producer leadership (%s)", self.token)
+                self.is_leader = False
+
+            if await client.set(self.key, self.token, nx=True, px=self.ttl_ms):
+                logger.info("Acquired producer leadership (%s)", self.token)
+                self.is_leader = True
+        except redis.RedisError as e:
+            # Without Redis we cannot prove we still hold the lock, so stand down
+            if self.is_leader:
+                logger.error("Standing down as producer leader, Redis unavailable: %s", e)
+            self.is_leader = False
+        return self.is_leader
+
+    async def resign(self):
+        """Release the lock if we hold it so a follower can take over immediately"""
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        try:
+            await get_redis_client().eval(RELEASE_SCRIPT, 1, self.key, self.token)
+            logger.info("Resigned producer leadership (%s)", self.token)
+        except redis.RedisError as e:
+            logger.error("Error releasing producer leadership: %s", e)
+
+    async def run(self):
+        """Campaign several times per TTL so a live leader never lets the lock expire"""
+        # Checking ownership covers cancels that redis.asyncio swallows mid-command
+        while self._task is asyncio.current_task():
+            await self.campaign()
+            await asyncio.sleep(self.ttl / 3)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.resign()
@@ -0,0 +1,138 @@
+import atexit
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger(__name__)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to a background writer; when the queue is full it drops
+    records below WARNING instead of blocking the event loop, and waits for
+    room only for warnings and errors"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The listener lives in this process, so message formatting is left to it
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record)
+            else:
+                self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `rate` records per message template and rate key through every `per` seconds
+
+    The key is the template (the unformatted msg) plus an optional `rate_key`
+    extra such as a client id or symbol; keyed records are also capped at
+    `total_rate` per template so thousands of clients cannot multiply the
+    volume. A suppressed run is reported on the next record that gets
+    through. Errors are never suppressed.
+    """
+
+    def __init__(self, rate: int = 10, per: float = 60.0, total_rate: int = None, max_keys: int = 10000):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.total_rate = total_rate or rate * 10
+        self.max_keys = max_keys
+        self.windows = {}
+
+    def filter(self, record) -> bool:
+        # Several handlers can share this filter, decide once per record
+        decision = getattr(record, 'rate_limited', None)
+        if decision is not None:
+            return not decision
+        allowed = self.allow(record)
+        record.rate_limited = not allowed
+        return allowed
+
+    def allow(self, record) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        template = (record.name, record.msg)
+        rate_key = getattr(record, 'rate_key', None)
+        suppressed = 0
+        if rate_key is not None:
+            allowed, suppressed = self.take(template + (rate_key,), self.rate, now)
+            if not allowed:
+                return False
+        allowed, count = self.take(template + (None,), self.rate if rate_key is None else self.total_rate, now)
+        if not allowed:
+            return False
+        suppressed += count
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+    def take(self, key, limit: int, now: float):
+        """Count one record against a key's window, returns (allowed, suppressed in the previous window)"""
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.per:
+            suppressed = window[2] if window is not None else 0
+            if window is None and len(self.windows) >= self.max_keys:
+                self.prune(now)
+            self.windows[key] = [now, 1, 0]
+            return True, suppressed
+        if window[1] < limit:
+            window[1] += 1
+            return True, 0
+        window[2] += 1
+        return False, 0
+
+    def prune(self, now: float):
+        for key in [key for key, window in self.windows.items() if now - window[0] >= self.per]:
+            del self.windows[key]
+        if len(self.windows) >= self.max_keys:
+            # Still full of live keys (e.g. thousands of clients), start over rather than grow
+            self.windows.clear()
+
+
+def _stop_listener(listener: QueueListener):
+    # QueueListener.stop() fails when called twice, flush only if still running
+    if listener._thread is not None:
+        listener.stop()
+
+
+def start_background_logging(logger_names, max_queue: int = 10000) -> QueueListener:
+    """Move the handlers of some loggers behind one queue drained by a background thread
+
+    Filters shared by every moved handler (such as the rate limit) move to the
+    queue handler, so records they suppress are dropped on the calling thread
+    instead of being queued for the writer.
+    """
+    log_queue = queue.Queue(max_queue)
+    handlers = []
+    for name in logger_names:
+        target = logging.getLogger(name)
+        for handler in list(target.handlers):
+            if isinstance(handler, QueueHandler):
+                continue
+            target.removeHandler(handler)
+            if handler not in handlers:
+                handlers.append(handler)
+    shared = [f for f in handlers[0].filters if all(f in handler.filters for handler in handlers[1:])] if handlers else []
+    for handler in handlers:
+        for log_filter in shared:
+            handler.removeFilter(log_filter)
+    for name in logger_names:
+        queue_handler = DroppingQueueHandler(log_queue)
+        for log_filter in shared:
+            queue_handler.addFilter(log_filter)
+        logging.getLogger(name).addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    logger.debug("Background logging started for %s with %d handlers", ", ".join(logger_names), len(handlers))
+    return listener
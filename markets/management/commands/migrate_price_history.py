@@ -0,0 +1,29 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from markets.models import PriceHistory, get_redis_client
+
+
+class Command(BaseCommand):
+    help = "Rewrite legacy str(dict) price history entries in the compact binary format"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = asyncio.run(self.migrate(options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(f"Migrated {total} price history entries"))
+
+    async def migrate(self, batch_size: int) -> int:
+        history = PriceHistory()
+        prefix = history.price_key_format.format(symbol='')
+        total = 0
+        async for key in get_redis_client().scan_iter(match=f"{prefix}*", count=batch_size):
+            symbol = key.decode()[len(prefix):]
+            if ':' in symbol:
+                # Compacted tiers (price_history:<tier>:<symbol>) are always written in the binary format
+                continue
+            count = await history.migrate_legacy(symbol, batch_size)
+            if count:
+                self.stdout.write(f"{symbol}: {count}")
+            total += count
+        return total
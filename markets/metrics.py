@@ -0,0 +1,126 @@
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from sub-millisecond sends up to slow upstream fetches
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Timer:
+    """Context manager observing the elapsed time of its block into a histogram"""
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{_format_value(bound)}"}}', cumulative
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+
+class Gauge:
+    """Value that is set directly or read from `fn` at scrape time"""
+
+    def __init__(self, name: str, documentation: str, fn=None, kind: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.kind = kind
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.fn() if self.fn is not None else self.value
+
+
+class Registry:
+    """Every metric of the process, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, value in metric.samples():
+                    lines.append(f"{name} {_format_value(value)}")
+            except Exception as e:
+                logger.error("Error collecting metric %s: %s", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def histogram(name: str, documentation: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, buckets))
+
+
+def gauge(name: str, documentation: str, fn=None, kind: str = "gauge") -> Gauge:
+    return registry.register(Gauge(name, documentation, fn, kind))
+
+
+fetch_seconds = histogram("markets_upstream_fetch_seconds", "Newton request latency, including conditional and failed ones")
+format_seconds = histogram("markets_format_seconds", "Time to format one upstream snapshot")
+redis_write_seconds = histogram("markets_redis_write_seconds", "Time to write one tick of price history to Redis")
+send_seconds = histogram("markets_client_send_seconds", "Time to hand one frame to a client's socket")
+queue_lag_seconds = histogram("markets_client_queue_lag_seconds", "Time frames wait in a client's outbox before being sent")
+connected_clients = gauge("markets_connected_clients", "Open WebSocket connections in this process")
@@ -1,84 +1,335 @@
 from django.db import models
+import asyncio
+import weakref
+import struct
 import redis
+import redis.asyncio as aioredis
 from django.conf import settings
 import time
 import logging
-import json
+from .encoding import encode_price, decode_price, decode_prices, is_legacy, encode_candle, decode_candles
+from .candles import CANDLE_RETENTION
+from .metrics import redis_write_seconds
 
 logger = logging.getLogger(__name__)
 
+# One client (and connection pool) per event loop; in production that is one per process
+_redis_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis_client() -> aioredis.Redis:
+    """Get the process-wide asyncio Redis client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _redis_clients.get(loop)
+    if client is None:
+        logger.info("Creating shared Redis connection pool")
+        pool = aioredis.ConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            max_connections=settings.REDIS_MAX_CONNECTIONS
+        )
+        client = aioredis.Redis(connection_pool=pool)
+        _redis_clients[loop] = client
+    return client
+
+
+# Ticks older than PRICE_HISTORY_RAW_RETENTION roll up into coarser tiers, each holding
+# the last price of every `resolution`-second bucket: (tier, resolution, kept for seconds)
+PRICE_HISTORY_TIERS = (
+    ("1m", 60, 7 * 24 * 60 * 60),
+    ("1h", 60 * 60, 365 * 24 * 60 * 60),
+)
+
+
 class PriceHistory:
     def __init__(self):
-        logger.info("Initializing Redis connection")
+        self.price_key_format = "price_history:{symbol}"
+        self.tier_key_format = "price_history:{tier}:{symbol}"
+        self.week_seconds = 7 * 24 * 60 * 60
+        self.retention_seconds = PRICE_HISTORY_TIERS[-1][2]
+        self._last_quotes = {}
+        self._last_compaction = 0.0
+
+    @property
+    def redis_client(self) -> aioredis.Redis:
+        return get_redis_client()
+
+    def tier_keys(self, symbol: str) -> list:
+        """Keys holding a symbol's history, raw ticks first and the coarsest tier last"""
+        return [self.price_key_format.format(symbol=symbol)] + [
+            self.tier_key_format.format(tier=tier, symbol=symbol) for tier, _, _ in PRICE_HISTORY_TIERS
+        ]
+
+    async def ping(self):
+        """Check that the shared Redis pool can reach the server"""
         try:
-            self.redis_client = redis.Redis(
-                host=settings.REDIS_HOST,
-                port=settings.REDIS_PORT,
-                db=settings.REDIS_DB,
-                decode_responses=True
-            )
-            self.redis_client.ping()  # Test connection
+            await self.redis_client.ping()
             logger.info("Successfully connected to Redis")
         except redis.ConnectionError as e:
-            logger.error(f"Failed to connect to Redis: {str(e)}")
+            logger.error("Failed to connect to Redis: %s", e)
             raise
-            
-        self.price_key_format = "price_history:{symbol}"
-        self.week_seconds = 7 * 24 * 60 * 60
 
-    def store_price(self, symbol: str, price_data: dict):
+    async def store_price(self, symbol: str, price_data: dict):
         """Store price data with timestamp"""
-        key = self.price_key_format.format(symbol=symbol)
+        await self.store_tick([dict(price_data, symbol=symbol)])
+
+    def quote_changed(self, item: dict) -> bool:
+        """Whether the quote differs from the last one stored for its symbol"""
+        quote = (item.get('bid'), item.get('ask'), item.get('change'))
+        if self._last_quotes.get(item['symbol']) == quote:
+            return False
+        self._last_quotes[item['symbol']] = quote
+        return True
+
+    def compaction_due(self, now: float) -> bool:
+        """Whether the next compaction pass should start"""
+        return now - self._last_compaction >= settings.PRICE_HISTORY_COMPACT_INTERVAL
+
+    async def store_tick(self, items: list) -> int:
+        """Store a whole snapshot in one pipelined round trip, returns symbols written"""
+        changed = []
+        for item in items:
+            if not self.quote_changed(item):
+                continue
+            try:
+                changed.append((item['symbol'], encode_price(item), item['timestamp']))
+            except (KeyError, ValueError, TypeError, struct.error) as e:
+                self._last_quotes.pop(item['symbol'], None)
+                logger.warning("Error encoding %s price: %s", item['symbol'], e, extra={"rate_key": item['symbol']})
+        if not changed:
+            logger.debug("No quote changes in tick of %s entries, skipping write", len(items))
+            return 0
+
         try:
-            # Log the data being stored
-            logger.debug(f"Storing price for {symbol}: {json.dumps(price_data)}")
-            
-            # Store the data
-            result = self.redis_client.zadd(key, {str(price_data): price_data['timestamp']})
-            
-            # Cleanup old data
-            month_ago = int(time.time()) - (30 * 24 * 60 * 60)
-            removed = self.redis_client.zremrangebyscore(key, '-inf', month_ago)
-            
-            logger.info(f"Stored price for {symbol}: added={result}, removed={removed} old entries")
-            
-            # Log current data count
-            count = self.redis_client.zcard(key)
-            logger.debug(f"Current price history count for {symbol}: {count}")
-            
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for symbol, member, timestamp in changed:
+                    pipe.zadd(self.price_key_format.format(symbol=symbol), {member: timestamp})
+                with redis_write_seconds.time():
+                    await pipe.execute()
+            logger.debug("Stored tick: %s of %s entries changed", len(changed), len(items))
+            return len(changed)
+
         except redis.RedisError as e:
-            logger.error(f"Redis error storing price for {symbol}: {str(e)}")
+            # Forget the quotes so the next tick retries them
+            for symbol, _, _ in changed:
+                self._last_quotes.pop(symbol, None)
+            logger.error("Redis error storing tick of %s entries: %s", len(changed), e)
             raise
 
-    def get_previous_price(self, symbol: str, window: int = None) -> dict:
+    async def compact_batch(self, source: str, target: str, resolution: int, cutoff: int, batch_size: int) -> int:
+        """Roll up to `batch_size` entries of `source` older than `cutoff` into `target`, returns entries moved
+
+        Each bucket keeps its last price under that price's own timestamp, and
+        the copy and the removal run in one transaction so readers never see a
+        price twice. A full batch leaves its last bucket for the next one, as
+        more of it may be waiting past the batch.
+        """
+        entries = await self.redis_client.zrangebyscore(source, '-inf', f"({cutoff}", start=0, num=batch_size, withscores=True)
+        if not entries:
+            return 0
+        buckets = {}
+        for member, score in entries:
+            buckets.setdefault(int(score) - int(score) % resolution, []).append(member)
+        if len(entries) == batch_size and len(buckets) > 1:
+            buckets.popitem()
+
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            moved = 0
+            for bucket, members in buckets.items():
+                prices = []
+                for member in members:
+                    try:
+                        prices.append(decode_price(member, ''))
+                    except (KeyError, ValueError, SyntaxError) as e:
+                        logger.error("Dropping unparseable entry of %s: %s", source, e)
+                if prices:
+                    last = max(prices, key=lambda price: price['timestamp'])
+                    # A bucket split across batches replaces the last price it got from the earlier one
+                    pipe.zremrangebyscore(target, bucket, f"({bucket + resolution}")
+                    pipe.zadd(target, {encode_price(last): last['timestamp']})
+                pipe.zrem(source, *members)
+                moved += len(members)
+            await pipe.execute()
+        return moved
+
+    async def compact(self, symbols, now: float = None, batch_size: int = None) -> int:
+        """Move aged prices of every symbol down the retention tiers in bounded batches, returns entries moved
+
+        Every batch is a single short transaction, so a long backlog (such as a
+        month of raw ticks after an upgrade) is worked through without holding
+        Redis up for other clients. The coarsest tier is trimmed to its retention.
+        """
+        now = int(now or time.time())
+        batch_size = batch_size or settings.PRICE_HISTORY_COMPACT_BATCH
+        self._last_compaction = now
+        start_time = time.time()
+        moved = 0
+        try:
+            for symbol in symbols:
+                keys = self.tier_keys(symbol)
+                retention = settings.PRICE_HISTORY_RAW_RETENTION
+                for (tier, resolution, tier_retention), source, target in zip(PRICE_HISTORY_TIERS, keys, keys[1:]):
+                    # Only whole buckets are rolled up, so the cutoff sits on a bucket boundary
+                    cutoff = now - retention
+                    cutoff -= cutoff % resolution
+                    while True:
+                        count = await self.compact_batch(source, target, resolution, cutoff, batch_size)
+                        moved += count
+                        if count == 0:
+                            break
+                        await asyncio.sleep(0)
+                    retention = tier_retention
+                await self.redis_client.zremrangebyscore(keys[-1], '-inf', now - retention)
+        except redis.RedisError as e:
+            logger.error("Redis error compacting price history: %s", e)
+            raise
+        logger.info("Compacted %s price entries in %.2fs", moved, time.time() - start_time)
+        return moved
+
+    async def get_previous_price(self, symbol: str, window: int = None) -> dict:
         """Get previous price data for change calculation"""
-        key = self.price_key_format.format(symbol=symbol)
         window = window or self.week_seconds
         current_time = int(time.time())
         previous_time = current_time - window
-        
+
         try:
-            logger.debug(f"Fetching previous price for {symbol} from {previous_time} to {current_time}")
-            
-            prices = self.redis_client.zrangebyscore(
-                key, 
-                previous_time, 
-                current_time, 
-                start=0, 
-                num=1
-            )
-            
+            logger.debug("Fetching previous price for %s from %s to %s", symbol, previous_time, current_time)
+
+            # The oldest price may sit in any tier, so ask all of them in one round trip
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for key in self.tier_keys(symbol):
+                    pipe.zrangebyscore(key, previous_time, current_time, start=0, num=1)
+                results = await pipe.execute()
+
+            prices = [decode_price(members[0], symbol) for members in results if members]
             if prices:
-                price_data = eval(prices[0])
-                logger.info(f"Found previous price for {symbol}: {json.dumps(price_data)}")
+                price_data = min(prices, key=lambda price: price['timestamp'])
+                logger.info("Found previous price for %s: %s", symbol, price_data)
                 return price_data
             else:
-                logger.warning(f"No previous price found for {symbol} in the last {window} seconds")
+                logger.warning("No previous price found for %s in the last %s seconds", symbol, window)
                 return None
-                
+
         except redis.RedisError as e:
-            logger.error(f"Redis error fetching previous price for {symbol}: {str(e)}")
+            logger.error("Redis error fetching previous price for %s: %s", symbol, e)
             raise
         except (ValueError, SyntaxError) as e:
-            logger.error(f"Error parsing price data for {symbol}: {str(e)}")
+            logger.error("Error parsing price data for %s: %s", symbol, e)
             return None
+
+    async def get_price_range(self, symbol: str, start: float, end: float) -> list:
+        """Get all decoded price data for a symbol between two timestamps, across every tier"""
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for key in self.tier_keys(symbol):
+                    pipe.zrangebyscore(key, start, end)
+                results = await pipe.execute()
+        except redis.RedisError as e:
+            logger.error("Redis error fetching price range for %s: %s", symbol, e)
+            raise
+        return self.merge_tiers(results, symbol)
+
+    def merge_tiers(self, results: list, symbol: str) -> list:
+        """Decoded prices of per-tier results in timestamp order; tiers never overlap, so coarser ones come first"""
+        prices = []
+        for members in reversed(results):
+            prices.extend(decode_prices(members, symbol))
+        prices.sort(key=lambda price: price['timestamp'])
+        return prices
+
+    async def get_price_page(self, symbol: str, start: float, end: float, offset: int, count: int) -> list:
+        """Up to `count` decoded prices between two timestamps, skipping the first `offset`"""
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for key in self.tier_keys(symbol):
+                    pipe.zrangebyscore(key, start, end, start=0, num=offset + count)
+                results = await pipe.execute()
+        except redis.RedisError as e:
+            logger.error("Redis error fetching price page for %s: %s", symbol, e)
+            raise
+        return self.merge_tiers(results, symbol)[offset:offset + count]
+
+    async def get_last_prices(self, symbol: str, buckets: list) -> list:
+        """Latest price inside each (start, end) bucket, None for empty buckets, in one round trip"""
+        keys = self.tier_keys(symbol)
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for bucket_start, bucket_end in buckets:
+                    for key in keys:
+                        pipe.zrevrangebyscore(key, bucket_end, bucket_start, start=0, num=1)
+                results = await pipe.execute()
+        except redis.RedisError as e:
+            logger.error("Redis error fetching downsampled prices for %s: %s", symbol, e)
+            raise
+        last_prices = []
+        for i in range(0, len(results), len(keys)):
+            prices = [decode_price(members[0], symbol) for members in results[i:i + len(keys)] if members]
+            last_prices.append(max(prices, key=lambda price: price['timestamp']) if prices else None)
+        return last_prices
+
+    async def migrate_legacy(self, symbol: str, batch_size: int = 1000) -> int:
+        """Rewrite legacy str(dict) members of one symbol as v1 records, returns members migrated"""
+        key = self.price_key_format.format(symbol=symbol)
+        migrated = 0
+        cursor = 0
+        while True:
+            cursor, entries = await self.redis_client.zscan(key, cursor, count=batch_size)
+            legacy = [(member, score) for member, score in entries if is_legacy(member)]
+            if legacy:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for member, score in legacy:
+                        try:
+                            record = encode_price(decode_price(member, symbol))
+                        except (KeyError, ValueError, SyntaxError) as e:
+                            logger.error("Dropping unparseable %s entry: %s", symbol, e)
+                            pipe.zrem(key, member)
+                            continue
+                        pipe.zrem(key, member)
+                        pipe.zadd(key, {record: score})
+                    await pipe.execute()
+                migrated += len(legacy)
+            if cursor == 0:
+                break
+        logger.info("Migrated %s legacy price entries for %s", migrated, symbol)
+        return migrated
+
+
+class CandleStore:
+    """Closed OHLCV bars per symbol and interval, kept next to PriceHistory"""
+
+    def __init__(self):
+        self.candle_key_format = "candles:{interval}:{symbol}"
+
+    @property
+    def redis_client(self) -> aioredis.Redis:
+        return get_redis_client()
+
+    async def store(self, closed: list) -> int:
+        """Write (interval, symbol, Candle) bars in one pipelined round trip and trim old ones"""
+        if not closed:
+            return 0
+        now = int(time.time())
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for interval, symbol, candle in closed:
+                    key = self.candle_key_format.format(interval=interval, symbol=symbol)
+                    pipe.zadd(key, {encode_candle(candle.as_dict()): candle.start})
+                    retention = CANDLE_RETENTION.get(interval)
+                    if retention:
+                        pipe.zremrangebyscore(key, '-inf', now - retention)
+                await pipe.execute()
+            logger.debug("Stored %s closed candles", len(closed))
+            return len(closed)
+        except redis.RedisError as e:
+            logger.error("Redis error storing %s closed candles: %s", len(closed), e)
+            raise
+
+    async def get_candles(self, symbol: str, interval: str, start: float, end: float) -> list:
+        """Closed bars of one interval whose start falls between two timestamps"""
+        key = self.candle_key_format.format(interval=interval, symbol=symbol)
+        try:
+            return decode_candles(await self.redis_client.zrangebyscore(key, start, end))
+        except redis.RedisError as e:
+            logger.error("Redis error fetching %s candles for %s: %s", interval, symbol, e)
+            raise
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from .metrics import gauge, send_seconds, queue_lag_seconds
+
+logger = logging.getLogger(__name__)
+
+# Process-wide totals across every connection, per-connection counts live on each Outbox
+outbox_totals = {"sent": 0, "dropped": 0, "conflated": 0, "disconnected": 0}
+
+gauge("markets_outbox_sent_total", "Frames written to clients", fn=lambda: outbox_totals["sent"], kind="counter")
+gauge("markets_outbox_dropped_total", "Frames discarded by client outboxes", fn=lambda: outbox_totals["dropped"], kind="counter")
+gauge("markets_outbox_conflated_total", "Times a client outbox collapsed its backlog", fn=lambda: outbox_totals["conflated"], kind="counter")
+gauge("markets_outbox_disconnected_total", "Clients disconnected for lagging", fn=lambda: outbox_totals["disconnected"], kind="counter")
+
+
+class Outbox:
+    """Bounded per-connection send queue that conflates instead of growing when the client lags
+
+    Handlers only enqueue (seq, text) items and a writer task drains them, so a
+    slow socket never holds up the consumer or other clients. Full ticks are
+    latest-wins within their stream, deltas past max_size collapse into the
+    resync() snapshots of every stream, and a client lagging more than max_lag seconds is
+    handed to on_slow.
+    """
+
+    def __init__(self, send, name: str = None, resync=None, on_slow=None, max_size: int = 64, max_lag: float = 30.0):
+        self.send = send
+        self.name = name
+        self.resync = resync
+        self.on_slow = on_slow
+        self.max_size = max_size
+        self.max_lag = max_lag
+        self.pending = deque()
+        self.resync_pending = False
+        self.last_seq = None
+        self.sent = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.last_sent = time.monotonic()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._slow_task = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self.pending) + (1 if self.resync_pending else 0)
+
+    def _count(self, name: str, amount: int = 1):
+        setattr(self, name, getattr(self, name) + amount)
+        outbox_totals[name] += amount
+
+    def _wake(self):
+        if self._closed:
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        elif self.pending and time.monotonic() - self.pending[0][2] > self.max_lag:
+            # The writer is stuck on a send, give up without waiting for it
+            self._closed = True
+            self._slow_task = asyncio.create_task(self._give_up(time.monotonic() - self.pending[0][2]))
+        self._wakeup.set()
+
+    async def _give_up(self, lag: float):
+        logger.warning("Outbox lagged %.1fs behind, giving up on client", lag)
+        self._closed = True
+        outbox_totals["disconnected"] += 1
+        self._count("dropped", len(self.pending))
+        self.pending.clear()
+        if self.on_slow is not None:
+            await self.on_slow()
+
+    def put(self, seq, text: str):
+        if self._closed:
+            return
+        if self.resync_pending:
+            # The resync will render current state, so this item is already covered
+            self._count("dropped")
+            return
+        if len(self.pending) >= self.max_size and self.resync is not None:
+            self._count("conflated")
+            self._count("dropped", len(self.pending))
+            self.pending.clear()
+            self.resync_pending = True
+        elif len(self.pending) >= self.max_size:
+            self.pending.popleft()
+            self._count("dropped")
+            self.pending.append((seq, text, time.monotonic(), None))
+        else:
+            self.pending.append((seq, text, time.monotonic(), None))
+        self._wake()
+
+    def put_latest(self, seq, text: str, stream: str = "latest"):
+        """Queue text in place of anything still pending from the same stream; put() items are never replaced"""
+        if self._closed:
+            return
+        replaced = [item for item in self.pending if item[3] == stream]
+        if replaced:
+            self._count("conflated")
+            self._count("dropped", len(replaced))
+            enqueued_at = replaced[0][2]
+            self.pending = deque(item for item in self.pending if item[3] != stream)
+        else:
+            enqueued_at = time.monotonic()
+        # Keep the original enqueue time so lag keeps accumulating while frames are replaced
+        self.pending.append((seq, text, enqueued_at, stream))
+        self._wake()
+
+    def put_snapshot(self, seq, text: str):
+        if self._closed:
+            return
+        if self.pending:
+            self._count("dropped", len(self.pending))
+            self.pending.clear()
+        self.resync_pending = False
+        self.last_seq = None
+        self.pending.append((seq, text, time.monotonic(), None))
+        self._wake()
+
+    def _next(self):
+        if self.resync_pending:
+            self.resync_pending = False
+            # Ahead of full ticks queued since, which are only ever newer than the snapshots
+            now = time.monotonic()
+            self.pending.extendleft((seq, text, now, None) for seq, text in reversed(self.resync()))
+            if not self.pending:
+                return None
+        return self.pending.popleft()
+
+    async def run(self):
+        """Drain pending items to the socket until closed"""
+        while not self._closed:
+            if not self.pending and not self.resync_pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            item = self._next()
+            if item is None:
+                continue
+            seq, text, enqueued_at, _ = item
+            if seq is not None and self.last_seq is not None and seq <= self.last_seq:
+                self._count("dropped")
+                continue
+            if enqueued_at is not None and time.monotonic() - enqueued_at > self.max_lag:
+                self._count("dropped")
+                await self._give_up(time.monotonic() - enqueued_at)
+                return
+
+            if enqueued_at is not None:
+                queue_lag_seconds.observe(time.monotonic() - enqueued_at)
+            try:
+                with send_seconds.time():
+                    await self.send(text)
+            except Exception as e:
+                logger.warning("Error writing to client %s: %s", self.name, e, extra={"rate_key": self.name})
+                self._count("dropped")
+                continue
+            if seq is not None:
+                self.last_seq = seq
+            self.last_sent = time.monotonic()
+            self._count("sent")
+
+    async def close(self):
+        """Stop the writer and discard anything still pending"""
+        self._closed = True
+        if self.pending:
+            self._count("dropped", len(self.pending))
+            self.pending.clear()
+        task, self._task = self._task, None
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "dropped": self.dropped, "conflated": self.conflated, "pending": len(self)}
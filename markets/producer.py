@@ -0,0 +1,509 @@
+import asyncio
+import logging
+import redis
+import time
+from collections import Counter
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .services import MarketDataService
+from .frames import Frame, compose_frame, encode_fragment, WIRE_FORMATS
+from .subscriptions import SymbolIndex
+from .leader import LeaderElection
+from .candles import CandleAggregator, CANDLE_INTERVALS
+from .indicators import IndicatorEngine
+from .models import CandleStore
+from .metrics import gauge
+from .scheduler import TickScheduler
+
+logger = logging.getLogger(__name__)
+
+RATES_GROUP = "rates"
+
+# Producers in every process listen here for the leader's ticks in multi-process mode
+SYNC_GROUP = "rates.sync"
+
+# Live and closed bars of each candle interval go to "candles.<interval>"
+CANDLES_GROUP = "candles"
+
+# Streaming indicators of every moved pair go to one opt-in group
+INDICATORS_GROUP = "indicators"
+
+# A symbol is included in a delta when any of these fields moved
+DELTA_FIELDS = ("bid", "ask", "change")
+
+
+class MarketDataProducer:
+    """Process-wide poller that fetches Newton once per tick and fans out to the rates group
+
+    With an election, only the leading process polls; every other process
+    mirrors the leader's ticks from SYNC_GROUP so its snapshots and symbol
+    routing stay current, and takes over polling if the leader goes away.
+    """
+
+    def __init__(self, group_name: str = RATES_GROUP, election: LeaderElection = None):
+        self.group_name = group_name
+        self.election = election
+        self.market_service = None
+        self.subscriber_count = 0
+        self.format_counts = Counter()
+        self.throttle_counts = Counter()
+        self.wire_formats = {}
+        self.tick_count = 0
+        self.seq = 0
+        self.last_data = {}
+        # Wall-clock time upstream last confirmed last_data, sent with snapshots so clients can tell how stale they are
+        self.as_of = None
+        self.index = SymbolIndex()
+        self.candles = CandleAggregator()
+        self.candle_store = CandleStore()
+        self.indicators = IndicatorEngine()
+        self._fragments = {}
+        self._snapshot_frames = {}
+        self._throttle_slots = {}
+        self._throttle_moved = {}
+        self.scheduler = None
+        self._task = None
+        self._follow_task = None
+        self._sync_channel = None
+        self._sync_joined = None
+        # Token of the leader whose state this process mirrors, and the one it last asked for a full sync
+        self.leader_epoch = None
+        self._sync_requested = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.election is None or self.election.is_leader
+
+    @staticmethod
+    def candle_group(interval: str) -> str:
+        return f"{CANDLES_GROUP}.{interval}"
+
+    def is_running(self) -> bool:
+        """Whether the poll loop is alive on the current event loop"""
+        if self._task is None or self._task.done():
+            return False
+        return self._task.get_loop() is asyncio.get_running_loop()
+
+    def format_group(self, wire_format: str = "json", throttle: str = None) -> str:
+        """Group carrying full/delta frames in one wire format, JSON keeps the plain group name"""
+        group = self.group_name if wire_format == "json" else f"{self.group_name}.{wire_format}"
+        return f"{group}.{throttle}" if throttle else group
+
+    def active_formats(self):
+        """Wire formats worth encoding each tick"""
+        if self.election is not None:
+            # Subscribers in other processes are invisible from here
+            return WIRE_FORMATS
+        return [wire_format for wire_format in WIRE_FORMATS if self.format_counts[wire_format]]
+
+    def active_throttles(self):
+        """Throttled rates streams worth sending"""
+        if self.election is not None:
+            return list(settings.RATES_THROTTLES)
+        return [throttle for throttle in settings.RATES_THROTTLES if self.throttle_counts[throttle]]
+
+    async def add_subscriber(self, wire_format: str = "json", throttle: str = None):
+        """Register a subscriber and start polling if this is the first one"""
+        self.subscriber_count += 1
+        self.format_counts[wire_format] += 1
+        if throttle:
+            self.throttle_counts[throttle] += 1
+        logger.info("Producer subscriber added, total=%s", self.subscriber_count)
+        if not self.is_running():
+            self.start()
+
+    async def remove_subscriber(self, wire_format: str = "json", throttle: str = None):
+        """Unregister a subscriber and stop polling once nobody is listening"""
+        self.subscriber_count = max(0, self.subscriber_count - 1)
+        self.format_counts[wire_format] = max(0, self.format_counts[wire_format] - 1)
+        if throttle:
+            self.throttle_counts[throttle] = max(0, self.throttle_counts[throttle] - 1)
+        logger.info("Producer subscriber removed, total=%s", self.subscriber_count)
+        if self.subscriber_count == 0:
+            await self.stop()
+
+    def start(self):
+        """Start the poll loop on the running event loop"""
+        logger.info("Starting market data producer for group '%s'", self.group_name)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Cancel the poll loop, keeping the market data service and its price windows for the next subscriber"""
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            logger.info("Stopping market data producer for group '%s'", self.group_name)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.stop_following()
+
+    async def close(self):
+        """Stop polling and release upstream resources at process shutdown"""
+        await self.stop()
+        if self.market_service is not None:
+            await self.market_service.close()
+            self.market_service = None
+
+    def compute_delta(self, data: dict) -> dict:
+        """Symbols whose bid/ask/change moved since the last published state"""
+        delta = {}
+        for symbol, quote in data.items():
+            previous = self.last_data.get(symbol)
+            if previous is None or any(previous[field] != quote[field] for field in DELTA_FIELDS):
+                delta[symbol] = quote
+        return delta
+
+    def snapshot_frame(self, event: str = "snapshot"):
+        """Full state at the current sequence number, encoded once per tick"""
+        frame = self._snapshot_frames.get(event)
+        if frame is None:
+            frame = self._snapshot_frames[event] = self.symbols_frame(self._fragments, event=event)
+        return frame
+
+    def confirm(self, as_of: float = None):
+        """Record that upstream still reports the current state"""
+        self.as_of = as_of if as_of is not None else time.time()
+        self._snapshot_frames = {}
+
+    def symbols_frame(self, symbols, event: str = "snapshot"):
+        """Current state of some symbols, spliced from their cached fragments"""
+        symbols = [symbol for symbol in sorted(symbols) if symbol in self._fragments]
+        if not symbols:
+            return None
+        return compose_frame(
+            {"channel": self.group_name, "event": event, "seq": self.seq, "as_of": self.as_of},
+            [self._fragments[symbol] for symbol in symbols],
+            data={symbol: self.last_data[symbol] for symbol in symbols}
+        )
+
+    async def route_symbols(self, delta: dict):
+        """Send each per-symbol subscriber one message holding only the moved symbols it watches"""
+        routes = self.index.route(delta)
+        if not routes:
+            return
+        channel_layer = get_channel_layer()
+        frames = {}
+        sends = []
+        for channel_name, symbols in routes.items():
+            # Clients watching the same pairs share one composed frame, encoded once per format
+            key = tuple(sorted(symbols))
+            if key not in frames:
+                frames[key] = self.symbols_frame(key, event="delta")
+            sends.append(channel_layer.send(channel_name, {
+                "type": "rates.symbols",
+                "frame": frames[key].encode(self.wire_formats.get(channel_name, "json")),
+                "seq": self.seq,
+            }))
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        if failed:
+            logger.warning("Failed to route tick seq=%s to %s of %s symbol subscribers", self.seq, failed, len(sends))
+        logger.debug("Routed %s moved symbols to %s symbol subscribers with %s frames", len(delta), len(sends), len(frames))
+
+    def apply_tick(self, data: dict, seq: int = None) -> dict:
+        """Fold a tick into the published state, returning the symbols that moved"""
+        delta = self.compute_delta(data)
+        if delta:
+            self.seq = seq if seq is not None else self.seq + 1
+            self.last_data = {**self.last_data, **delta}
+            self._snapshot_frames = {}
+            for symbol, quote in delta.items():
+                self._fragments[symbol] = encode_fragment(symbol, quote)
+        return delta
+
+    async def publish(self, response: dict):
+        """Encode one formatted tick once per wire format and broadcast it to every consumer"""
+        self.confirm()
+        frame = Frame(dict(response, as_of=self.as_of))
+        delta = self.apply_tick(response["data"])
+        delta_frame = None
+        if delta:
+            delta_frame = compose_frame(
+                {"channel": self.group_name, "event": "delta", "seq": self.seq, "as_of": self.as_of},
+                [self._fragments[symbol] for symbol in sorted(delta)],
+                data=delta
+            )
+            logger.debug("Tick seq=%s moved %s of %s symbols", self.seq, len(delta), len(response['data']))
+
+        channel_layer = get_channel_layer()
+        for wire_format in self.active_formats():
+            await channel_layer.group_send(self.format_group(wire_format), {
+                "type": "rates.update",
+                "format": wire_format,
+                "throttle": None,
+                "frame": frame.encode(wire_format),
+                "seq": self.seq,
+                "delta": delta_frame.encode(wire_format) if delta_frame is not None else None,
+            })
+        await self.publish_throttled(frame, delta)
+        await self.publish_sync(delta)
+        if delta:
+            await self.route_symbols(delta)
+        await self.publish_candles(delta)
+        await self.publish_indicators(delta)
+        return frame
+
+    async def publish_sync(self, delta: dict = None, full: bool = False):
+        """Send the moved symbols, or with full all of them, and the current as_of to the producers in other processes"""
+        if self.election is None:
+            return
+        await get_channel_layer().group_send(SYNC_GROUP, {
+            "type": "rates.sync",
+            "epoch": self.election.token,
+            "full": full,
+            "seq": self.seq,
+            "as_of": self.as_of,
+            "data": delta or {},
+        })
+
+    async def request_sync(self):
+        """Ask the leader to send its whole state to SYNC_GROUP"""
+        await get_channel_layer().group_send(SYNC_GROUP, {"type": "rates.sync.request"})
+
+    async def publish_throttled(self, frame: Frame = None, delta: dict = None):
+        """Send each throttled stream the latest frame once per wall-clock period of its throttle
+
+        Symbols that moved in between are merged into the one delta sent at the
+        first tick past each boundary, so bursts arrive as a single aligned update.
+        Ticks where upstream did not change call this without a frame, which only
+        flushes throttles still holding moved symbols from a finished period.
+        """
+        now = time.time()
+        channel_layer = get_channel_layer()
+        for throttle in self.active_throttles():
+            moved = self._throttle_moved.setdefault(throttle, set())
+            moved.update(delta or ())
+            slot = int(now // settings.RATES_THROTTLES[throttle])
+            if slot == self._throttle_slots.get(throttle) or (frame is None and not moved):
+                continue
+            self._throttle_slots[throttle] = slot
+            self._throttle_moved[throttle] = set()
+            full_frame = frame if frame is not None else self.snapshot_frame("data")
+            delta_frame = self.symbols_frame(moved, event="delta") if moved else None
+            for wire_format in self.active_formats():
+                await channel_layer.group_send(self.format_group(wire_format, throttle), {
+                    "type": "rates.update",
+                    "format": wire_format,
+                    "throttle": throttle,
+                    "frame": full_frame.encode(wire_format),
+                    "seq": self.seq,
+                    "delta": delta_frame.encode(wire_format) if delta_frame is not None else None,
+                })
+
+    def candles_frame(self, intervals, event: str = "snapshot") -> Frame:
+        """Open bars of some intervals, as sent on subscribe and resync"""
+        return Frame({
+            "channel": CANDLES_GROUP,
+            "event": event,
+            "data": {interval: self.candles.live(interval) for interval in sorted(intervals)},
+        })
+
+    async def publish_candles(self, delta: dict):
+        """Fold moved quotes into the candles, persist closed bars and push both to candle subscribers
+
+        Without moved quotes this still closes the bars whose period has ended
+        by the candles' tick clock.
+        """
+        closed = self.candles.update_tick(delta)
+        if closed:
+            try:
+                await self.candle_store.store(closed)
+            except redis.RedisError:
+                pass  # already logged, the live stream goes on without persistence
+
+        by_interval = {}
+        for interval, symbol, candle in closed:
+            by_interval.setdefault(interval, {})[symbol] = candle.as_dict()
+        messages = []
+        for interval in CANDLE_INTERVALS:
+            if interval in by_interval:
+                messages.append((interval, {"channel": CANDLES_GROUP, "event": "closed",
+                                            "interval": interval, "data": by_interval[interval]}))
+            if delta:
+                messages.append((interval, {"channel": CANDLES_GROUP, "event": "update",
+                                            "interval": interval, "data": self.candles.live(interval, delta)}))
+
+        channel_layer = get_channel_layer()
+        formats = self.active_formats()
+        for interval, payload in messages:
+            frame = Frame(payload)
+            await channel_layer.group_send(self.candle_group(interval), {
+                "type": "candles.update",
+                "frames": {wire_format: frame.encode(wire_format) for wire_format in formats},
+            })
+
+    def indicators_frame(self, event: str = "snapshot") -> Frame:
+        """Indicators of every pair, as sent on subscribe and resync"""
+        return Frame({"channel": INDICATORS_GROUP, "event": event, "seq": self.seq, "data": self.indicators.snapshot()})
+
+    async def publish_indicators(self, delta: dict):
+        """Fold moved quotes into the indicators once and push the moved pairs' values to indicator subscribers"""
+        if not delta:
+            return
+        frame = Frame({"channel": INDICATORS_GROUP, "event": "update", "seq": self.seq,
+                       "data": self.indicators.update_tick(delta)})
+        await get_channel_layer().group_send(INDICATORS_GROUP, {
+            "type": "indicators.update",
+            "frames": {wire_format: frame.encode(wire_format) for wire_format in self.active_formats()},
+        })
+
+    async def follow(self):
+        """Mirror the leader's ticks into local state and route them to local symbol subscribers"""
+        channel_layer = get_channel_layer()
+        channel_name = self._sync_channel = await channel_layer.new_channel()
+        await self.join_sync_group()
+        # The leader only sends what moves, so symbols that stay quiet would never arrive here
+        await self.request_sync()
+        try:
+            while self._follow_task is asyncio.current_task():
+                message = await channel_layer.receive(channel_name)
+                if message.get("type") == "rates.sync.request":
+                    if self.is_leader and self.last_data:
+                        await self.publish_sync(self.last_data, full=True)
+                    continue
+                # Our own ticks come back too while leading
+                if message.get("type") != "rates.sync" or message["epoch"] == self.election.token:
+                    continue
+                if message["epoch"] != self.leader_epoch:
+                    if message["full"]:
+                        # Seqs keep rising across leaders only as far as their clocks agree, so a
+                        # new leader's full state is taken whatever its seq
+                        self.leader_epoch = message["epoch"]
+                        self.seq = min(self.seq, message["seq"])
+                    elif self._sync_requested != message["epoch"]:
+                        # A new leader sends what moved from its own state, which may not be ours
+                        self._sync_requested = message["epoch"]
+                        await self.request_sync()
+                # Stale ticks arrive from an old leader after a failover
+                if message["seq"] < self.seq:
+                    continue
+                as_of = message.get("as_of")
+                if as_of is not None and (self.as_of is None or as_of > self.as_of):
+                    # Unchanged ticks only move as_of, so snapshots here show the leader's freshness
+                    self.confirm(as_of)
+                if message["seq"] == self.seq and not message["full"]:
+                    continue
+                delta = self.apply_tick(message["data"], seq=message["seq"])
+                if delta:
+                    # Kept current here too, so subscribe snapshots in this process are not empty
+                    # and a follower that takes over carries on with the open bars. The leader
+                    # persists and publishes closed bars, so here they are only dropped
+                    self.candles.update_tick(delta)
+                    self.indicators.update_tick(delta)
+                    await self.route_symbols(delta)
+        finally:
+            self._sync_channel = self._sync_joined = None
+            await channel_layer.group_discard(SYNC_GROUP, channel_name)
+
+    async def join_sync_group(self):
+        """Join SYNC_GROUP again every PRODUCER_SYNC_REJOIN seconds
+
+        Channel layers forget group members after their group_expiry, so a
+        follower that joined only once would silently stop mirroring.
+        """
+        if self._sync_channel is None:
+            return
+        now = time.monotonic()
+        if self._sync_joined is not None and now - self._sync_joined < settings.PRODUCER_SYNC_REJOIN:
+            return
+        try:
+            await get_channel_layer().group_add(SYNC_GROUP, self._sync_channel)
+            self._sync_joined = now
+        except Exception as e:
+            logger.error("Error joining %s: %s", SYNC_GROUP, e)
+
+    async def stop_following(self):
+        task, self._follow_task = self._follow_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.election is not None:
+            await self.election.stop()
+
+    def ensure_service(self):
+        if self.market_service is None:
+            try:
+                self.market_service = MarketDataService()
+            except Exception as e:
+                logger.error("Failed to initialize market data producer: %s", e)
+                raise
+            self.market_service.start_window_rebuild()
+
+    def poll_interval(self) -> float:
+        if self.market_service is None:
+            return settings.MARKET_DATA_POLL_INTERVAL
+        return self.market_service.next_poll_interval()
+
+    async def wait_for_tick(self):
+        """Sleep until the next aligned tick, or for the source's own pacing when it replays a recording"""
+        interval = self.poll_interval()
+        if self.market_service is not None and not self.market_service.source.aligned:
+            await asyncio.sleep(interval)
+        else:
+            await self.scheduler.wait(interval)
+
+    async def run(self):
+        """Fetch, format and broadcast on every aligned tick while leading"""
+        self.scheduler = TickScheduler(settings.MARKET_DATA_POLL_INTERVAL)
+        if self.election is not None:
+            self._follow_task = asyncio.create_task(self.follow())
+            self.election.start()
+            # Give the first campaign a chance before deciding whether to poll
+            await asyncio.sleep(0)
+        else:
+            self.ensure_service()
+        if self.as_of is not None and time.time() - self.as_of < settings.MARKET_DATA_POLL_INTERVAL:
+            # Subscribers got the recent snapshot, a restart need not fetch ahead of the tick grid
+            await self.scheduler.wait()
+
+        # Checking ownership as well as relying on cancel() covers cancels that
+        # redis.asyncio swallows mid-command
+        while self._task is asyncio.current_task():
+            await self.join_sync_group()
+            if not self.is_leader:
+                self.candles.update_tick({})
+                await self.scheduler.wait()
+                continue
+            if self.election is not None and self.leader_epoch != self.election.token:
+                # Taking over: start past any seq a previous leader could have reached, so clients
+                # that saw its ticks do not drop ours as stale
+                self.leader_epoch = self.election.token
+                self.seq = max(self.seq, int(time.time() * 1000))
+            cycle_start = time.time()
+            try:
+                self.ensure_service()
+                response = await self.market_service.get_market_data()
+                if response is None:
+                    self.confirm()
+                    await self.publish_sync()
+                    # Moves held back by a throttle and bars past their period must not wait for upstream to change again
+                    await self.publish_throttled()
+                    await self.publish_candles({})
+                    logger.debug("Upstream unchanged, nothing to publish")
+                elif response:
+                    await self.publish(response)
+                    self.tick_count += 1
+                    logger.debug("Published tick #%s to %s subscribers in %.3fs",
+                                 self.tick_count, self.subscriber_count, time.time() - cycle_start)
+                else:
+                    logger.warning("No market data available to publish")
+            except Exception as e:
+                logger.error("Error publishing market data: %s", e)
+            await self.wait_for_tick()
+
+
+market_data_producer = MarketDataProducer(
+    election=LeaderElection() if settings.MARKETS_MULTIPROCESS else None
+)
+
+gauge("markets_subscriptions", "Clients holding a rates or candles subscription in this process",
+      fn=lambda: market_data_producer.subscriber_count)
+gauge("markets_symbol_subscriptions", "Clients subscribed to individual symbols in this process",
+      fn=lambda: len(market_data_producer.index))
+gauge("markets_producer_seq", "Sequence number of the latest published tick",
+      fn=lambda: market_data_producer.seq)
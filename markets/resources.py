@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+import weakref
+import redis
+from django.conf import settings
+from . import producer
+from .models import get_redis_client
+from .upstream import get_http_session, close_http_session
+
+logger = logging.getLogger(__name__)
+
+# The warm-up task of each event loop, so it runs once however many scopes arrive
+_warm_ups = weakref.WeakKeyDictionary()
+
+
+async def warm_up():
+    """Open the shared Redis pool and Newton session and load the producer's state before clients arrive"""
+    start_time = time.time()
+    try:
+        await get_redis_client().ping()
+    except redis.RedisError as e:
+        logger.warning("Redis unreachable during warm-up, connecting on first use: %s", e)
+    if settings.MARKET_DATA_SOURCE != "replay":
+        get_http_session()
+    # Starts the price window rebuild in the background, so the first subscriber does not pay for it
+    producer.market_data_producer.ensure_service()
+    logger.info("Shared resources warmed up in %.3fs", time.time() - start_time)
+
+
+def ensure_warm() -> asyncio.Task:
+    """Start the warm-up once per event loop without waiting for it"""
+    loop = asyncio.get_running_loop()
+    task = _warm_ups.get(loop)
+    if task is None:
+        task = _warm_ups[loop] = loop.create_task(warm_up())
+        task.add_done_callback(_forget_failed_warm_up)
+    return task
+
+
+def _forget_failed_warm_up(task: asyncio.Task):
+    # Nothing may await a background warm-up, so log its failure here and let the next scope retry
+    if not task.cancelled() and task.exception() is None:
+        return
+    if not task.cancelled():
+        logger.error("Warm-up failed, retrying with the next connection: %s", task.exception())
+    if _warm_ups.get(task.get_loop()) is task:
+        del _warm_ups[task.get_loop()]
+
+
+async def close_resources():
+    await producer.market_data_producer.close()
+    await close_http_session()
+    _warm_ups.pop(asyncio.get_running_loop(), None)
+
+
+class WarmUpMiddleware:
+    """Warms shared resources at server startup so connection handshakes never do I/O
+
+    Servers speaking the ASGI lifespan protocol (uvicorn, hypercorn) finish the
+    warm-up before accepting connections and close the resources at shutdown.
+    Daphne has no lifespan events, so there the warm-up starts in the
+    background with the first request or connection and is never awaited by it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        ensure_warm()
+        await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await ensure_warm()
+                except Exception as e:
+                    logger.exception("Warm-up failed: %s", e)
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_resources()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
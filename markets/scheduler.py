@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import math
+import time
+from .metrics import gauge, histogram
+
+logger = logging.getLogger(__name__)
+
+tick_lateness_seconds = histogram("markets_tick_lateness_seconds", "How late the poll loop woke up after its tick deadline")
+tick_missed = gauge("markets_tick_missed_total", "Tick deadlines skipped because a cycle overran them", kind="counter")
+
+
+class TickScheduler:
+    """Sleeps until monotonic deadlines aligned to wall-clock multiples of `period`
+
+    Deadlines come from the grid rather than from when the last cycle ended, so
+    cycle time does not add up to drift and every process ticks on the same
+    boundaries. Longer intervals (an idle upstream, a backoff) are rounded up
+    to whole periods. Deadlines that pass while a cycle is still running are
+    counted as missed and skipped rather than run back to back.
+    """
+
+    def __init__(self, period: float):
+        self.period = period
+        self.deadline = None
+        self.missed = 0
+
+    def next_deadline(self, interval: float = None) -> float:
+        """Monotonic time of the grid boundary at least `interval` (rounded up to periods) away"""
+        periods = max(1, math.ceil((interval or self.period) / self.period - 1e-9))
+        wall, now = time.time(), time.monotonic()
+        boundary = (math.floor(wall / self.period) + periods) * self.period
+        return now + boundary - wall
+
+    async def wait(self, interval: float = None):
+        now = time.monotonic()
+        if self.deadline is not None and now - self.deadline > self.period:
+            missed = int((now - self.deadline) // self.period)
+            self.missed += missed
+            tick_missed.inc(missed)
+            logger.warning("Tick cycle took %.3fs, skipped %s deadlines", now - self.deadline, missed)
+        self.deadline = self.next_deadline(interval)
+        await asyncio.sleep(max(0.0, self.deadline - time.monotonic()))
+        tick_lateness_seconds.observe(max(0.0, time.monotonic() - self.deadline))
@@ -1,11 +1,15 @@
 import aiohttp
 import asyncio
+import redis
 import logging
 from typing import Dict, Any
 from django.conf import settings
 import time
-import json
 from .models import PriceHistory
+from .window import PriceWindowCache
+from .metrics import format_seconds
+from .upstream import UpstreamError, CircuitOpenError
+from .sources import make_source
 
 logger = logging.getLogger(__name__)
 
@@ -13,37 +17,45 @@ class MarketDataService:
     """Service for fetching market data from Newton"""
     
     def __init__(self):
-        self.session = None
+        self.source = make_source()
         self.price_history = PriceHistory()
+        self.price_window = PriceWindowCache()
+        self._window_rebuild = None
+        self._compaction = None
         self.supported_pairs = {f"{asset}_CAD" for asset in settings.SUPPORTED_ASSETS}
-        logger.info(f"MarketDataService initialized with {len(self.supported_pairs)} supported pairs")
+        logger.info("MarketDataService initialized with %s supported pairs", len(self.supported_pairs))
 
     async def get_session(self) -> aiohttp.ClientSession:
-        """Get or create aiohttp session"""
-        if self.session is None or self.session.closed:
-            logger.debug("Creating new aiohttp session")
-            self.session = aiohttp.ClientSession()
-        return self.session
-
-    async def fetch_newton_data(self) -> list:
-        """Fetch market data from Newton API"""
+        """Get or create the live source's aiohttp session"""
+        return await self.source.get_session()
+
+    async def fetch_newton_data(self):
+        """Fetch market data from Newton API, None when it has not changed since the last fetch"""
         start_time = time.time()
         try:
             logger.debug("Fetching data from Newton API")
-            session = await self.get_session()
-            async with session.get(settings.NEWTON_API_URL) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logger.info(f"Successfully fetched Newton data in {time.time() - start_time:.2f}s")
-                    logger.debug(f"Raw Newton data: {json.dumps(data)[:200]}...")
-                    return data
-                else:
-                    logger.error(f"Newton API error: Status {response.status}")
-                    return []
+            data = await self.source.fetch()
+        except CircuitOpenError as e:
+            logger.warning("Skipping Newton fetch: %s", e)
+            return []
+        except UpstreamError as e:
+            logger.error("Newton API error: %s", e)
+            return []
         except Exception as e:
-            logger.exception(f"Error fetching Newton data: {str(e)}")
+            logger.exception("Error fetching Newton data: %s", e)
             return []
 
+        if data is None:
+            logger.debug("Newton data unchanged")
+            return None
+        logger.info("Successfully fetched Newton data in %.2fs", time.time() - start_time)
+        logger.debug("Raw Newton data: %.200s...", data)
+        return data
+
+    def next_poll_interval(self) -> float:
+        """Seconds until the next upstream poll, adapted to data changes and errors"""
+        return self.source.next_interval()
+
     def format_market_data(self, newton_data: list) -> dict:
         """Format market data according to requirements"""
         start_time = time.time()
@@ -51,18 +63,15 @@ class MarketDataService:
         processed_count = 0
         error_count = 0
         
-        logger.debug(f"Starting to format {len(newton_data)} market data entries")
+        logger.debug("Starting to format %s market data entries", len(newton_data))
         
         for item in newton_data:
             symbol = item.get('symbol')
             if symbol not in self.supported_pairs:
-                logger.debug(f"Skipping unsupported symbol: {symbol}")
+                logger.debug("Skipping unsupported symbol: %s", symbol, extra={"rate_key": symbol})
                 continue
 
             try:
-                # Store historical data for change calculation
-                self.price_history.store_price(symbol, item)
-                
                 bid = float(item['bid'])
                 ask = float(item['ask'])
                 spot = (bid + ask) / 2
@@ -76,16 +85,62 @@ class MarketDataService:
                     "change": float(item['change'])
                 }
                 processed_count += 1
-                logger.debug(f"Processed {symbol}: bid={bid}, ask={ask}, spot={spot}")
+                logger.debug("Processed %s: bid=%s, ask=%s, spot=%s", symbol, bid, ask, spot, extra={"rate_key": symbol})
                 
-            except (KeyError, ValueError) as e:
+            except (KeyError, ValueError, TypeError) as e:
                 error_count += 1
-                logger.error(f"Error formatting {symbol} data: {str(e)}")
+                logger.warning("Error formatting %s data: %s", symbol, e, extra={"rate_key": symbol})
                 continue
 
-        logger.info(f"Formatted {processed_count} entries with {error_count} errors in {time.time() - start_time:.2f}s")
+        logger.info("Formatted %s entries with %s errors in %.2fs", processed_count, error_count, time.time() - start_time)
         return formatted_data
 
+    async def store_history(self, newton_data: list):
+        """Store historical data for change calculation"""
+        start_time = time.time()
+        items = [
+            item for item in newton_data
+            if item.get('symbol') in self.supported_pairs and 'timestamp' in item
+        ]
+        try:
+            stored_count = await self.price_history.store_tick(items)
+            logger.info("Stored history for %s of %s entries in %.2fs", stored_count, len(items), time.time() - start_time)
+        except Exception as e:
+            # History is best effort, a failed write must never keep a formatted tick from being published
+            logger.error("Error storing market data history: %s", e)
+        if self.price_history.compaction_due(start_time):
+            self.start_compaction()
+
+    def start_compaction(self):
+        """Roll aged history down the retention tiers in the background"""
+        if self._compaction is None or self._compaction.done():
+            self._compaction = asyncio.create_task(self.compact_history())
+        return self._compaction
+
+    async def compact_history(self):
+        try:
+            await self.price_history.compact(sorted(self.supported_pairs))
+        except redis.RedisError as e:
+            logger.error("Error compacting market data history: %s", e)
+
+    def start_window_rebuild(self):
+        """Reload the in-memory price windows from Redis in the background"""
+        if self._window_rebuild is None or self._window_rebuild.done():
+            self._window_rebuild = asyncio.create_task(
+                self.price_window.rebuild(self.price_history, sorted(self.supported_pairs))
+            )
+        return self._window_rebuild
+
+    def apply_price_window(self, market_data: dict):
+        """Record the tick in the price windows and optionally compute change locally"""
+        window = settings.PRICE_CHANGE_WINDOW
+        for symbol, quote in market_data.items():
+            if window:
+                change = self.price_window.change(symbol, window, quote['spot'], now=quote['timestamp'])
+                if change is not None:
+                    quote['change'] = change
+            self.price_window.record(symbol, quote['timestamp'], quote['spot'])
+
     def get_formatted_response(self, market_data: dict) -> dict:
         """Format the final WebSocket response"""
         if not market_data:
@@ -97,30 +152,47 @@ class MarketDataService:
             "event": "data",
             "data": market_data
         }
-        logger.debug(f"Formatted response with {len(market_data)} symbols")
+        logger.debug("Formatted response with %s symbols", len(market_data))
         return response
 
-    async def get_market_data(self) -> dict:
-        """Get formatted market data"""
+    async def get_market_data(self):
+        """Get formatted market data, None when upstream has not changed"""
         start_time = time.time()
         logger.info("Starting market data fetch and format cycle")
         
         newton_data = await self.fetch_newton_data()
+        if newton_data is None:
+            # Same body as last time, nothing to format or publish
+            return None
         if not newton_data:
             logger.error("No data received from Newton API")
             return {}
             
-        market_data = self.format_market_data(newton_data)
+        with format_seconds.time():
+            market_data = self.format_market_data(newton_data)
+        self.apply_price_window(market_data)
+        await self.store_history(newton_data)
         response = self.get_formatted_response(market_data)
         
-        logger.info(f"Completed market data cycle in {time.time() - start_time:.2f}s")
+        logger.info("Completed market data cycle in %.2fs", time.time() - start_time)
         return response
 
     async def close(self):
         """Close the aiohttp session"""
-        if self.session and not self.session.closed:
-            logger.info("Closing aiohttp session")
-            await self.session.close()
+        if self._window_rebuild is not None and not self._window_rebuild.done():
+            self.price_window.stop_rebuild()
+            self._window_rebuild.cancel()
+            try:
+                await self._window_rebuild
+            except asyncio.CancelledError:
+                pass
+        if self._compaction is not None and not self._compaction.done():
+            self._compaction.cancel()
+            try:
+                await self._compaction
+            except asyncio.CancelledError:
+                pass
+        await self.source.close()
 
     async def __aenter__(self):
         return self
@@ -0,0 +1,148 @@
+import json
+import logging
+import mmap
+import os
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .encoding import encode_snapshot, read_snapshot_header, decode_snapshot_body
+from .upstream import MarketDataSource, UpstreamClient, UpstreamError, get_http_session
+
+logger = logging.getLogger(__name__)
+
+SOURCE_MODES = ("live", "record", "replay")
+
+
+class RecordingSource(MarketDataSource):
+    """Live source that appends every changed raw body to a snapshot log as it passes through"""
+
+    def __init__(self, upstream: UpstreamClient, path: str):
+        self.upstream = upstream
+        self.path = path
+        self.recorded = 0
+        self._file = None
+
+    async def fetch(self):
+        data = await self.upstream.fetch()
+        if data is not None:
+            self.record(self.upstream.body)
+        return data
+
+    def record(self, body: bytes):
+        if self._file is None:
+            logger.info("Recording upstream snapshots to %s", self.path)
+            self._file = open(self.path, "ab")
+        # One compressed snapshot per tick, small enough to write from the event loop;
+        # flushing keeps the log readable up to the last tick if the process dies
+        self._file.write(encode_snapshot(time.time(), body))
+        self._file.flush()
+        self.recorded += 1
+
+    def next_interval(self) -> float:
+        return self.upstream.next_interval()
+
+    async def get_session(self):
+        return await self.upstream.get_session()
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info("Recorded %s snapshots to %s", self.recorded, self.path)
+        await self.upstream.close()
+
+
+class ReplaySource(MarketDataSource):
+    """Plays a snapshot log back through a memory map at `speed` times the recorded pace
+
+    Pacing is measured from the first replayed record, so time spent handling
+    each tick does not add up to drift. A speed of 0 replays as fast as the
+    consumer fetches. At the end of the log it starts over when `loop` is set,
+    and otherwise reports every later fetch as unchanged.
+    """
+
+    aligned = False
+
+    def __init__(self, path: str, speed: float = 1.0, loop: bool = False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.replayed = 0
+        self.finished = False
+        self._file = None
+        self._map = None
+        self._offset = 0
+        self._started = None
+
+    def open(self):
+        try:
+            self._file = open(self.path, "rb")
+            if os.fstat(self._file.fileno()).st_size == 0:
+                raise UpstreamError(f"Snapshot log {self.path} is empty")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            raise UpstreamError(f"Cannot open snapshot log {self.path}: {e}") from e
+        logger.info("Replaying %s bytes of snapshots from %s at %sx", len(self._map), self.path, self.speed or "max")
+
+    def next_record(self):
+        header = read_snapshot_header(self._map, self._offset)
+        if header is None and self.loop and self._offset:
+            logger.info("Reached the end of %s after %s snapshots, starting over", self.path, self.replayed)
+            self._offset = 0
+            self._started = None
+            header = read_snapshot_header(self._map, self._offset)
+        return header
+
+    async def fetch(self):
+        if self._map is None:
+            self.open()
+        if self.finished:
+            return None
+        try:
+            header = self.next_record()
+            if header is None:
+                self.finished = True
+                logger.info("Finished replaying %s snapshots from %s", self.replayed, self.path)
+                return None
+            received_at, start, end = header
+            data = json.loads(decode_snapshot_body(self._map, start, end))
+        except ValueError as e:
+            raise UpstreamError(f"Corrupt snapshot log {self.path} at offset {self._offset}: {e}") from e
+        if self._started is None:
+            self._started = (received_at, time.monotonic())
+        self._offset = end
+        self.replayed += 1
+        return data
+
+    def next_interval(self) -> float:
+        if self._map is None or self.finished:
+            return settings.MARKET_DATA_POLL_INTERVAL
+        if not self.speed or self._started is None:
+            return 0.0
+        header = read_snapshot_header(self._map, self._offset)
+        if header is None:
+            return 0.0
+        recorded_start, wall_start = self._started
+        due = wall_start + (header[0] - recorded_start) / self.speed
+        return max(0.0, due - time.monotonic())
+
+    async def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def make_source() -> MarketDataSource:
+    """Source selected by settings.MARKET_DATA_SOURCE"""
+    mode = settings.MARKET_DATA_SOURCE
+    if mode not in SOURCE_MODES:
+        raise ImproperlyConfigured(f"MARKET_DATA_SOURCE must be one of {', '.join(SOURCE_MODES)}, not {mode!r}")
+    if mode == "replay":
+        return ReplaySource(settings.MARKET_DATA_LOG, settings.MARKET_DATA_REPLAY_SPEED, settings.MARKET_DATA_REPLAY_LOOP)
+    upstream = UpstreamClient(settings.NEWTON_API_URL, session_factory=get_http_session)
+    if mode == "record":
+        return RecordingSource(upstream, settings.MARKET_DATA_LOG)
+    return upstream
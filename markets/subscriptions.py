@@ -0,0 +1,56 @@
+import logging
+from collections import defaultdict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_PAIRS = frozenset(f"{asset}_CAD" for asset in settings.SUPPORTED_ASSETS)
+
+
+class SymbolIndex:
+    """Inverted index from symbol to the consumer channels that want it"""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._symbols = defaultdict(set)
+
+    def subscribe(self, channel_name: str, symbols) -> set:
+        """Add symbols for a channel, returns the ones that were newly added"""
+        added = set(symbols) - self._symbols[channel_name]
+        for symbol in added:
+            self._subscribers[symbol].add(channel_name)
+        self._symbols[channel_name] |= added
+        return added
+
+    def unsubscribe(self, channel_name: str, symbols=None) -> set:
+        """Remove some (or all) symbols for a channel, returns what it still watches"""
+        current = self._symbols.get(channel_name, set())
+        removed = current if symbols is None else current & set(symbols)
+        for symbol in removed:
+            subscribers = self._subscribers[symbol]
+            subscribers.discard(channel_name)
+            if not subscribers:
+                del self._subscribers[symbol]
+        remaining = current - removed
+        if remaining:
+            self._symbols[channel_name] = remaining
+        else:
+            self._symbols.pop(channel_name, None)
+        return remaining
+
+    def symbols_for(self, channel_name: str) -> set:
+        return set(self._symbols.get(channel_name, ()))
+
+    def subscribers(self, symbol: str) -> set:
+        return self._subscribers.get(symbol, set())
+
+    def route(self, symbols) -> dict:
+        """Group changed symbols by interested channel, touching only symbols someone watches"""
+        routes = defaultdict(list)
+        for symbol in symbols:
+            for channel_name in self._subscribers.get(symbol, ()):
+                routes[channel_name].append(symbol)
+        return routes
+
+    def __len__(self) -> int:
+        return len(self._symbols)
@@ -1,22 +1,99 @@
 import pytest
+import pytest_asyncio
 from channels.testing import WebsocketCommunicator
 from channels.routing import URLRouter
 from channels.auth import AuthMiddlewareStack
 import json
+import math
 import asyncio
 from django.test import TestCase
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from unittest.mock import AsyncMock
+import fakeredis
+import fakeredis.aioredis
 from .routing import websocket_urlpatterns
 from .services import MarketDataService
+from .producer import MarketDataProducer
+from .leader import LeaderElection
+from .models import PriceHistory, get_redis_client
+from .frames import Frame, compose_frame, encode_fragment
+from .subscriptions import SymbolIndex
+from .outbox import Outbox
+from .consumers import MarketConsumer
+from .candles import CandleAggregator
+from .indicators import IndicatorEngine, RollingWindow
+from .models import CandleStore
+from .history import history_cache, parse_history_params, query_history
+from django.test import AsyncClient
+from .metrics import Histogram, Gauge
+from .log import DroppingQueueHandler, RateLimitFilter, start_background_logging
+from . import metrics
+from .upstream import UpstreamClient, UpstreamError, CircuitOpenError, CircuitBreaker, get_http_session
+from .resources import WarmUpMiddleware, close_resources, ensure_warm
+from .heartbeat import Heartbeat
+from .scheduler import TickScheduler
+from types import SimpleNamespace
+from channels.layers import get_channel_layer
+from .sources import RecordingSource, ReplaySource, make_source
+from .encoding import encode_snapshot
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from .window import RingBuffer, PriceWindow, PriceWindowCache, FINE_SPAN
+from . import frames
+from .encoding import encode_price, decode_price, decode_prices, is_legacy, PRICE_RECORD_V1
 import os
+import time
+import zlib
+import logging
+import queue
+import msgpack
 
 # Mark all test classes with django_db to allow database access
 pytestmark = pytest.mark.django_db
 
+SAMPLE_TIMESTAMP = int(time.time())
+SAMPLE_NEWTON_DATA = [
+    {"symbol": "BTC_CAD", "bid": "50000.0", "ask": "50100.0", "change": "1.5", "timestamp": SAMPLE_TIMESTAMP},
+    {"symbol": "ETH_CAD", "bid": "3000.0", "ask": "3010.0", "change": "-0.5", "timestamp": SAMPLE_TIMESTAMP},
+    {"symbol": "NOPE_CAD", "bid": "1.0", "ask": "1.1", "change": "0.0", "timestamp": SAMPLE_TIMESTAMP},
+]
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    # Swap the shared Redis client for an in-process fake so tests do not need redis-server
+    client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+    monkeypatch.setattr("markets.models.get_redis_client", lambda: client)
+    monkeypatch.setattr("markets.leader.get_redis_client", lambda: client)
+    monkeypatch.setattr("markets.resources.get_redis_client", lambda: client)
+    # Cached history pages would belong to another test's data
+    history_cache.clear()
+    return client
+
+
+@pytest_asyncio.fixture
+async def producer(monkeypatch):
+    # A fresh process-wide producer per test so sequence numbers and state do not leak
+    producer = MarketDataProducer()
+    monkeypatch.setattr("markets.consumers.market_data_producer", producer)
+    yield producer
+    # The service outlives its subscribers, so stop its window rebuild with the test
+    await producer.close()
+
+
+@pytest.fixture
+def mock_upstream(monkeypatch, fake_redis, producer, settings):
+    # Replace the Newton HTTP call with canned data and speed up the poll loop
+    settings.MARKET_DATA_POLL_INTERVAL = 0.05
+    fetch = AsyncMock(return_value=SAMPLE_NEWTON_DATA)
+    monkeypatch.setattr(MarketDataService, "fetch_newton_data", fetch)
+    return fetch
+
 @pytest.mark.asyncio
 class TestWebSocket:
     # UNIT TESTS:
-    async def test_invalid_json(self):
+    async def test_invalid_json(self, caplog):
         # Unit test - tests JSON validation in isolation
         communicator = await self.setup_communicator()
         
@@ -25,6 +102,9 @@ class TestWebSocket:
         
         assert response["event"] == "error"
         assert response["message"] == "Invalid JSON format"
+        # Clients can send this at will, so it is a rate-limited warning rather than an error
+        record = next(record for record in caplog.records if record.msg.startswith("Client %s sent invalid JSON"))
+        assert record.levelno == logging.WARNING and record.rate_key
         
         await communicator.disconnect()
 
@@ -195,4 +275,1644 @@ class TestWebSocket:
         communicator = WebsocketCommunicator(application, "/markets/ws/")
         connected, _ = await communicator.connect()
         assert connected
-        return communicator
\ No newline at end of file
+        return communicator
+
+
+@pytest.mark.asyncio
+class TestSharedProducer:
+    async def test_subscription_with_mocked_upstream(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        response = await communicator.receive_json_from(timeout=2)
+
+        assert response["channel"] == "rates"
+        assert response["event"] == "data"
+        assert set(response["data"]) == {"BTC_CAD", "ETH_CAD"}
+        assert response["data"]["BTC_CAD"]["spot"] == 50050.0
+        assert response["as_of"] == pytest.approx(time.time(), abs=2)
+
+        await communicator.disconnect()
+
+    async def test_subscribe_gets_last_known_snapshot_without_fetching(self, mock_upstream, producer):
+        # State left by an earlier tick; upstream reports nothing new from here on
+        producer.apply_tick(MarketDataService().format_market_data(SAMPLE_NEWTON_DATA))
+        producer.confirm(1000.0)
+        mock_upstream.return_value = None
+        full, delta = await setup_communicator(), await setup_communicator()
+
+        await full.send_json_to({"event": "subscribe", "channel": "rates"})
+        first = await full.receive_json_from(timeout=0.5)
+        await delta.send_json_to({"event": "subscribe", "channel": "rates", "mode": "delta"})
+        snapshot = await delta.receive_json_from(timeout=0.5)
+
+        assert first["event"] == "data" and snapshot["event"] == "snapshot"
+        assert first["as_of"] == 1000.0
+        # By then the producer had polled, and "unchanged" still confirms the state as current
+        assert snapshot["as_of"] >= 1000.0
+        assert set(first["data"]) == set(snapshot["data"]) == {"BTC_CAD", "ETH_CAD"}
+
+        await full.disconnect()
+        await delta.disconnect()
+
+    async def test_single_upstream_fetch_for_many_clients(self, mock_upstream, producer):
+        communicators = [await setup_communicator() for _ in range(5)]
+
+        for communicator in communicators:
+            await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+
+        first_ticks = [await communicator.receive_json_from(timeout=2) for communicator in communicators]
+        assert all(r["channel"] == "rates" for r in first_ticks)
+        # One fetch per tick regardless of how many clients are listening
+        assert mock_upstream.await_count <= producer.tick_count + 1
+        assert producer.subscriber_count == 5
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        assert producer.subscriber_count == 0
+        assert not producer.is_running()
+
+    async def test_frame_encoded_once_for_all_subscribers(self, mock_upstream, producer):
+        communicators = [await setup_communicator() for _ in range(3)]
+
+        for communicator in communicators:
+            await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        texts = [(await communicator.receive_output(timeout=2))["text"] for communicator in communicators]
+
+        # Every subscriber was handed the very same encoded string
+        assert all(text is texts[0] for text in texts)
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_delta_mode_sends_snapshot_then_moved_symbols(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "mode": "delta"})
+        snapshot = await communicator.receive_json_from(timeout=2)
+        assert snapshot["event"] == "snapshot"
+        assert set(snapshot["data"]) == {"BTC_CAD", "ETH_CAD"}
+
+        moved = [dict(SAMPLE_NEWTON_DATA[0], bid="50200.0")] + SAMPLE_NEWTON_DATA[1:]
+        mock_upstream.return_value = moved
+        delta = await communicator.receive_json_from(timeout=2)
+
+        assert delta["event"] == "delta"
+        assert delta["seq"] == snapshot["seq"] + 1
+        assert set(delta["data"]) == {"BTC_CAD"}
+        assert delta["data"]["BTC_CAD"]["bid"] == 50200.0
+
+        await communicator.disconnect()
+
+    async def test_delta_mode_snapshot_from_running_producer(self, mock_upstream, producer):
+        full = await setup_communicator()
+        await full.send_json_to({"event": "subscribe", "channel": "rates"})
+        await full.receive_json_from(timeout=2)
+
+        late = await setup_communicator()
+        await late.send_json_to({"event": "subscribe", "channel": "rates", "mode": "delta"})
+        snapshot = await late.receive_json_from(timeout=2)
+        assert snapshot["event"] == "snapshot"
+        assert snapshot["seq"] == producer.seq
+
+        # Unchanged quotes produce no delta traffic while full-mode clients keep ticking
+        await full.receive_json_from(timeout=2)
+        assert await late.receive_nothing(timeout=0.2)
+
+        await full.disconnect()
+        await late.disconnect()
+
+    async def test_invalid_subscription_mode(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "mode": "bogus"})
+        response = await communicator.receive_json_from()
+        assert response == {"event": "error", "message": "Invalid subscription mode"}
+
+        await communicator.disconnect()
+
+    async def test_duplicate_subscribe_does_not_stack(self, mock_upstream, producer):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        await communicator.receive_json_from(timeout=2)
+
+        assert producer.subscriber_count == 1
+
+        await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+class TestLeaderElection:
+    async def test_single_leader(self, fake_redis):
+        first, second = LeaderElection(key="test:leader", ttl=5), LeaderElection(key="test:leader", ttl=5)
+
+        assert await first.campaign()
+        assert not await second.campaign()
+        # Renewing keeps the lock
+        assert await first.campaign()
+
+        await first.resign()
+        assert await second.campaign()
+        await second.resign()
+
+    async def test_failover_when_leader_stops_renewing(self, fake_redis):
+        first, second = LeaderElection(key="test:leader", ttl=0.1), LeaderElection(key="test:leader", ttl=0.1)
+        assert await first.campaign()
+
+        await asyncio.sleep(0.15)
+        assert await second.campaign()
+        # The old leader notices on its next renewal and does not steal the lock back
+        assert not await first.campaign()
+        assert await fake_redis.get("test:leader") == second.token.encode()
+
+    async def test_only_leader_polls_and_follower_mirrors(self, mock_upstream):
+        leader = MarketDataProducer(election=LeaderElection(key="test:leader", ttl=0.3))
+        follower = MarketDataProducer(election=LeaderElection(key="test:leader", ttl=0.3))
+        # Upstream reports "unchanged" until both are running, so the follower sees the first tick
+        mock_upstream.return_value = None
+        await leader.add_subscriber()
+        for _ in range(20):
+            await asyncio.sleep(0.05)
+            if leader.is_leader:
+                break
+        await follower.add_subscriber()
+        await asyncio.sleep(0.05)
+        mock_upstream.return_value = SAMPLE_NEWTON_DATA
+
+        for _ in range(40):
+            await asyncio.sleep(0.05)
+            if follower.seq:
+                break
+        assert leader.is_leader and not follower.is_leader
+        assert follower.market_service is None
+        assert follower.seq == leader.seq
+        assert follower.last_data == leader.last_data
+        snapshots = [dict(producer.snapshot_frame().payload, as_of=None) for producer in (leader, follower)]
+        assert snapshots[0] == snapshots[1]
+        # Ticks that move nothing still carry the leader's as_of over
+        as_of = follower.as_of
+        await asyncio.sleep(0.2)
+        assert follower.as_of > as_of
+        assert follower.as_of == pytest.approx(leader.as_of, abs=0.1)
+        # Day bars, so a minute boundary passing mid-test cannot close one side's bars first
+        assert follower.candles_frame(["1d"]).text == leader.candles_frame(["1d"]).text
+
+        # The follower takes over polling once the leader steps down
+        await leader.remove_subscriber()
+        for _ in range(40):
+            await asyncio.sleep(0.05)
+            if follower.tick_count:
+                break
+        assert follower.is_leader
+        assert follower.tick_count > 0
+
+        await follower.remove_subscriber()
+        assert not follower.is_leader
+        await leader.close()
+        await follower.close()
+
+
+    async def test_late_follower_gets_full_state(self, mock_upstream):
+        leader = MarketDataProducer(election=LeaderElection(key="test:leader", ttl=0.3))
+        follower = MarketDataProducer(election=LeaderElection(key="test:leader", ttl=0.3))
+        await leader.add_subscriber()
+        for _ in range(40):
+            await asyncio.sleep(0.05)
+            if leader.last_data:
+                break
+        assert leader.is_leader and set(leader.last_data) == {"BTC_CAD", "ETH_CAD"}
+
+        # Left over from an earlier leader: a higher seq must not hide the current one's state
+        follower.seq = 10 ** 15
+        await follower.add_subscriber()
+        for _ in range(20):
+            await asyncio.sleep(0.05)
+            if follower.last_data:
+                break
+        # Upstream has not moved since, so all of this came from the bootstrap
+        assert follower.last_data == leader.last_data
+        assert follower.seq == leader.seq
+        assert follower.leader_epoch == leader.election.token
+
+        await follower.close()
+        await leader.close()
+
+    async def test_follower_rejoins_sync_group_before_it_expires(self, mock_upstream, settings, monkeypatch):
+        settings.PRODUCER_SYNC_REJOIN = 0.1
+        monkeypatch.setattr(get_channel_layer(), "group_expiry", 1)
+        leader = MarketDataProducer(election=LeaderElection(key="test:leader", ttl=0.3))
+        follower = MarketDataProducer(election=LeaderElection(key="test:leader", ttl=0.3))
+        mock_upstream.return_value = None
+        await leader.add_subscriber()
+        for _ in range(20):
+            await asyncio.sleep(0.05)
+            if leader.is_leader:
+                break
+        await follower.add_subscriber()
+
+        # Outlive the group expiry, then move a price
+        await asyncio.sleep(2.2)
+        mock_upstream.return_value = SAMPLE_NEWTON_DATA
+        for _ in range(40):
+            await asyncio.sleep(0.05)
+            if follower.seq:
+                break
+        assert leader.seq and follower.seq == leader.seq
+
+        await follower.close()
+        await leader.close()
+
+@pytest.mark.asyncio
+class TestSymbolSubscriptions:
+    async def test_symbol_subscription_receives_only_watched_symbols(self, mock_upstream, producer):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "symbols": ["ETH_CAD"]})
+        first = await communicator.receive_json_from(timeout=2)
+        assert set(first["data"]) == {"ETH_CAD"}
+
+        # BTC moves but this client only watches ETH, so nothing is sent
+        mock_upstream.return_value = [dict(SAMPLE_NEWTON_DATA[0], bid="1.0")] + SAMPLE_NEWTON_DATA[1:]
+        assert await communicator.receive_nothing(timeout=0.3)
+
+        mock_upstream.return_value = [SAMPLE_NEWTON_DATA[0], dict(SAMPLE_NEWTON_DATA[1], ask="3020.0")]
+        delta = await communicator.receive_json_from(timeout=2)
+        assert delta["event"] == "delta"
+        assert delta["data"] == {"ETH_CAD": {
+            "symbol": "ETH_CAD", "timestamp": SAMPLE_TIMESTAMP,
+            "bid": 3000.0, "ask": 3020.0, "spot": 3010.0, "change": -0.5,
+        }}
+
+        await communicator.disconnect()
+        assert len(producer.index) == 0
+
+    async def test_symbol_snapshot_and_unsubscribe(self, mock_upstream, producer):
+        watcher = await setup_communicator()
+        await watcher.send_json_to({"event": "subscribe", "channel": "rates"})
+        await watcher.receive_json_from(timeout=2)
+
+        communicator = await setup_communicator()
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "symbols": ["BTC_CAD", "ETH_CAD"]})
+        snapshot = await communicator.receive_json_from(timeout=2)
+        assert snapshot["event"] == "snapshot"
+        assert set(snapshot["data"]) == {"BTC_CAD", "ETH_CAD"}
+
+        await communicator.send_json_to({"event": "unsubscribe", "channel": "rates", "symbols": ["BTC_CAD"]})
+        assert await communicator.receive_json_from(timeout=2) == {
+            "event": "unsubscribed", "channel": "rates", "symbols": ["ETH_CAD"]
+        }
+        assert producer.index.subscribers("BTC_CAD") == set()
+
+        await communicator.send_json_to({"event": "unsubscribe", "channel": "rates"})
+        assert (await communicator.receive_json_from(timeout=2))["symbols"] == []
+        assert producer.subscriber_count == 1
+
+        await communicator.disconnect()
+        await watcher.disconnect()
+
+    async def test_adding_symbols_keeps_pending_deltas(self, producer):
+        producer.apply_tick(MarketDataService().format_market_data(SAMPLE_NEWTON_DATA))
+        consumer = MarketConsumer()
+        consumer.channel_name = "client"
+        consumer.format = "json"
+        consumer.group = None
+        consumer.symbols = set()
+        consumer.intervals = set()
+        consumer.indicators = False
+        consumer.registered = ("json", None)
+        socket = BlockingSocket()
+        consumer.outbox = Outbox(socket, resync=consumer.resync_frames)
+
+        await consumer.handle_symbol_subscription({"BTC_CAD"})
+        await asyncio.sleep(0)
+        # The client lags while BTC keeps moving, then adds ETH
+        consumer.outbox.put(2, "btc@2")
+        consumer.outbox.put(3, "btc@3")
+        await consumer.handle_symbol_subscription({"ETH_CAD"})
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+
+        assert set(json.loads(socket.sent[0])["data"]) == {"BTC_CAD"}
+        assert socket.sent[1:3] == ["btc@2", "btc@3"]
+        assert set(json.loads(socket.sent[3])["data"]) == {"ETH_CAD"}
+        await consumer.outbox.close()
+
+    async def test_overflow_resyncs_every_stream(self, producer):
+        delta = producer.apply_tick(MarketDataService().format_market_data(SAMPLE_NEWTON_DATA))
+        producer.candles.update_tick(delta, SAMPLE_TIMESTAMP)
+        producer.indicators.update_tick(delta)
+        consumer = MarketConsumer()
+        consumer.format = "json"
+        consumer.group = None
+        consumer.symbols = {"BTC_CAD"}
+        consumer.intervals = {"1m"}
+        consumer.indicators = True
+        socket = BlockingSocket()
+        consumer.outbox = Outbox(socket, resync=consumer.resync_frames, max_size=2)
+        # Ticks the client fell behind on
+        producer.seq = 5
+
+        for seq in range(2, 6):
+            consumer.outbox.put(seq, f"btc@{seq}")
+            await asyncio.sleep(0)
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+
+        assert socket.sent[0] == "btc@2"
+        resynced = [json.loads(text) for text in socket.sent[1:]]
+        assert [(frame["channel"], frame["event"]) for frame in resynced] == [
+            ("rates", "snapshot"), ("candles", "snapshot"), ("indicators", "snapshot"),
+        ]
+        assert set(resynced[0]["data"]) == {"BTC_CAD"}
+        await consumer.outbox.close()
+
+    async def test_unsubscribing_symbols_from_full_stream_rejected(self, mock_upstream, producer):
+        communicator = await setup_communicator()
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        await communicator.receive_json_from(timeout=2)
+
+        await communicator.send_json_to({"event": "unsubscribe", "channel": "rates", "symbols": ["BTC_CAD"]})
+        assert await communicator.receive_json_from(timeout=2) == {
+            "event": "error", "message": "Subscribed to all symbols, subscribe to the ones to keep instead"
+        }
+        assert producer.subscriber_count == 1
+
+        await communicator.disconnect()
+
+    async def test_unsupported_symbols_rejected(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "symbols": ["BTC_CAD", "NOPE_CAD"]})
+        response = await communicator.receive_json_from()
+        assert response == {"event": "error", "message": "Unsupported symbols: NOPE_CAD"}
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "symbols": "BTC_CAD"})
+        response = await communicator.receive_json_from()
+        assert response == {"event": "error", "message": "Invalid symbols list"}
+
+        await communicator.disconnect()
+
+    async def test_symbol_index_routes_only_interested_channels(self):
+        index = SymbolIndex()
+        index.subscribe("a", ["BTC_CAD", "ETH_CAD"])
+        index.subscribe("b", ["ETH_CAD"])
+
+        assert index.route(["ETH_CAD", "XRP_CAD"]) == {"a": ["ETH_CAD"], "b": ["ETH_CAD"]}
+        assert index.unsubscribe("a", ["ETH_CAD"]) == {"BTC_CAD"}
+        assert index.route(["ETH_CAD"]) == {"b": ["ETH_CAD"]}
+        assert index.unsubscribe("b") == set()
+        assert len(index) == 1
+
+
+@pytest.mark.asyncio
+class TestPriceHistory:
+    async def test_store_and_get_previous_price(self, fake_redis):
+        history = PriceHistory()
+        item = dict(SAMPLE_NEWTON_DATA[0], timestamp=int(time.time()) - 60)
+
+        await history.store_price("BTC_CAD", item)
+        previous = await history.get_previous_price("BTC_CAD", window=3600)
+
+        assert previous == {
+            "symbol": "BTC_CAD", "timestamp": item["timestamp"],
+            "bid": 50000.0, "ask": 50100.0, "change": 1.5,
+        }
+
+    async def test_missing_previous_price(self, fake_redis):
+        history = PriceHistory()
+        assert await history.get_previous_price("ETH_CAD", window=3600) is None
+
+    async def test_shared_client_per_event_loop(self):
+        # Creating the client does no I/O, so this runs without a Redis server
+        assert get_redis_client() is get_redis_client()
+        assert PriceHistory().redis_client is PriceHistory().redis_client
+
+    async def test_store_tick_skips_unchanged_quotes(self, fake_redis):
+        history = PriceHistory()
+        items = SAMPLE_NEWTON_DATA[:2]
+
+        assert await history.store_tick(items) == 2
+        moved = [dict(items[0], bid="50001.0", timestamp=SAMPLE_TIMESTAMP + 1), dict(items[1], timestamp=SAMPLE_TIMESTAMP + 1)]
+        assert await history.store_tick(moved) == 1
+
+        assert await fake_redis.zcard("price_history:BTC_CAD") == 2
+        assert await fake_redis.zcard("price_history:ETH_CAD") == 1
+
+    async def test_unencodable_quote_skipped(self, fake_redis):
+        history = PriceHistory()
+        # Past the record's uint32 timestamp
+        unencodable = dict(SAMPLE_NEWTON_DATA[0], timestamp=2 ** 32)
+
+        assert await history.store_tick([unencodable, SAMPLE_NEWTON_DATA[1]]) == 1
+        assert await fake_redis.exists("price_history:BTC_CAD") == 0
+        assert await fake_redis.zcard("price_history:ETH_CAD") == 1
+
+    async def test_failed_history_write_still_publishes(self, mock_upstream, monkeypatch):
+        monkeypatch.setattr(PriceHistory, "store_tick", AsyncMock(side_effect=RuntimeError("boom")))
+        response = await MarketDataService().get_market_data()
+        assert set(response["data"]) == {"BTC_CAD", "ETH_CAD"}
+
+    async def test_compaction_rolls_ticks_into_tiers(self, fake_redis, monkeypatch):
+        history = PriceHistory()
+        now = 1_700_006_400  # a whole day, so every tier boundary falls on it
+        day = 24 * 60 * 60
+        # Two ticks per minute, 8 and 2 days back, plus one recent tick that stays raw
+        ticks = [now - 8 * day + offset for offset in (0, 30, 60, 90)]
+        ticks += [now - 2 * day + offset for offset in (0, 30, 60, 90)] + [now - 60]
+        await fake_redis.zadd("price_history:BTC_CAD", {
+            encode_price(dict(SAMPLE_NEWTON_DATA[0], bid=str(t), timestamp=t)): t for t in ticks
+        })
+
+        assert await history.compact(["BTC_CAD"], now=now, batch_size=3) == 10
+        assert await fake_redis.zcard("price_history:BTC_CAD") == 1
+        minutes = await history.get_price_range("BTC_CAD", now - 3 * day, now - day)
+        assert [p["timestamp"] for p in minutes] == [now - 2 * day + 30, now - 2 * day + 90]
+        # The 8-day-old ticks went through the 1m tier into a single hourly price
+        assert await fake_redis.zcard("price_history:1m:BTC_CAD") == 2
+        assert await fake_redis.zcard("price_history:1h:BTC_CAD") == 1
+
+        monkeypatch.setattr("markets.models.time", SimpleNamespace(time=lambda: now))
+        previous = await history.get_previous_price("BTC_CAD", window=9 * day)
+        assert previous["timestamp"] == now - 8 * day + 90
+        assert previous["bid"] == now - 8 * day + 90
+        prices = await history.get_price_range("BTC_CAD", 0, now)
+        assert [p["timestamp"] for p in prices] == [now - 8 * day + 90, now - 2 * day + 30, now - 2 * day + 90, now - 60]
+
+        # Nothing left to move, and the coarsest tier is trimmed to its retention
+        assert await history.compact(["BTC_CAD"], now=now + history.retention_seconds) == 4
+        assert await fake_redis.exists("price_history:1h:BTC_CAD") == 0
+
+    async def test_downsampled_history_reads_across_tiers(self, fake_redis):
+        history = PriceHistory()
+        old = SAMPLE_TIMESTAMP - 3 * 24 * 60 * 60
+        await fake_redis.zadd("price_history:1m:BTC_CAD", {encode_price(dict(SAMPLE_NEWTON_DATA[0], timestamp=old)): old})
+        await history.store_tick([SAMPLE_NEWTON_DATA[0]])
+
+        assert await history.get_last_prices("BTC_CAD", [(old - 60, old), (old, SAMPLE_TIMESTAMP)]) == [
+            decode_price(encode_price(SAMPLE_NEWTON_DATA[0]), "BTC_CAD") | {"timestamp": old},
+            decode_price(encode_price(SAMPLE_NEWTON_DATA[0]), "BTC_CAD"),
+        ]
+        page = await history.get_price_page("BTC_CAD", old, SAMPLE_TIMESTAMP, 1, 5)
+        assert [p["timestamp"] for p in page] == [SAMPLE_TIMESTAMP]
+
+    async def test_compact_encoding_round_trip(self):
+        item = SAMPLE_NEWTON_DATA[1]
+        record = encode_price(item)
+
+        assert len(record) < len(str(item)) / 3
+        assert decode_price(record, "ETH_CAD") == {
+            "symbol": "ETH_CAD", "timestamp": SAMPLE_TIMESTAMP,
+            "bid": 3000.0, "ask": 3010.0, "change": -0.5,
+        }
+        assert decode_prices([record, str(item).encode()], "ETH_CAD") == [decode_price(record, "ETH_CAD")] * 2
+
+    async def test_change_keeps_full_precision_and_v1_still_decodes(self):
+        item = dict(SAMPLE_NEWTON_DATA[0], change="1.23")
+        assert decode_price(encode_price(item), "BTC_CAD")["change"] == 1.23
+
+        v1 = PRICE_RECORD_V1.pack(1, SAMPLE_TIMESTAMP, 50000.0, 50100.0, 1.5)
+        expected = {"symbol": "BTC_CAD", "timestamp": SAMPLE_TIMESTAMP, "bid": 50000.0, "ask": 50100.0, "change": 1.5}
+        assert decode_price(v1, "BTC_CAD") == expected
+        assert decode_prices([v1, v1], "BTC_CAD") == [expected] * 2
+        assert decode_prices([v1, encode_price(item)], "BTC_CAD")[0] == expected
+
+    async def test_legacy_members_are_not_evaluated(self):
+        with pytest.raises(ValueError):
+            decode_price(b"{'bid': __import__('os').getcwd()}", "BTC_CAD")
+
+    async def test_migrate_legacy_entries(self, fake_redis):
+        history = PriceHistory()
+        legacy = [dict(SAMPLE_NEWTON_DATA[0], timestamp=SAMPLE_TIMESTAMP - i) for i in range(3)]
+        await fake_redis.zadd("price_history:BTC_CAD", {str(item): item["timestamp"] for item in legacy})
+
+        assert await history.migrate_legacy("BTC_CAD", batch_size=2) == 3
+        members = await fake_redis.zrange("price_history:BTC_CAD", 0, -1)
+        assert not any(is_legacy(member) for member in members)
+        prices = await history.get_price_range("BTC_CAD", SAMPLE_TIMESTAMP - 10, SAMPLE_TIMESTAMP)
+        assert [p["timestamp"] for p in prices] == [SAMPLE_TIMESTAMP - 2, SAMPLE_TIMESTAMP - 1, SAMPLE_TIMESTAMP]
+
+    async def test_market_data_cycle_stores_history(self, mock_upstream, fake_redis):
+        service = MarketDataService()
+        response = await service.get_market_data()
+
+        assert set(response["data"]) == {"BTC_CAD", "ETH_CAD"}
+        assert await fake_redis.zcard("price_history:BTC_CAD") == 1
+        assert await fake_redis.exists("price_history:NOPE_CAD") == 0
+
+
+class TestPriceWindow:
+    def test_ring_buffer_wraps_and_searches(self):
+        ring = RingBuffer(4)
+        for t in range(10):
+            ring.append(t, t * 10.0)
+
+        assert len(ring) == 4
+        assert ring.first() == (6, 60.0)
+        assert ring.at_or_before(7.5) == (7, 70.0)
+        assert ring.at_or_before(100) == (9, 90.0)
+        assert ring.at_or_before(5) is None
+
+    def test_price_ago_across_fine_and_coarse_windows(self):
+        cache = PriceWindowCache()
+        now = 1_000_000
+        # One tick every 10s for two days
+        for t in range(now - 2 * 24 * 60 * 60, now + 1, 10):
+            cache.record("BTC_CAD", t, float(t))
+
+        assert cache.price_ago("BTC_CAD", 35, now=now) == now - 40
+        # Older than the full-resolution span: minute buckets keep the last tick of each minute
+        day_ago = cache.price_ago("BTC_CAD", 24 * 60 * 60, now=now)
+        assert now - 24 * 60 * 60 - 60 <= day_ago <= now - 24 * 60 * 60
+        assert cache.price_ago("BTC_CAD", 7 * 24 * 60 * 60, now=now) is None
+        assert cache.change("BTC_CAD", 35, current=2.0 * (now - 40), now=now) == 100.0
+
+    def test_memory_is_bounded(self):
+        window = PriceWindow()
+        for t in range(FINE_SPAN * 3):
+            window.append(t, 1.0)
+        assert len(window.fine) == FINE_SPAN
+        assert len(window.coarse) == FINE_SPAN * 3 // 60
+
+
+@pytest.mark.asyncio
+class TestPriceWindowRebuild:
+    async def test_rebuild_from_redis_keeps_live_ticks(self, fake_redis):
+        history = PriceHistory()
+        now = int(time.time())
+        for ago in (7200, 3600, 60):
+            await history.store_price("BTC_CAD", dict(SAMPLE_NEWTON_DATA[0], bid=str(ago), ask=str(ago), timestamp=now - ago))
+
+        cache = PriceWindowCache()
+        cache.record("BTC_CAD", now, 5.0)
+        await cache.rebuild(history, ["BTC_CAD"], span=3 * 60 * 60)
+
+        assert cache.price_ago("BTC_CAD", 3600, now=now) == 3600.0
+        assert cache.price_ago("BTC_CAD", 7000, now=now) == 7200.0
+        assert cache.price_ago("BTC_CAD", 0, now=now) == 5.0
+
+    async def test_local_change_window(self, mock_upstream, settings):
+        settings.PRICE_CHANGE_WINDOW = 60
+        service = MarketDataService()
+        service.price_window.record("BTC_CAD", SAMPLE_TIMESTAMP - 60, 25025.0)
+
+        response = await service.get_market_data()
+
+        assert response["data"]["BTC_CAD"]["change"] == 100.0
+        # No history for ETH yet, so upstream's change is kept
+        assert response["data"]["ETH_CAD"]["change"] == -0.5
+
+
+class BlockingSocket:
+    """Send callable that stalls until released, standing in for a slow client link"""
+
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    async def __call__(self, text):
+        await self.gate.wait()
+        self.sent.append(text)
+
+
+@pytest.mark.asyncio
+class TestOutbox:
+    async def test_full_frames_are_latest_wins(self):
+        socket = BlockingSocket()
+        outbox = Outbox(socket, max_size=8)
+
+        for n in range(5):
+            outbox.put_latest(None, f"tick{n}")
+            await asyncio.sleep(0)
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+
+        # tick0 was already being written, tick1-3 were superseded by tick4
+        assert socket.sent == ["tick0", "tick4"]
+        assert outbox.stats() == {"sent": 2, "dropped": 3, "conflated": 3, "pending": 0}
+        await outbox.close()
+
+    async def test_latest_wins_only_within_a_stream(self):
+        socket = BlockingSocket()
+        outbox = Outbox(socket, max_size=8)
+
+        outbox.put_latest(None, "tick0", stream="rates")
+        await asyncio.sleep(0)
+        outbox.put_latest(None, "tick1", stream="rates")
+        outbox.put(None, "closed-bar")
+        outbox.put_latest(None, "tick2", stream="rates")
+        outbox.put_latest(None, "rates.2s-tick", stream="rates.2s")
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+
+        # Closed bars and other streams' ticks are not superseded by a newer rates tick
+        assert socket.sent == ["tick0", "closed-bar", "tick2", "rates.2s-tick"]
+        await outbox.close()
+
+    async def test_lagging_deltas_conflate_to_snapshot(self):
+        socket = BlockingSocket()
+        outbox = Outbox(socket, resync=lambda: [(20, "snapshot@20")], max_size=3)
+
+        for seq in range(1, 11):
+            outbox.put(seq, f"delta{seq}")
+            await asyncio.sleep(0)
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+        outbox.put(15, "delta15")
+        outbox.put(21, "delta21")
+        await asyncio.sleep(0.01)
+
+        assert socket.sent == ["delta1", "snapshot@20", "delta21"]
+        assert outbox.conflated == 1
+        await outbox.close()
+
+    async def test_slow_client_is_disconnected(self):
+        socket = BlockingSocket()
+        on_slow = AsyncMock()
+        outbox = Outbox(socket, on_slow=on_slow, max_lag=0.05)
+
+        outbox.put(1, "delta1")
+        outbox.put(2, "delta2")
+        await asyncio.sleep(0.1)
+        outbox.put(3, "delta3")
+        await asyncio.sleep(0.01)
+
+        on_slow.assert_awaited_once()
+        assert len(outbox) == 0
+        await outbox.close()
+
+    async def test_fast_client_not_held_back_by_slow_one(self):
+        slow, fast = BlockingSocket(), BlockingSocket()
+        fast.gate.set()
+        slow_outbox, fast_outbox = Outbox(slow, max_size=4), Outbox(fast, max_size=4)
+
+        for n in range(20):
+            slow_outbox.put_latest(None, f"tick{n}")
+            fast_outbox.put_latest(None, f"tick{n}")
+            await asyncio.sleep(0)
+
+        assert len(fast.sent) == 20
+        assert slow.sent == [] and len(slow_outbox) == 1
+        await slow_outbox.close()
+        await fast_outbox.close()
+
+
+class StubNewton:
+    """Local aiohttp server standing in for Newton, with switchable body, ETag and status"""
+
+    def __init__(self, body=SAMPLE_NEWTON_DATA, etag=None):
+        self.body = json.dumps(body)
+        self.etag = etag
+        self.status = 200
+        self.requests = []
+        app = web.Application()
+        app.router.add_get("/rates", self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        self.requests.append(dict(request.headers))
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if self.etag and request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304)
+        headers = {"ETag": self.etag} if self.etag else {}
+        return web.Response(text=self.body, content_type="application/json", headers=headers)
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.server.close()
+
+    @property
+    def url(self):
+        return str(self.server.make_url("/rates"))
+
+
+@pytest.mark.asyncio
+class TestUpstreamClient:
+    async def test_conditional_request_with_etag(self):
+        async with StubNewton(etag='"v1"') as stub:
+            client = UpstreamClient(stub.url, min_interval=1, max_interval=4)
+            try:
+                assert await client.fetch() == SAMPLE_NEWTON_DATA
+                assert await client.fetch() is None
+            finally:
+                await client.close()
+
+        assert stub.requests[1]["If-None-Match"] == '"v1"'
+        assert client.stats["not_modified"] == 1
+        assert client.next_interval() == 1.5
+
+    async def test_unchanged_body_skipped_by_hash(self):
+        async with StubNewton() as stub:
+            client = UpstreamClient(stub.url, min_interval=1, max_interval=2)
+            try:
+                assert await client.fetch() == SAMPLE_NEWTON_DATA
+                for _ in range(3):
+                    assert await client.fetch() is None
+                assert client.next_interval() == 2
+
+                # New data brings the poll interval straight back down
+                stub.body = json.dumps(SAMPLE_NEWTON_DATA[:1])
+                assert await client.fetch() == SAMPLE_NEWTON_DATA[:1]
+                assert client.next_interval() == 1
+            finally:
+                await client.close()
+
+    async def test_backoff_and_circuit_breaker(self):
+        async with StubNewton() as stub:
+            stub.status = 503
+            breaker = CircuitBreaker(threshold=3, reset_timeout=0.1)
+            client = UpstreamClient(stub.url, min_interval=0.01, backoff_max=10, breaker=breaker)
+            try:
+                for failures in range(1, 4):
+                    with pytest.raises(UpstreamError):
+                        await client.fetch()
+                    assert client.failures == failures
+                assert breaker.state == CircuitBreaker.OPEN
+                assert 0.05 < client.next_interval() <= 0.1
+
+                # No request reaches the server while the circuit is open
+                with pytest.raises(CircuitOpenError):
+                    await client.fetch()
+                assert len(stub.requests) == 3
+
+                # A successful trial request after the timeout closes it again
+                await asyncio.sleep(0.1)
+                stub.status = 200
+                assert await client.fetch() == SAMPLE_NEWTON_DATA
+                assert breaker.state == CircuitBreaker.CLOSED
+                assert client.next_interval() == 0.01
+            finally:
+                await client.close()
+
+    async def test_jittered_backoff_bounds(self):
+        client = UpstreamClient("http://stub.invalid/", min_interval=1, backoff_max=8)
+        client.failures = 5
+        delays = {client.next_interval() for _ in range(50)}
+        assert all(1 <= delay <= 8 for delay in delays)
+        assert len(delays) > 1
+
+    async def test_service_skips_unchanged_ticks(self, fake_redis):
+        async with StubNewton() as stub:
+            service = MarketDataService()
+            service.source = UpstreamClient(stub.url)
+            try:
+                response = await service.get_market_data()
+                assert set(response["data"]) == {"BTC_CAD", "ETH_CAD"}
+                assert await service.get_market_data() is None
+            finally:
+                await service.close()
+
+
+@pytest.mark.asyncio
+class TestSources:
+    async def test_record_then_replay(self, tmp_path):
+        path = str(tmp_path / "newton.rec")
+        async with StubNewton() as stub:
+            recorder = RecordingSource(UpstreamClient(stub.url), path)
+            try:
+                assert await recorder.fetch() == SAMPLE_NEWTON_DATA
+                assert await recorder.fetch() is None
+                stub.body = json.dumps(SAMPLE_NEWTON_DATA[:1])
+                assert await recorder.fetch() == SAMPLE_NEWTON_DATA[:1]
+            finally:
+                await recorder.close()
+        assert recorder.recorded == 2
+
+        replay = ReplaySource(path, speed=0)
+        try:
+            assert await replay.fetch() == SAMPLE_NEWTON_DATA
+            assert replay.next_interval() == 0
+            assert await replay.fetch() == SAMPLE_NEWTON_DATA[:1]
+            assert await replay.fetch() is None
+            assert replay.finished
+        finally:
+            await replay.close()
+
+    async def test_replay_paces_from_first_record_and_loops(self, tmp_path):
+        path = tmp_path / "newton.rec"
+        body = json.dumps(SAMPLE_NEWTON_DATA).encode()
+        # A torn record at the end, as left by a recorder that died mid-write
+        path.write_bytes(encode_snapshot(1000.0, body) + encode_snapshot(1010.0, body) + encode_snapshot(1020.0, body)[:-3])
+
+        replay = ReplaySource(str(path), speed=10, loop=True)
+        try:
+            await replay.fetch()
+            assert 0.9 < replay.next_interval() <= 1.0
+            await replay.fetch()
+            # The torn tail counts as the end, so the log starts over
+            assert await replay.fetch() == SAMPLE_NEWTON_DATA
+            assert replay.replayed == 3
+        finally:
+            await replay.close()
+
+    async def test_service_runs_from_replay(self, tmp_path, fake_redis, settings):
+        path = tmp_path / "newton.rec"
+        path.write_bytes(encode_snapshot(1000.0, json.dumps(SAMPLE_NEWTON_DATA).encode()))
+        settings.MARKET_DATA_SOURCE = "replay"
+        settings.MARKET_DATA_LOG = str(path)
+        service = MarketDataService()
+        try:
+            assert isinstance(service.source, ReplaySource)
+            response = await service.get_market_data()
+            assert set(response["data"]) == {"BTC_CAD", "ETH_CAD"}
+        finally:
+            await service.close()
+
+    async def test_missing_log_is_an_upstream_error(self, tmp_path):
+        replay = ReplaySource(str(tmp_path / "missing.rec"))
+        with pytest.raises(UpstreamError):
+            await replay.fetch()
+
+    async def test_unknown_mode_is_rejected(self, settings):
+        settings.MARKET_DATA_SOURCE = "carrier-pigeon"
+        with pytest.raises(ImproperlyConfigured):
+            make_source()
+
+
+@pytest.mark.asyncio
+class TestWarmUp:
+    async def test_lifespan_warms_and_closes_shared_resources(self, fake_redis, producer, monkeypatch):
+        monkeypatch.setattr("markets.producer.market_data_producer", producer)
+        pings = []
+        monkeypatch.setattr(fake_redis, "ping", AsyncMock(side_effect=lambda: pings.append(1)))
+        messages = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        lifespan = asyncio.create_task(WarmUpMiddleware(None)({"type": "lifespan"}, messages.get, send))
+        await messages.put({"type": "lifespan.startup"})
+        while not sent:
+            await asyncio.sleep(0.01)
+        assert sent == ["lifespan.startup.complete"]
+        assert pings and producer.market_service is not None
+        session = get_http_session()
+        assert session.connector.use_dns_cache and session.connector.limit == settings.UPSTREAM_MAX_CONNECTIONS
+        assert get_http_session() is session
+
+        await messages.put({"type": "lifespan.shutdown"})
+        await lifespan
+        assert sent[-1] == "lifespan.shutdown.complete"
+        assert session.closed and producer.market_service is None
+
+    async def test_failed_warm_up_retried_by_next_scope(self, monkeypatch):
+        calls = []
+
+        async def warm_up():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+
+        monkeypatch.setattr("markets.resources.warm_up", warm_up)
+        first = ensure_warm()
+        with pytest.raises(RuntimeError):
+            await first
+        await asyncio.sleep(0)
+
+        second = ensure_warm()
+        assert second is not first
+        await second
+        assert ensure_warm() is second and len(calls) == 2
+        await close_resources()
+
+    async def test_service_outlives_the_last_subscriber(self, mock_upstream, producer):
+        await producer.add_subscriber()
+        await asyncio.sleep(0.1)
+        service = producer.market_service
+        assert service is not None and producer.tick_count
+        await producer.remove_subscriber()
+        assert not producer.is_running()
+
+        # The next first subscriber reuses the service and its loaded price windows
+        await producer.add_subscriber()
+        await asyncio.sleep(0.1)
+        assert producer.market_service is service
+        await producer.close()
+        assert producer.market_service is None
+
+    async def test_connect_does_no_io(self, fake_redis, monkeypatch, producer):
+        monkeypatch.setattr("markets.producer.market_data_producer", producer)
+        touched = []
+        ping_gate = asyncio.Event()
+
+        async def ping():
+            touched.append("redis ping")
+            await ping_gate.wait()
+
+        def handshake_redis():
+            touched.append("redis")
+            return fake_redis
+
+        monkeypatch.setattr(fake_redis, "ping", ping)
+        monkeypatch.setattr("markets.models.get_redis_client", handshake_redis)
+        monkeypatch.setattr("markets.resources.get_http_session", lambda: touched.append("http session"))
+        application = WarmUpMiddleware(AuthMiddlewareStack(URLRouter(websocket_urlpatterns)))
+
+        # The first connection starts the warm-up in the background and is accepted while it is stuck on Redis
+        communicator = WebsocketCommunicator(application, "/markets/ws/")
+        connected, _ = await communicator.connect(timeout=1)
+        assert connected
+        assert touched == ["redis ping"]
+        assert producer.market_service is None
+
+        ping_gate.set()
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+            if producer.market_service is not None:
+                break
+        assert touched[:2] == ["redis ping", "http session"]
+        assert producer.market_service is not None
+        await communicator.disconnect()
+        await close_resources()
+
+
+class TestFormatMarketData:
+    def test_malformed_entry_skipped(self):
+        service = MarketDataService()
+        data = SAMPLE_NEWTON_DATA + [
+            {"symbol": "LTC_CAD", "bid": "oops", "ask": "1", "change": "0", "timestamp": 1},
+            {"symbol": "LTC_CAD", "bid": None, "ask": "1", "change": "0", "timestamp": 1},
+        ]
+
+        formatted = service.format_market_data(data)
+        assert set(formatted) == {"BTC_CAD", "ETH_CAD"}
+
+
+class TestCandleAggregator:
+    def test_ohlcv_within_one_bar(self):
+        candles = CandleAggregator({"1m": 60})
+        for timestamp, price in [(120, 10.0), (130, 12.0), (140, 9.0), (179, 11.0)]:
+            assert candles.update("BTC_CAD", timestamp, price) == []
+
+        assert candles.live("1m") == {
+            "BTC_CAD": {"start": 120, "open": 10.0, "high": 12.0, "low": 9.0, "close": 11.0, "volume": 4}
+        }
+
+    def test_next_period_closes_bar_and_late_ticks_are_ignored(self):
+        candles = CandleAggregator({"1m": 60, "5m": 300})
+        candles.update("BTC_CAD", 120, 10.0)
+        closed = candles.update("BTC_CAD", 185, 13.0)
+
+        assert [(interval, symbol, candle.close) for interval, symbol, candle in closed] == [("1m", "BTC_CAD", 10.0)]
+        assert candles.live("5m")["BTC_CAD"]["volume"] == 2
+        candles.update("BTC_CAD", 150, 99.0)
+        assert candles.live("1m")["BTC_CAD"]["high"] == 13.0
+
+    def test_quiet_symbols_closed_by_sweep(self):
+        candles = CandleAggregator({"1m": 60})
+        candles.update_tick({"BTC_CAD": {"timestamp": 120, "spot": 10.0}}, now=120)
+
+        assert candles.update_tick({}, now=150) == []
+        closed = candles.update_tick({}, now=181)
+        assert [(symbol, candle.start) for _, symbol, candle in closed] == [("BTC_CAD", 120)]
+        assert candles.live("1m") == {}
+        # A straggler for the swept minute does not reopen it
+        candles.update("BTC_CAD", 170, 10.5)
+        assert candles.live("1m") == {}
+
+    def test_sweep_follows_upstream_clock(self, monkeypatch):
+        clock = [10_000.0]
+        monkeypatch.setattr("markets.candles.time", SimpleNamespace(time=lambda: clock[0]))
+        candles = CandleAggregator({"1m": 60})
+        # Upstream's timestamps run far behind the server's clock
+        candles.update_tick({"BTC_CAD": {"timestamp": 120, "spot": 10.0}})
+
+        clock[0] += 50
+        assert candles.update_tick({}) == []
+        # Quotes that keep the same timestamp hold the clock where they are
+        candles.update_tick({"BTC_CAD": {"timestamp": 120, "spot": 11.0}})
+        clock[0] += 50
+        assert candles.update_tick({}) == []
+        clock[0] += 11
+        closed = candles.update_tick({})
+        assert [(symbol, candle.close) for _, symbol, candle in closed] == [("BTC_CAD", 11.0)]
+
+
+@pytest.mark.asyncio
+class TestCandles:
+    async def test_closed_candles_persisted(self, fake_redis, producer):
+        start = SAMPLE_TIMESTAMP - SAMPLE_TIMESTAMP % 60
+        quote = {"symbol": "BTC_CAD", "timestamp": start, "bid": 1.0, "ask": 3.0, "spot": 2.0, "change": 0.0}
+        await producer.publish_candles({"BTC_CAD": quote})
+        moved = dict(quote, timestamp=start + 60, spot=4.0)
+        await producer.publish_candles({"BTC_CAD": moved})
+
+        bars = await CandleStore().get_candles("BTC_CAD", "1m", start - 60, start + 60)
+        assert bars == [{"start": start, "open": 2.0, "high": 2.0, "low": 2.0, "close": 2.0, "volume": 1}]
+
+    async def test_quiet_tick_closes_due_bars(self, fake_redis, producer, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr("markets.candles.time", SimpleNamespace(time=lambda: clock[0]))
+        start = SAMPLE_TIMESTAMP - SAMPLE_TIMESTAMP % 60
+        quote = {"symbol": "BTC_CAD", "timestamp": start, "bid": 1.0, "ask": 3.0, "spot": 2.0, "change": 0.0}
+        await producer.publish_candles({"BTC_CAD": quote})
+
+        clock[0] += 30
+        await producer.publish_candles({})
+        assert "BTC_CAD" in producer.candles.live("1m")
+        clock[0] += 31
+        await producer.publish_candles({})
+        assert producer.candles.live("1m") == {}
+        bars = await CandleStore().get_candles("BTC_CAD", "1m", start, start)
+        assert [bar["close"] for bar in bars] == [2.0]
+
+    async def test_candles_channel(self, mock_upstream, producer):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "candles", "intervals": ["1m"]})
+        snapshot = await communicator.receive_json_from(timeout=2)
+        assert snapshot["channel"] == "candles" and snapshot["event"] == "snapshot"
+        assert set(snapshot["data"]) == {"1m"}
+
+        update = await communicator.receive_json_from(timeout=2)
+        assert update["event"] == "update" and update["interval"] == "1m"
+        assert update["data"]["BTC_CAD"]["open"] == 50050.0
+        assert producer.subscriber_count == 1
+
+        await communicator.send_json_to({"event": "unsubscribe", "channel": "candles"})
+        assert await communicator.receive_json_from(timeout=2) == {
+            "event": "unsubscribed", "channel": "candles", "intervals": []
+        }
+        assert producer.subscriber_count == 0
+
+        await communicator.disconnect()
+
+    async def test_invalid_intervals(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "candles", "intervals": ["3m"]})
+        assert await communicator.receive_json_from() == {"event": "error", "message": "Invalid intervals"}
+
+        await communicator.disconnect()
+
+
+class TestIndicators:
+    def test_rolling_window_matches_recomputation(self):
+        window = RollingWindow(10, capacity=2)
+        samples = [(t, 100.0 + (t * 7) % 5) for t in range(40)]
+        for timestamp, value in samples:
+            window.append(timestamp, value)
+            kept = [v for t, v in samples[:timestamp + 1] if t >= timestamp - 10]
+            mean = sum(kept) / len(kept)
+            stats = window.stats()
+            assert stats["count"] == len(kept)
+            assert stats["mean"] == pytest.approx(mean)
+            assert stats["stddev"] == pytest.approx((sum((v - mean) ** 2 for v in kept) / len(kept)) ** 0.5)
+            assert (stats["min"], stats["max"]) == (min(kept), max(kept))
+
+    def test_twap_weights_by_time(self):
+        window = RollingWindow(60)
+        for timestamp, value in [(0, 10.0), (30, 20.0), (40, 40.0)]:
+            window.append(timestamp, value)
+        # 10 for 30s, then 20 for 10s
+        assert window.stats()["twap"] == pytest.approx(12.5)
+        window.append(20, 99.0)
+        assert window.stats()["count"] == 3
+
+    def test_engine_ema_and_spread(self):
+        engine = IndicatorEngine({"1m": 60}, {"1m": 60})
+        engine.update("BTC_CAD", 0, 9.0, 11.0)
+        assert engine.snapshot()["BTC_CAD"]["ema"] == {"1m": 10.0}
+
+        moved = engine.update_tick({"BTC_CAD": {"timestamp": 60, "bid": 19.0, "ask": 23.0}})
+        indicators = moved["BTC_CAD"]
+        # The old mid stood for one span, the new one has not stood yet
+        assert indicators["ema"]["1m"] == pytest.approx(10.0)
+        assert indicators["mid"] == 21.0 and indicators["spread"] == 4.0
+        assert indicators["windows"]["1m"]["spread_mean"] == 3.0
+        assert indicators["windows"]["1m"]["spread_max"] == 4.0
+        engine.update("BTC_CAD", 120, 19.0, 23.0)
+        assert engine.snapshot(["BTC_CAD"])["BTC_CAD"]["ema"]["1m"] == pytest.approx(21.0 - 11.0 / math.e)
+
+
+@pytest.mark.asyncio
+class TestIndicatorChannel:
+    async def test_indicators_channel(self, mock_upstream, producer):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "indicators"})
+        snapshot = await communicator.receive_json_from(timeout=2)
+        assert snapshot["channel"] == "indicators" and snapshot["event"] == "snapshot"
+
+        update = await communicator.receive_json_from(timeout=2)
+        assert update["event"] == "update"
+        assert set(update["data"]) == {"BTC_CAD", "ETH_CAD"}
+        assert update["data"]["BTC_CAD"]["mid"] == 50050.0
+        assert update["data"]["BTC_CAD"]["windows"]["1m"]["spread_max"] == 100.0
+        assert producer.subscriber_count == 1
+
+        await communicator.send_json_to({"event": "unsubscribe", "channel": "indicators"})
+        assert await communicator.receive_json_from(timeout=2) == {"event": "unsubscribed", "channel": "indicators"}
+        assert producer.subscriber_count == 0
+
+        await communicator.disconnect()
+
+
+async def store_history_ticks(start: int, count: int):
+    history = PriceHistory()
+    for n in range(count):
+        await history.store_tick([{"symbol": "BTC_CAD", "bid": 100.0 + n, "ask": 101.0 + n, "change": 0.0, "timestamp": start + n}])
+    # A second quote sharing a timestamp, so pages must split within one score
+    await history.store_tick([{"symbol": "BTC_CAD", "bid": 500.0, "ask": 501.0, "change": 0.0, "timestamp": start + 4}])
+
+
+@pytest.mark.asyncio
+class TestHistoryQuery:
+    async def test_cursor_pages_cover_range_once(self, fake_redis):
+        start = SAMPLE_TIMESTAMP - 100
+        await store_history_ticks(start, 10)
+
+        query = parse_history_params({"symbol": "BTC_CAD", "start": start, "end": start + 9, "limit": 2})
+        points, pages = [], 0
+        while True:
+            result = await query_history(query)
+            points.extend(result["data"])
+            pages += 1
+            if result["next_cursor"] is None:
+                break
+            query = dict(query, cursor=result["next_cursor"])
+
+        assert pages == 6
+        assert len(points) == 11
+        assert [p["timestamp"] for p in points] == sorted(p["timestamp"] for p in points)
+        assert sorted(p["bid"] for p in points if p["timestamp"] == start + 4) == [104.0, 500.0]
+        assert points[0]["spot"] == 100.5
+
+    async def test_downsampled_buckets_hold_last_tick(self, fake_redis):
+        start = SAMPLE_TIMESTAMP - SAMPLE_TIMESTAMP % 5 - 100
+        await store_history_ticks(start, 10)
+
+        query = parse_history_params({"symbol": "BTC_CAD", "start": start, "end": start + 9, "resolution": 5, "limit": 1})
+        first = await query_history(query)
+        second = await query_history(dict(query, cursor=first["next_cursor"]))
+
+        assert [(p["bucket"], p["timestamp"]) for p in first["data"]] == [(start, start + 4)]
+        assert [(p["bucket"], p["timestamp"]) for p in second["data"]] == [(start + 5, start + 9)]
+        assert second["next_cursor"] is None
+
+    async def test_hot_windows_served_from_cache(self, fake_redis):
+        start = SAMPLE_TIMESTAMP - 100
+        await store_history_ticks(start, 3)
+        query = parse_history_params({"symbol": "BTC_CAD", "start": start, "end": start + 9})
+
+        first = await query_history(query)
+        hits = history_cache.hits
+        await fake_redis.flushall()
+        assert await query_history(query) == first
+        assert history_cache.hits == hits + 1
+
+    async def test_invalid_params(self):
+        with pytest.raises(ValueError, match="Unsupported symbol"):
+            parse_history_params({"symbol": "NOPE_CAD"})
+        with pytest.raises(ValueError, match="Invalid limit"):
+            parse_history_params({"symbol": "BTC_CAD", "limit": "many"})
+        with pytest.raises(ValueError, match="start must not be after end"):
+            parse_history_params({"symbol": "BTC_CAD", "start": 10, "end": 5})
+        assert parse_history_params({"symbol": "BTC_CAD", "limit": "5000"})["limit"] == 1000
+        for name, value in (("limit", "inf"), ("resolution", "inf"), ("start", "nan"), ("end", "-inf")):
+            with pytest.raises(ValueError, match=f"Invalid {name}"):
+                parse_history_params({"symbol": "BTC_CAD", name: value})
+
+    async def test_open_ended_queries_share_a_cache_key(self, settings, monkeypatch):
+        settings.HISTORY_CACHE_TTL = 5
+        now = [1001.2]
+        monkeypatch.setattr("markets.history.time", SimpleNamespace(time=lambda: now[0], monotonic=time.monotonic))
+        first = parse_history_params({"symbol": "BTC_CAD"})
+        now[0] = 1004.9
+        assert parse_history_params({"symbol": "BTC_CAD"}) == first
+        assert first["end"] == 1005 and first["start"] == 1005 - 60 * 60
+        now[0] = 1005.1
+        assert parse_history_params({"symbol": "BTC_CAD"})["end"] == 1010
+
+    async def test_http_endpoint(self, fake_redis):
+        start = SAMPLE_TIMESTAMP - 100
+        await store_history_ticks(start, 5)
+        client = AsyncClient()
+
+        response = await client.get(f"/markets/history/BTC_CAD/?start={start}&end={start + 9}&limit=4")
+        assert response.status_code == 200
+        body = response.json()
+        assert len(body["data"]) == 4 and body["next_cursor"]
+
+        assert (await client.get("/markets/history/NOPE_CAD/")).status_code == 404
+        assert (await client.get("/markets/history/BTC_CAD/?limit=x")).status_code == 400
+        assert (await client.get("/markets/history/BTC_CAD/?limit=inf")).status_code == 400
+        assert (await client.post("/markets/history/BTC_CAD/")).status_code == 405
+
+    async def test_websocket_history_event(self, fake_redis):
+        start = SAMPLE_TIMESTAMP - 100
+        await store_history_ticks(start, 5)
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "history", "id": 7, "symbol": "BTC_CAD", "start": start, "end": start + 9})
+        response = await communicator.receive_json_from(timeout=2)
+        assert response["event"] == "history" and response["id"] == 7
+        assert len(response["data"]) == 6
+
+        await communicator.send_json_to({"event": "history", "id": 8, "symbol": "BTC_CAD", "resolution": 0})
+        assert await communicator.receive_json_from(timeout=2) == {"event": "error", "message": "Invalid resolution", "id": 8}
+
+        await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+class TestControlMessages:
+    async def test_ping_answered_while_history_pending(self, monkeypatch):
+        release = asyncio.Event()
+
+        async def slow_query(query):
+            await release.wait()
+            return {"symbol": query["symbol"], "data": []}
+
+        monkeypatch.setattr("markets.consumers.query_history", slow_query)
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "history", "id": 1, "symbol": "BTC_CAD"})
+        await communicator.send_json_to({"event": "ping", "id": 2})
+        pong = await communicator.receive_json_from(timeout=1)
+        assert pong["event"] == "pong" and pong["id"] == 2
+
+        release.set()
+        assert await communicator.receive_json_from(timeout=1) == {"event": "history", "id": 1, "symbol": "BTC_CAD", "data": []}
+
+        await communicator.disconnect()
+
+    async def test_pending_requests_limited_and_cancelled_on_disconnect(self, monkeypatch, settings):
+        settings.CLIENT_MAX_PENDING_REQUESTS = 1
+        cancelled = []
+
+        async def stuck_query(query):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(query["symbol"])
+                raise
+
+        monkeypatch.setattr("markets.consumers.query_history", stuck_query)
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "history", "id": 1, "symbol": "BTC_CAD"})
+        await communicator.send_json_to({"event": "history", "id": 2, "symbol": "ETH_CAD"})
+        assert await communicator.receive_json_from(timeout=1) == {"event": "error", "message": "Too many pending requests", "id": 2}
+
+        await communicator.disconnect()
+        assert cancelled == ["BTC_CAD"]
+
+    async def test_heartbeat_and_idle_timeout(self, monkeypatch, settings):
+        monkeypatch.setattr("markets.consumers.heartbeat", Heartbeat(0.05))
+        communicator = await setup_communicator()
+
+        assert (await communicator.receive_json_from(timeout=1))["event"] == "heartbeat"
+
+        settings.CLIENT_IDLE_TIMEOUT = 0.1
+        output = await communicator.receive_output(timeout=1)
+        while output["type"] != "websocket.close":
+            output = await communicator.receive_output(timeout=1)
+        assert output["code"] == 1001
+
+        await communicator.disconnect()
+
+
+@pytest.mark.asyncio
+class TestTickScheduler:
+    async def test_deadlines_align_to_wall_clock(self, monkeypatch):
+        monkeypatch.setattr("markets.scheduler.time", SimpleNamespace(time=lambda: 1000.25, monotonic=lambda: 50.0))
+        scheduler = TickScheduler(1.0)
+        assert scheduler.next_deadline() == pytest.approx(50.75)
+        # Longer intervals round up to whole periods on the same grid
+        assert scheduler.next_deadline(2.5) == pytest.approx(52.75)
+
+    async def test_cycle_time_does_not_drift(self):
+        scheduler = TickScheduler(0.02)
+        await scheduler.wait()
+        start = time.monotonic()
+        for _ in range(5):
+            await asyncio.sleep(0.008)  # the fetch/format/send cycle
+            await scheduler.wait()
+        assert time.monotonic() - start == pytest.approx(0.1, abs=0.015)
+        assert scheduler.missed == 0
+
+    async def test_overrun_counts_missed_deadlines(self):
+        scheduler = TickScheduler(0.01)
+        scheduler.deadline = time.monotonic() - 0.0355
+        await scheduler.wait()
+        assert scheduler.missed == 3
+
+    async def test_throttled_stream_merges_moves_per_period(self, fake_redis, settings, monkeypatch):
+        settings.RATES_THROTTLES = {"1s": 1}
+        now = [1000.2]
+        monkeypatch.setattr("markets.producer.time", SimpleNamespace(time=lambda: now[0]))
+        producer = MarketDataProducer()
+        producer.throttle_counts["1s"] = 1
+        producer.format_counts["json"] = 1
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(producer.format_group("json", "1s"), channel)
+
+        service = MarketDataService()
+        btc, eth = SAMPLE_NEWTON_DATA[0], SAMPLE_NEWTON_DATA[1]
+        ticks = [
+            (1000.2, [btc, eth]),
+            (1000.5, [btc, dict(eth, bid="3001.0")]),
+            (1000.8, [dict(btc, bid="50001.0"), dict(eth, bid="3001.0")]),
+            (1001.1, [dict(btc, bid="50001.0"), dict(eth, bid="3001.0")]),
+        ]
+        sent = []
+        for at, data in ticks:
+            now[0] = at
+            await producer.publish(service.get_formatted_response(service.format_market_data(data)))
+            try:
+                message = await asyncio.wait_for(channel_layer.receive(channel), timeout=0.05)
+            except asyncio.TimeoutError:
+                continue
+            assert message["throttle"] == "1s"
+            sent.append((at, sorted(json.loads(message["delta"])["data"])))
+
+        # One update per wall-clock second, carrying everything that moved since the last one
+        assert sent == [(1000.2, ["BTC_CAD", "ETH_CAD"]), (1001.1, ["BTC_CAD", "ETH_CAD"])]
+
+    async def test_throttled_moves_flushed_while_upstream_is_quiet(self, fake_redis, settings, monkeypatch):
+        settings.RATES_THROTTLES = {"5s": 5}
+        now = [1000.2]
+        monkeypatch.setattr("markets.producer.time", SimpleNamespace(time=lambda: now[0]))
+        producer = MarketDataProducer()
+        producer.throttle_counts["5s"] = 1
+        producer.format_counts["json"] = 1
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(producer.format_group("json", "5s"), channel)
+
+        service = MarketDataService()
+        btc = SAMPLE_NEWTON_DATA[0]
+        await producer.publish(service.get_formatted_response(service.format_market_data([btc])))
+        await asyncio.wait_for(channel_layer.receive(channel), timeout=0.05)
+        now[0] = 1001.0
+        await producer.publish(service.get_formatted_response(service.format_market_data([dict(btc, bid="50001.0")])))
+
+        # Upstream goes quiet: nothing is due inside the period, the held move goes out once it ends
+        now[0] = 1004.0
+        await producer.publish_throttled()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel), timeout=0.05)
+        now[0] = 1005.1
+        await producer.publish_throttled()
+        message = await asyncio.wait_for(channel_layer.receive(channel), timeout=0.05)
+        assert json.loads(message["delta"])["data"]["BTC_CAD"]["bid"] == 50001.0
+        assert json.loads(message["frame"])["data"]["BTC_CAD"]["bid"] == 50001.0
+
+        # With nothing left to flush, quiet ticks send nothing
+        now[0] = 1010.1
+        await producer.publish_throttled()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel), timeout=0.05)
+
+    async def test_throttled_client_gets_fewer_frames(self, mock_upstream, settings):
+        settings.RATES_THROTTLES = {"200ms": 0.2}
+        every_tick = await setup_communicator()
+        throttled = await setup_communicator()
+        await every_tick.send_json_to({"event": "subscribe", "channel": "rates"})
+        await throttled.send_json_to({"event": "subscribe", "channel": "rates", "throttle": "200ms"})
+        await throttled.send_json_to({"event": "subscribe", "channel": "rates", "throttle": "1ms"})
+        assert await throttled.receive_json_from(timeout=1) == {"event": "error", "message": "Invalid throttle"}
+
+        await asyncio.sleep(0.6)
+        counts = []
+        for communicator in (every_tick, throttled):
+            count = 0
+            while not await communicator.receive_nothing(timeout=0.01):
+                await communicator.receive_output()
+                count += 1
+            counts.append(count)
+        assert 2 <= counts[1] < counts[0] / 2
+
+        await every_tick.disconnect()
+        await throttled.disconnect()
+
+
+class TestMetrics:
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "Test", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value)
+
+        assert dict(histogram.samples()) == {
+            'test_seconds_bucket{le="0.1"}': 1,
+            'test_seconds_bucket{le="1.0"}': 3,
+            'test_seconds_bucket{le="+Inf"}': 4,
+            "test_seconds_sum": 4.25,
+            "test_seconds_count": 4,
+        }
+
+    def test_timer_and_callback_gauge(self):
+        histogram = Histogram("test_seconds", "Test")
+        with histogram.time():
+            pass
+        assert histogram.count == 1
+        assert dict(Gauge("test_value", "Test", fn=lambda: 7).samples()) == {"test_value": 7}
+
+    @pytest.mark.asyncio
+    async def test_metrics_endpoint(self, mock_upstream):
+        communicator = await setup_communicator()
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        await communicator.receive_json_from(timeout=2)
+
+        response = await AsyncClient().get("/metrics")
+        body = response.content.decode()
+        assert response.status_code == 200
+        assert response["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "# TYPE markets_format_seconds histogram" in body
+        assert metrics.connected_clients.value >= 1
+        assert f"markets_connected_clients {metrics.connected_clients.value}" in body
+        assert "markets_outbox_sent_total" in body
+        assert metrics.format_seconds.count > 0 and metrics.send_seconds.count > 0
+
+        await communicator.disconnect()
+
+
+class TestLogging:
+    @staticmethod
+    def record(msg, level=logging.WARNING, **extra):
+        record = logging.LogRecord("markets.test", level, __file__, 1, msg, (), None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_rate_limit_per_key_with_total_cap(self, monkeypatch):
+        log_filter = RateLimitFilter(rate=2, per=60, total_rate=3)
+        now = [1000.0]
+        monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+        assert [log_filter.filter(self.record("Client %s sent junk", rate_key="a")) for _ in range(3)] == [True, True, False]
+        assert log_filter.filter(self.record("Client %s sent junk", rate_key="b"))
+        # The template as a whole is capped too, however many clients there are
+        assert not log_filter.filter(self.record("Client %s sent junk", rate_key="c"))
+        assert log_filter.filter(self.record("Something else"))
+        assert log_filter.filter(self.record("Client %s sent junk", level=logging.ERROR, rate_key="a"))
+
+        now[0] += 60
+        record = self.record("Client %s sent junk", rate_key="a")
+        assert log_filter.filter(record)
+        assert record.msg.endswith("[2 similar messages suppressed]")
+
+    def test_decision_shared_between_handlers(self):
+        log_filter = RateLimitFilter(rate=1)
+        first, second = self.record("Tick"), self.record("Tick")
+        assert log_filter.filter(first) and log_filter.filter(first)
+        assert not log_filter.filter(second) and not log_filter.filter(second)
+
+    def test_full_queue_drops_debug_but_keeps_errors(self):
+        log_queue = queue.Queue(1)
+        handler = DroppingQueueHandler(log_queue)
+        handler.handle(self.record("Noise %s", level=logging.DEBUG))
+        handler.handle(self.record("More noise", level=logging.DEBUG))
+        assert handler.dropped == 1
+
+        log_queue.get_nowait()
+        handler.handle(self.record("Broken", level=logging.ERROR))
+        assert log_queue.get_nowait().msg == "Broken"
+
+    def test_background_logging_moves_handlers_behind_queue(self):
+        target = logging.getLogger("markets.test_background")
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        target.addHandler(handler)
+        target.propagate = False
+        target.setLevel(logging.DEBUG)
+        listener = start_background_logging(["markets.test_background"])
+        try:
+            assert [type(h) for h in target.handlers] == [DroppingQueueHandler]
+            target.debug("Value %s", {"bid": 1})
+            listener.stop()
+            assert [record.getMessage() for record in records] == ["Value {'bid': 1}"]
+        finally:
+            target.handlers.clear()
+            target.propagate = True
+
+
+    def test_rate_limit_applied_before_queueing(self):
+        target = logging.getLogger("markets.test_background_filter")
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handler.addFilter(RateLimitFilter(rate=2))
+        target.addHandler(handler)
+        target.propagate = False
+        target.setLevel(logging.DEBUG)
+        listener = start_background_logging(["markets.test_background_filter"])
+        try:
+            assert handler.filters == []
+            queue_handler = target.handlers[0]
+            for n in range(10):
+                target.debug("Tick %s", n)
+            assert queue_handler.queue.qsize() <= 2
+            listener.stop()
+            assert [record.getMessage() for record in records] == ["Tick 0", "Tick 1"]
+        finally:
+            target.handlers.clear()
+            target.propagate = True
+
+class TestFrames:
+    def test_frame_encodes_lazily_and_once(self, monkeypatch):
+        frame = Frame({"channel": "rates", "event": "data", "data": {"BTC_CAD": {"bid": 1.5}}})
+
+        assert frame.text == '{"channel":"rates","event":"data","data":{"BTC_CAD":{"bid":1.5}}}'
+        assert frame.bytes is frame.bytes
+        assert frame.text is frame.text
+
+    def test_compose_frame_splices_fragments(self):
+        fragments = [encode_fragment("BTC_CAD", {"bid": 1.0}), encode_fragment("ETH_CAD", {"bid": 2.0})]
+        frame = compose_frame({"channel": "rates", "event": "delta", "seq": 3}, fragments)
+
+        assert json.loads(frame.text) == {
+            "channel": "rates", "event": "delta", "seq": 3,
+            "data": {"BTC_CAD": {"bid": 1.0}, "ETH_CAD": {"bid": 2.0}},
+        }
+        assert frame.payload["seq"] == 3
+
+    def test_stdlib_fallback_matches_fast_encoder(self, monkeypatch):
+        payload = {"channel": "rates", "data": {"ETH_CAD": {"spot": 3005.0, "change": -0.5}}}
+        fast = Frame(payload).bytes
+        monkeypatch.setattr(frames, "orjson", None)
+        assert json.loads(Frame(payload).bytes) == json.loads(fast)
+
+    def test_wire_formats_encoded_once(self):
+        data = {"BTC_CAD": {"bid": 1.0}}
+        frame = compose_frame({"channel": "rates", "event": "delta", "seq": 3}, [encode_fragment("BTC_CAD", data["BTC_CAD"])], data=data)
+        expected = {"channel": "rates", "event": "delta", "seq": 3, "data": data}
+
+        assert msgpack.unpackb(frame.encode("msgpack")) == expected
+        assert json.loads(zlib.decompress(frame.encode("deflate"))) == expected
+        assert frame.encode("msgpack") is frame.encode("msgpack")
+        assert frame.encode("json") is frame.text
+
+    def test_msgpack_without_data_decodes_json(self):
+        frame = compose_frame({"seq": 1}, [encode_fragment("BTC_CAD", {"bid": 1.0})])
+        assert msgpack.unpackb(frame.encode("msgpack")) == {"seq": 1, "data": {"BTC_CAD": {"bid": 1.0}}}
+        with pytest.raises(ValueError):
+            frame.encode("xml")
+
+
+@pytest.mark.asyncio
+class TestWireFormats:
+    async def test_msgpack_negotiated_by_subprotocol(self, mock_upstream):
+        communicator = await setup_communicator(subprotocols=["rates.msgpack"])
+        assert communicator.subprotocol == "rates.msgpack"
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        message = msgpack.unpackb((await communicator.receive_output(timeout=2))["bytes"])
+        assert message["event"] == "data"
+        assert message["data"]["BTC_CAD"]["spot"] == 50050.0
+
+        await communicator.disconnect()
+
+    async def test_format_chosen_at_subscribe(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "mode": "delta", "format": "deflate"})
+        snapshot = json.loads(zlib.decompress((await communicator.receive_output(timeout=2))["bytes"]))
+        assert snapshot["event"] == "snapshot"
+        assert set(snapshot["data"]) == {"BTC_CAD", "ETH_CAD"}
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "symbols": ["ETH_CAD"], "format": "msgpack"})
+        snapshot = msgpack.unpackb((await communicator.receive_output(timeout=2))["bytes"])
+        assert set(snapshot["data"]) == {"ETH_CAD"}
+
+        await communicator.disconnect()
+
+    async def test_invalid_format(self, mock_upstream):
+        communicator = await setup_communicator()
+
+        await communicator.send_json_to({"event": "subscribe", "channel": "rates", "format": "xml"})
+        assert await communicator.receive_json_from() == {"event": "error", "message": "Invalid format"}
+
+        await communicator.disconnect()
+
+    async def test_each_format_encoded_once_per_tick(self, mock_upstream, producer):
+        binary = [await setup_communicator(subprotocols=["rates.msgpack"]) for _ in range(3)]
+        text = await setup_communicator()
+
+        for communicator in binary + [text]:
+            await communicator.send_json_to({"event": "subscribe", "channel": "rates"})
+        frames = [(await communicator.receive_output(timeout=2))["bytes"] for communicator in binary]
+        assert all(frame is frames[0] for frame in frames)
+        assert "text" in await text.receive_output(timeout=2)
+        assert sorted(producer.active_formats()) == ["json", "msgpack"]
+
+        for communicator in binary + [text]:
+            await communicator.disconnect()
+        assert producer.active_formats() == []
+
+
+async def setup_communicator(subprotocols=None):
+    application = AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+    communicator = WebsocketCommunicator(application, "/markets/ws/", subprotocols=subprotocols)
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    communicator.subprotocol = subprotocol
+    return communicator
@@ -0,0 +1,231 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+import weakref
+import aiohttp
+from django.conf import settings
+from .metrics import fetch_seconds
+
+logger = logging.getLogger(__name__)
+
+# One keep-alive session per event loop, like the Redis client; in production that is one per process
+_http_sessions = weakref.WeakKeyDictionary()
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Get the process-wide aiohttp session for the running event loop"""
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        logger.info("Creating shared aiohttp session")
+        connector = aiohttp.TCPConnector(
+            limit=settings.UPSTREAM_MAX_CONNECTIONS,
+            ttl_dns_cache=settings.UPSTREAM_DNS_CACHE_TTL,
+            keepalive_timeout=settings.UPSTREAM_KEEPALIVE
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _http_sessions[loop] = session
+    return session
+
+
+async def close_http_session():
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+class UpstreamError(Exception):
+    """The upstream request failed or returned something unusable"""
+
+
+class CircuitOpenError(UpstreamError):
+    """The circuit breaker is open, so no request was made"""
+
+
+class MarketDataSource:
+    """Where upstream snapshots come from: live Newton, a recorder in front of it, or a replayed log"""
+
+    # Whether polls follow the producer's wall-clock tick grid; replays keep their own pacing
+    aligned = True
+
+    async def fetch(self):
+        """Parsed snapshot when it changed since the last fetch, None when it did not; raises UpstreamError"""
+        raise NotImplementedError
+
+    def next_interval(self) -> float:
+        """Seconds to wait before the next fetch"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class CircuitBreaker:
+    """Stops calling a failing upstream for `reset_timeout` seconds after `threshold` consecutive failures
+
+    Once the timeout passes one trial request is let through (half-open): success
+    closes the circuit, failure opens it again for another full timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def retry_after(self) -> float:
+        """Seconds until a trial request is allowed, 0 when requests may go through"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if self.retry_after() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            logger.info("Upstream circuit half-open, sending a trial request")
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Upstream circuit closed after %s failures", self.failures)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                logger.warning("Upstream circuit opened after %s failures, retrying in %ss", self.failures, self.reset_timeout)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class UpstreamClient(MarketDataSource):
+    """Conditional poller for a JSON endpoint that only hands back bodies that changed
+
+    Sends If-None-Match/If-Modified-Since when the server supplied validators and
+    falls back to hashing the body when it did not. The suggested poll interval
+    stays at `min_interval` while data keeps changing, stretches towards
+    `max_interval` while it does not, and backs off exponentially with jitter on
+    errors, behind a CircuitBreaker. With a `session_factory` (such as
+    get_http_session) requests go through that shared session and close()
+    leaves it open; otherwise the client owns a session of its own.
+    """
+
+    def __init__(self, url: str = None, min_interval: float = None, max_interval: float = None,
+                 backoff_max: float = None, timeout: float = None, breaker: CircuitBreaker = None,
+                 session_factory=None):
+        self.url = url or settings.NEWTON_API_URL
+        self.min_interval = min_interval or settings.MARKET_DATA_POLL_INTERVAL
+        self.max_interval = max(self.min_interval, max_interval or settings.MARKET_DATA_MAX_POLL_INTERVAL)
+        self.backoff_max = backoff_max or settings.UPSTREAM_BACKOFF_MAX
+        self.timeout = timeout or settings.UPSTREAM_TIMEOUT
+        self.breaker = breaker or CircuitBreaker(settings.UPSTREAM_BREAKER_THRESHOLD, settings.UPSTREAM_BREAKER_RESET)
+        self.session_factory = session_factory
+        self.session = None
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.body = None
+        self.interval = self.min_interval
+        self.failures = 0
+        self.stats = {"changed": 0, "not_modified": 0, "unchanged": 0, "errors": 0}
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Get the shared session, or create this client's own"""
+        if self.session_factory is not None:
+            return self.session_factory()
+        if self.session is None or self.session.closed:
+            logger.debug("Creating new aiohttp session")
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    async def fetch(self):
+        """Parsed body when it changed since the last fetch, None when it did not; raises UpstreamError"""
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit open, retrying in {self.breaker.retry_after():.1f}s")
+
+        try:
+            session = await self.get_session()
+            with fetch_seconds.time():
+                async with session.get(self.url, headers=self.conditional_headers(),
+                                       timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                    if response.status == 304:
+                        body = None
+                    elif response.status == 200:
+                        body = await response.read()
+                    else:
+                        raise UpstreamError(f"Status {response.status}")
+                    headers = response.headers
+            data = None
+            digest = None
+            if body is not None:
+                digest = hashlib.blake2b(body, digest_size=16).digest()
+                if digest != self.body_hash:
+                    data = json.loads(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, UpstreamError) as e:
+            self.record_failure()
+            if isinstance(e, UpstreamError):
+                raise
+            raise UpstreamError(f"{type(e).__name__}: {str(e)}") from e
+
+        self.breaker.record_success()
+        self.failures = 0
+        if body is None:
+            self.stats["not_modified"] += 1
+            self.record_unchanged()
+            return None
+        # Validators are only kept once the body they describe parsed
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        if data is None:
+            self.stats["unchanged"] += 1
+            self.record_unchanged()
+            return None
+
+        self.body_hash = digest
+        self.body = body
+        self.stats["changed"] += 1
+        self.interval = self.min_interval
+        return data
+
+    def record_unchanged(self):
+        self.interval = min(self.max_interval, self.interval * 1.5)
+
+    def record_failure(self):
+        self.failures += 1
+        self.stats["errors"] += 1
+        self.breaker.record_failure()
+
+    def next_interval(self) -> float:
+        """Seconds to wait before the next poll"""
+        if not self.failures:
+            return self.interval
+        # Full jitter keeps several recovering pollers from retrying in lockstep
+        ceiling = min(self.backoff_max, self.min_interval * 2 ** self.failures)
+        delay = random.uniform(self.min_interval, max(self.min_interval, ceiling))
+        return max(delay, self.breaker.retry_after())
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            logger.info("Closing aiohttp session")
+            await self.session.close()
@@ -0,0 +1,6 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('history/<str:symbol>/', views.price_history, name='price_history'),
+]
@@ -1,3 +1,28 @@
-from django.shortcuts import render
+import logging
+import redis
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from .history import parse_history_params, query_history
+from .metrics import registry
+from .subscriptions import SUPPORTED_PAIRS
 
-# Create your views here.
+logger = logging.getLogger(__name__)
+
+
+async def price_history(request, symbol: str):
+    """Paginated, optionally downsampled price history for one symbol"""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if symbol not in SUPPORTED_PAIRS:
+        return JsonResponse({"error": f"Unsupported symbol: {symbol}"}, status=404)
+    try:
+        query = parse_history_params({**request.GET.dict(), "symbol": symbol})
+        return JsonResponse(await query_history(query))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except redis.RedisError:
+        return JsonResponse({"error": "History temporarily unavailable"}, status=503)
+
+
+def metrics(request):
+    """Process metrics in the Prometheus text exposition format"""
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
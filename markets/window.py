@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import redis
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+STANDARD_WINDOWS = {"1h": 60 * 60, "24h": 24 * 60 * 60, "7d": 7 * 24 * 60 * 60}
+
+# Recent ticks are kept at full resolution, older ones as the last price of each minute
+FINE_SPAN = 60 * 60 + 60
+COARSE_RESOLUTION = 60
+COARSE_SPAN = 7 * 24 * 60 * 60 + 60 * 60
+
+
+class RingBuffer:
+    """Fixed-capacity, time-ordered (timestamp, price) series in two parallel float arrays"""
+
+    __slots__ = ('capacity', 'timestamps', 'prices', 'start', 'size')
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.prices = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def _index(self, i: int) -> int:
+        return (self.start + i) % self.capacity
+
+    def __len__(self) -> int:
+        return self.size
+
+    def first(self):
+        if not self.size:
+            return None
+        i = self.start
+        return self.timestamps[i], self.prices[i]
+
+    def last(self):
+        if not self.size:
+            return None
+        i = self._index(self.size - 1)
+        return self.timestamps[i], self.prices[i]
+
+    def append(self, timestamp: float, price: float):
+        """Add a point, evicting the oldest when full; out-of-order points are dropped"""
+        if self.size:
+            last = self._index(self.size - 1)
+            if timestamp < self.timestamps[last]:
+                return
+            if timestamp == self.timestamps[last]:
+                self.prices[last] = price
+                return
+        if self.size == self.capacity:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            i = self._index(self.size)
+            self.size += 1
+        self.timestamps[i] = timestamp
+        self.prices[i] = price
+
+    def replace_last(self, timestamp: float, price: float):
+        i = self._index(self.size - 1)
+        self.timestamps[i] = timestamp
+        self.prices[i] = price
+
+    def at_or_before(self, timestamp: float):
+        """Latest point not after `timestamp`, by binary search over the logical order"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._index(mid)] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        i = self._index(lo - 1)
+        return self.timestamps[i], self.prices[i]
+
+    def items(self):
+        for n in range(self.size):
+            i = self._index(n)
+            yield self.timestamps[i], self.prices[i]
+
+
+class PriceWindow:
+    """Rolling per-symbol price series covering the standard change windows"""
+
+    __slots__ = ('fine', 'coarse')
+
+    def __init__(self):
+        self.fine = RingBuffer(FINE_SPAN)
+        self.coarse = RingBuffer(COARSE_SPAN // COARSE_RESOLUTION)
+
+    def append(self, timestamp: float, price: float):
+        self.fine.append(timestamp, price)
+        last = self.coarse.last()
+        if last is not None and last[0] // COARSE_RESOLUTION == timestamp // COARSE_RESOLUTION:
+            if timestamp >= last[0]:
+                self.coarse.replace_last(timestamp, price)
+        else:
+            self.coarse.append(timestamp, price)
+
+    def last_timestamp(self):
+        last = self.fine.last()
+        return last[0] if last else None
+
+    def price_at(self, timestamp: float):
+        """Last known price at or before `timestamp`, or None when out of range"""
+        first = self.fine.first()
+        if first is not None and timestamp >= first[0]:
+            point = self.fine.at_or_before(timestamp)
+        else:
+            point = self.coarse.at_or_before(timestamp)
+        return point[1] if point else None
+
+
+class PriceWindowCache:
+    """In-process price windows for every symbol, answering "price N seconds ago" without Redis"""
+
+    def __init__(self):
+        self.windows = {}
+        self.rebuilding = False
+
+    def stop_rebuild(self):
+        # redis.asyncio can swallow a task cancel that lands mid-command, so the loop also checks this flag
+        self.rebuilding = False
+
+    def record(self, symbol: str, timestamp: float, price: float):
+        window = self.windows.get(symbol)
+        if window is None:
+            window = self.windows[symbol] = PriceWindow()
+        window.append(timestamp, price)
+
+    def record_tick(self, market_data: dict):
+        for symbol, quote in market_data.items():
+            self.record(symbol, quote['timestamp'], quote['spot'])
+
+    def price_ago(self, symbol: str, seconds: float, now: float = None):
+        window = self.windows.get(symbol)
+        if window is None:
+            return None
+        return window.price_at((now if now is not None else time.time()) - seconds)
+
+    def change(self, symbol: str, seconds: float, current: float, now: float = None):
+        """Percent change of `current` against the price `seconds` ago"""
+        previous = self.price_ago(symbol, seconds, now)
+        if not previous:
+            return None
+        return (current - previous) / previous * 100
+
+    def changes(self, symbol: str, current: float, now: float = None) -> dict:
+        return {name: self.change(symbol, seconds, current, now) for name, seconds in STANDARD_WINDOWS.items()}
+
+    async def rebuild(self, price_history, symbols, span: int = None, chunk: int = 60 * 60):
+        """Reload windows from Redis, keeping any live ticks recorded while loading"""
+        span = span or max(STANDARD_WINDOWS.values())
+        start_time = time.time()
+        loaded = 0
+        self.rebuilding = True
+        for symbol in symbols:
+            window = PriceWindow()
+            end = int(time.time())
+            try:
+                for chunk_start in range(end - span, end + 1, chunk):
+                    if not self.rebuilding:
+                        logger.info("Price window rebuild stopped at %s", symbol)
+                        return
+                    prices = await price_history.get_price_range(symbol, chunk_start, min(chunk_start + chunk - 1, end))
+                    for price in prices:
+                        window.append(price['timestamp'], (price['bid'] + price['ask']) / 2)
+                    loaded += len(prices)
+            except redis.RedisError as e:
+                logger.error("Aborting price window rebuild at %s: %s", symbol, e)
+                self.rebuilding = False
+                return
+
+            live = self.windows.get(symbol)
+            if live is not None:
+                rebuilt_until = window.last_timestamp() or 0
+                for timestamp, price in live.fine.items():
+                    if timestamp > rebuilt_until:
+                        window.append(timestamp, price)
+            self.windows[symbol] = window
+            await asyncio.sleep(0)
+
+        self.rebuilding = False
+        logger.info("Rebuilt price windows for %s symbols from %s entries in %.2fs", len(symbols), loaded, time.time() - start_time)
@@ -12,14 +12,15 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from markets.routing import websocket_urlpatterns
+from markets.resources import WarmUpMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'websocket_project.settings')
 
-application = ProtocolTypeRouter({
+application = WarmUpMiddleware(ProtocolTypeRouter({
     "http": get_asgi_application(),
     "websocket": AuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
     ),
-})
+}))
@@ -130,9 +130,66 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0
+REDIS_MAX_CONNECTIONS = 50  # shared asyncio pool size per process
+# Raw ticks are kept this long, then rolled into 1m and 1h tiers (markets.models.PRICE_HISTORY_TIERS)
+PRICE_HISTORY_RAW_RETENTION = 24 * 60 * 60
+PRICE_HISTORY_COMPACT_INTERVAL = 60  # seconds between compaction passes
+PRICE_HISTORY_COMPACT_BATCH = 1000  # entries moved per Redis transaction
 
 # Newton API settings
 NEWTON_API_URL = 'https://api.newton.co/markets/v1.1/rates'
+MARKET_DATA_POLL_INTERVAL = 1  # seconds between upstream polls, ticks land on multiples of it
+# Polls stretch towards this while Newton keeps returning the same body
+MARKET_DATA_MAX_POLL_INTERVAL = 5
+UPSTREAM_TIMEOUT = 5  # seconds per Newton request
+UPSTREAM_BACKOFF_MAX = 30  # ceiling of the jittered exponential backoff on errors
+# Consecutive failures that open the circuit, and seconds before a trial request
+UPSTREAM_BREAKER_THRESHOLD = 5
+UPSTREAM_BREAKER_RESET = 30
+# The process-wide Newton session keeps idle connections for UPSTREAM_KEEPALIVE
+# seconds (longer than the slowest poll) and caches DNS answers
+UPSTREAM_MAX_CONNECTIONS = 4
+UPSTREAM_KEEPALIVE = 60
+UPSTREAM_DNS_CACHE_TTL = 300
+# Where snapshots come from: "live" polls Newton, "record" polls Newton and appends
+# every changed snapshot to MARKET_DATA_LOG, "replay" plays that log back without
+# network at MARKET_DATA_REPLAY_SPEED times the recorded pace (0 = as fast as possible)
+MARKET_DATA_SOURCE = os.environ.get('MARKET_DATA_SOURCE', 'live')
+MARKET_DATA_LOG = os.environ.get('MARKET_DATA_LOG', str(BASE_DIR / 'newton.rec'))
+MARKET_DATA_REPLAY_SPEED = float(os.environ.get('MARKET_DATA_REPLAY_SPEED', '1'))
+MARKET_DATA_REPLAY_LOOP = os.environ.get('MARKET_DATA_REPLAY_LOOP', '') == '1'
+# Rates subscriptions may ask for one of these throttles to get at most one update per
+# period, on wall-clock boundaries, instead of one per tick
+RATES_THROTTLES = {"100ms": 0.1, "1s": 1, "5s": 5}
+# Per-connection outbound queue: pending frames before conflating to a snapshot,
+# and how far behind a client may fall before it is disconnected
+CLIENT_SEND_QUEUE_SIZE = 64
+CLIENT_MAX_LAG_SECONDS = 30
+# Idle connections get a {"event": "heartbeat"} frame after this many seconds without
+# any other frame; clients silent (no message, not even a ping) for CLIENT_IDLE_TIMEOUT
+# seconds are closed, None keeps them open
+CLIENT_HEARTBEAT_INTERVAL = 30
+CLIENT_IDLE_TIMEOUT = None
+# History queries a client may have in flight at once
+CLIENT_MAX_PENDING_REQUESTS = 4
+# Compute "change" locally over this many seconds from the in-memory price window
+# (e.g. 24 * 60 * 60); None passes Newton's own change through
+PRICE_CHANGE_WINDOW = None
+
+# Multi-process mode: run several daphne processes against one Redis. The channel
+# layer moves to Redis and a Redis lock elects the single process that polls Newton;
+# a dead leader is replaced once its lock expires after PRODUCER_LEADER_TTL seconds
+MARKETS_MULTIPROCESS = os.environ.get('MARKETS_MULTIPROCESS', '') == '1'
+PRODUCER_LEADER_KEY = 'markets:producer:leader'
+PRODUCER_LEADER_TTL = 5
+# The Redis channel layer drops group members CHANNEL_GROUP_EXPIRY seconds after they joined;
+# producers re-join the sync group every PRODUCER_SYNC_REJOIN seconds so followers never age out
+CHANNEL_GROUP_EXPIRY = 24 * 60 * 60
+PRODUCER_SYNC_REJOIN = 60
+
+# Price history queries: how long a result page stays cached, and how many are kept
+HISTORY_CACHE_TTL = 5
+HISTORY_CACHE_SIZE = 256
 
 SUPPORTED_ASSETS = [
     "BTC", "ETH", "LTC", "XRP", "BCH", "USDC", "XMR", "XLM",
@@ -153,6 +210,25 @@ CHANNEL_LAYERS = {
     }
 }
 
+if MARKETS_MULTIPROCESS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [(REDIS_HOST, REDIS_PORT)],
+                "group_expiry": CHANNEL_GROUP_EXPIRY,
+            },
+        }
+    }
+
+# Level of the markets/redis loggers, whether their handlers run on a background
+# thread instead of the event loop, and how many lines per message template and
+# client/symbol key get through each period (errors always do)
+LOG_LEVEL = os.environ.get('MARKETS_LOG_LEVEL', 'DEBUG')
+LOG_BACKGROUND = os.environ.get('MARKETS_LOG_BACKGROUND', '1') == '1'
+LOG_RATE_LIMIT = 10
+LOG_RATE_PERIOD = 60
+
 # Add these logging settings
 LOGGING = {
     'version': 1,
@@ -167,26 +243,36 @@ LOGGING = {
             'style': '{',
         },
     },
+    # With LOG_BACKGROUND the rate limit moves in front of the queue, so suppressed lines are never queued
+    'filters': {
+        'rate_limit': {
+            '()': 'markets.log.RateLimitFilter',
+            'rate': LOG_RATE_LIMIT,
+            'per': LOG_RATE_PERIOD,
+        },
+    },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
             'formatter': 'simple',
+            'filters': ['rate_limit'],
         },
         'file': {
             'class': 'logging.FileHandler',
             'filename': 'debug.log',
             'formatter': 'verbose',
+            'filters': ['rate_limit'],
         },
     },
     'loggers': {
         'markets': {
             'handlers': ['console', 'file'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
         'redis': {
             'handlers': ['console', 'file'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': True,
         },
     },
@@ -15,8 +15,11 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
+from django.urls import include, path
+from markets import views as markets_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('markets/', include('markets.urls')),
+    path('metrics', markets_views.metrics, name='metrics'),
 ]